@@ -6,6 +6,8 @@ import { GoogleAuth } from "google-auth-library";
 export interface AgentRequest {
   action: string;
   parameters: Record<string, unknown>;
+  includeRawResponse?: boolean;
+  includeUsage?: boolean;
 }
 
 export interface AgentResponse {
@@ -14,6 +16,25 @@ export interface AgentResponse {
   error?: string;
 }
 
+/** Token usage of the provider calls made for one agent request. */
+export interface AgentUsage {
+  calls: number;
+  inputTokens: number;
+  outputTokens: number;
+  generationSeconds: number;
+  timeToFirstToken: number | null;
+}
+
+/** One line of the agent service's streaming response. */
+export interface AgentStreamEvent {
+  type: "progress" | "result";
+  stage?: string;
+  success?: boolean;
+  data?: unknown;
+  error?: string | null;
+  [key: string]: unknown;
+}
+
 /**
  * Configuration for agent service.
  * In production, this should point to the deployed Cloud Run service.
@@ -25,6 +46,12 @@ const AGENT_SERVICE_URL = RAW_SERVICE_URL.replace(/\/$/, "");
 
 const isLocalDevelopment = process.env.FUNCTIONS_EMULATOR === "true";
 
+// How long to wait for the agent service. The service is told to give up a
+// little earlier (X-Deadline-Ms) so it can cancel its work and answer 504
+// before this client times out.
+const AGENT_TIMEOUT_MS = 300000;
+const AGENT_DEADLINE_MARGIN_MS = 5000;
+
 // Warn if using localhost in production
 if (!isLocalDevelopment && AGENT_SERVICE_URL.includes("localhost")) {
   logger.error(
@@ -56,14 +83,43 @@ async function getIdentityToken(): Promise<string | null> {
   }
 }
 
+/**
+ * Headers for a request to the agent service, including auth and the deadline.
+ * The user ID lets the service share its capacity fairly between users.
+ */
+async function buildHeaders(userId?: string): Promise<Record<string, string>> {
+  const identityToken = await getIdentityToken();
+  logger.info(`Identity token obtained: ${identityToken ? "yes" : "no"}`);
+
+  const headers: Record<string, string> = {
+    "Content-Type": "application/json",
+    "X-Deadline-Ms": String(AGENT_TIMEOUT_MS - AGENT_DEADLINE_MARGIN_MS),
+  };
+
+  if (identityToken) {
+    headers.Authorization = `Bearer ${identityToken}`;
+  }
+  if (userId) {
+    headers["X-User-Id"] = userId;
+  }
+  return headers;
+}
+
 /**
  * Call the Python agent service.
  */
 export async function callAgent(
   action: string,
-  parameters: Record<string, unknown>
+  parameters: Record<string, unknown>,
+  userId?: string
 ): Promise<AgentResponse> {
-  const request: AgentRequest = { action, parameters };
+  // No caller reads rawResponse, so skip sending the duplicated text
+  const request: AgentRequest = {
+    action,
+    parameters,
+    includeRawResponse: false,
+    includeUsage: true,
+  };
 
   try {
     logger.info(`Calling agent service: ${action}`, {
@@ -71,16 +127,7 @@ export async function callAgent(
       parameters: Object.keys(parameters),
     });
 
-    const identityToken = await getIdentityToken();
-    logger.info(`Identity token obtained: ${identityToken ? "yes" : "no"}`);
-
-    const headers: Record<string, string> = {
-      "Content-Type": "application/json",
-    };
-
-    if (identityToken) {
-      headers.Authorization = `Bearer ${identityToken}`;
-    }
+    const headers = await buildHeaders(userId);
 
     logger.info(`Making POST request to agent service...`, {
       url: `${AGENT_SERVICE_URL}/agent/execute`,
@@ -94,7 +141,7 @@ export async function callAgent(
       request,
       {
         headers,
-        timeout: 300000,
+        timeout: AGENT_TIMEOUT_MS,
       }
     );
     const duration = Date.now() - startTime;
@@ -157,17 +204,117 @@ export async function callAgent(
   }
 }
 
+/**
+ * Call the Python agent service's streaming endpoint.
+ *
+ * Progress events are passed to onProgress as they arrive. The returned
+ * response has the same shape as callAgent's.
+ */
+export async function callAgentStream(
+  action: string,
+  parameters: Record<string, unknown>,
+  onProgress: (event: AgentStreamEvent) => void | Promise<void>,
+  userId?: string
+): Promise<AgentResponse> {
+  const request: AgentRequest = {
+    action,
+    parameters,
+    includeRawResponse: false,
+    includeUsage: true,
+  };
+
+  try {
+    logger.info(`Calling agent service (streaming): ${action}`, {
+      url: `${AGENT_SERVICE_URL}/agent/execute/stream`,
+      parameters: Object.keys(parameters),
+    });
+
+    const headers = await buildHeaders(userId);
+    const response = await axios.post(
+      `${AGENT_SERVICE_URL}/agent/execute/stream`,
+      request,
+      {
+        headers,
+        timeout: AGENT_TIMEOUT_MS,
+        responseType: "stream",
+      }
+    );
+
+    // Newline-delimited JSON: one event per line
+    const decoder = new TextDecoder();
+    let buffer = "";
+    let result: AgentStreamEvent | undefined;
+    for await (const chunk of response.data as AsyncIterable<Uint8Array>) {
+      buffer += decoder.decode(chunk, { stream: true });
+      let newline = buffer.indexOf("\n");
+      while (newline >= 0) {
+        const line = buffer.slice(0, newline).trim();
+        buffer = buffer.slice(newline + 1);
+        newline = buffer.indexOf("\n");
+        if (!line) continue;
+
+        const event = JSON.parse(line) as AgentStreamEvent;
+        if (event.type === "progress") {
+          await onProgress(event);
+        } else if (event.type === "result") {
+          result = event;
+        }
+      }
+    }
+
+    if (!result) {
+      return { success: false, error: "Agent stream ended without a result" };
+    }
+    if (!result.success) {
+      return { success: false, error: result.error || "Agent generation failed" };
+    }
+    return {
+      success: true,
+      data: {
+        success: true,
+        data: result.data,
+        error: null,
+        usage: result.usage,
+      },
+    };
+  } catch (error) {
+    const errorMessage = error instanceof Error ? error.message : String(error);
+    logger.error(`Agent service stream error [${action}]: ${errorMessage}`);
+    logger.error(`Attempted URL: ${AGENT_SERVICE_URL}`);
+    return {
+      success: false,
+      error: errorMessage,
+    };
+  }
+}
+
+/**
+ * Token usage reported with a successful agent response, if any.
+ */
+export function getAgentUsage(response: AgentResponse): AgentUsage | null {
+  const envelope = response.data as { usage?: AgentUsage } | undefined;
+  return envelope?.usage ?? null;
+}
+
 /**
  * Call agent with retry logic.
+ *
+ * With onProgress, the streaming endpoint is used and progress events are
+ * passed to it as they arrive. userId is sent so the service can schedule
+ * requests fairly between users.
  */
 export async function callAgentWithRetry(
   action: string,
   parameters: Record<string, unknown>,
   maxRetries = 3,
-  retryDelay = 1000
+  retryDelay = 1000,
+  onProgress?: (event: AgentStreamEvent) => void | Promise<void>,
+  userId?: string
 ): Promise<AgentResponse> {
   for (let attempt = 1; attempt <= maxRetries; attempt++) {
-    const result = await callAgent(action, parameters);
+    const result = onProgress
+      ? await callAgentStream(action, parameters, onProgress, userId)
+      : await callAgent(action, parameters, userId);
 
     // If successful, return immediately
     if (result.success) {
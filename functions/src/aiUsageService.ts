@@ -1,6 +1,7 @@
 /** AI Usage tracking and validation utilities. */
 import * as admin from "firebase-admin";
 import * as logger from "firebase-functions/logger";
+import { AgentUsage } from "./agentService";
 
 const db = admin.firestore();
 
@@ -70,3 +71,36 @@ export async function checkAndIncrementAiUsage(
     return { allowed: true, currentUsage: 0, remaining: 10 };
   }
 }
+
+/**
+ * Add the tokens an agent request used to the user's running totals.
+ * Failures are logged and otherwise ignored.
+ */
+export async function recordTokenUsage(
+  userId: string,
+  action: string,
+  usage: AgentUsage | null
+): Promise<void> {
+  if (!usage) return;
+  try {
+    const increment = admin.firestore.FieldValue.increment;
+    await db
+      .collection("users")
+      .doc(userId)
+      .set(
+        {
+          aiTokenUsage: {
+            inputTokens: increment(usage.inputTokens),
+            outputTokens: increment(usage.outputTokens),
+            calls: increment(usage.calls),
+            byAction: {
+              [action]: increment(usage.inputTokens + usage.outputTokens),
+            },
+          },
+        },
+        { merge: true }
+      );
+  } catch (error) {
+    logger.error("Error recording AI token usage", error);
+  }
+}
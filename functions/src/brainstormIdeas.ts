@@ -2,8 +2,11 @@
 import { onRequest } from "firebase-functions/v2/https";
 import * as logger from "firebase-functions/logger";
 import { requireStoryOwnership } from "./authService";
-import { callAgentWithRetry } from "./agentService";
-import { checkAndIncrementAiUsage } from "./aiUsageService";
+import { callAgentWithRetry, getAgentUsage } from "./agentService";
+import {
+  checkAndIncrementAiUsage,
+  recordTokenUsage,
+} from "./aiUsageService";
 import { corsOptions } from "./corsConfig";
 
 /**
@@ -44,12 +47,19 @@ export const brainstormIdeas = onRequest(
       const ideaCount = count && typeof count === "number" ? count : 5;
 
       // Call agent synchronously
-      const agentResponse = await callAgentWithRetry("brainstormIdeas", {
-        storyId,
-        type,
-        prompt,
-        count: ideaCount,
-      });
+      const agentResponse = await callAgentWithRetry(
+        "brainstormIdeas",
+        {
+          storyId,
+          type,
+          prompt,
+          count: ideaCount,
+        },
+        3,
+        1000,
+        undefined,
+        userId
+      );
 
       if (!agentResponse.success || !agentResponse.data) {
         response.status(500).json({
@@ -59,6 +69,11 @@ export const brainstormIdeas = onRequest(
         return;
       }
 
+      await recordTokenUsage(
+        userId,
+        "brainstormIdeas",
+        getAgentUsage(agentResponse)
+      );
       response.status(200).json(agentResponse.data);
     } catch (error) {
       logger.error("Error in brainstormIdeas", error);
@@ -80,11 +95,18 @@ export const brainstormCharacter = onRequest(
       const { role, archetype } = request.body;
 
       // Call agent synchronously
-      const agentResponse = await callAgentWithRetry("brainstormCharacter", {
-        storyId,
-        role,
-        archetype,
-      });
+      const agentResponse = await callAgentWithRetry(
+        "brainstormCharacter",
+        {
+          storyId,
+          role,
+          archetype,
+        },
+        3,
+        1000,
+        undefined,
+        userId
+      );
 
       if (!agentResponse.success || !agentResponse.data) {
         response.status(500).json({
@@ -94,6 +116,11 @@ export const brainstormCharacter = onRequest(
         return;
       }
 
+      await recordTokenUsage(
+        userId,
+        "brainstormCharacter",
+        getAgentUsage(agentResponse)
+      );
       response.status(200).json(agentResponse.data);
     } catch (error) {
       logger.error("Error in brainstormCharacter", error);
@@ -119,10 +146,17 @@ export const brainstormPlot = onRequest(
         plotType && validPlotTypes.includes(plotType) ? plotType : "conflict";
 
       // Call agent synchronously
-      const agentResponse = await callAgentWithRetry("brainstormPlot", {
-        storyId,
-        plotType: finalPlotType,
-      });
+      const agentResponse = await callAgentWithRetry(
+        "brainstormPlot",
+        {
+          storyId,
+          plotType: finalPlotType,
+        },
+        3,
+        1000,
+        undefined,
+        userId
+      );
 
       if (!agentResponse.success || !agentResponse.data) {
         response.status(500).json({
@@ -132,6 +166,11 @@ export const brainstormPlot = onRequest(
         return;
       }
 
+      await recordTokenUsage(
+        userId,
+        "brainstormPlot",
+        getAgentUsage(agentResponse)
+      );
       response.status(200).json(agentResponse.data);
     } catch (error) {
       logger.error("Error in brainstormPlot", error);
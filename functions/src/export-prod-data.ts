@@ -1,5 +1,6 @@
 import * as admin from "firebase-admin";
 import * as dotenv from "dotenv";
+import * as fs from "fs";
 
 dotenv.config();
 
@@ -63,6 +64,12 @@ async function exportData() {
     console.log("\n✅ Data exported from production");
     console.log(`Total stories exported: ${storiesSnapshot.size}`);
 
+    // Optionally keep the dataset on disk, e.g. for python/run-batch.py --export
+    if (process.env.EXPORT_FILE) {
+      fs.writeFileSync(process.env.EXPORT_FILE, JSON.stringify(exportData));
+      console.log(`Dataset written to ${process.env.EXPORT_FILE}`);
+    }
+
     // Now import to EMULATOR
     console.log("\n📥 Importing to emulator...");
 
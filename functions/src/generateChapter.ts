@@ -33,12 +33,14 @@ export const generateChapter = onRequest(
       });
 
       // Start processing asynchronously
-      processChapterGeneration(jobId, storyId, chapterNumber).catch((error) => {
-        logger.error(
-          `Error in background chapter generation for job ${jobId}`,
-          error
-        );
-      });
+      processChapterGeneration(jobId, storyId, userId, chapterNumber).catch(
+        (error) => {
+          logger.error(
+            `Error in background chapter generation for job ${jobId}`,
+            error
+          );
+        }
+      );
 
       response.status(202).json({
         jobId,
@@ -61,6 +63,7 @@ export const generateChapter = onRequest(
 async function processChapterGeneration(
   jobId: string,
   storyId: string,
+  userId: string,
   chapterNumber: number
 ): Promise<void> {
   try {
@@ -78,12 +81,27 @@ async function processChapterGeneration(
 
     await updateJobStatus(db, jobId, "processing", 25);
 
-    // Call agent to generate chapter
-    const agentResponse = await callAgentWithRetry("generateChapter", {
-      storyId,
-      chapterNumber,
-      previousChapters,
-    });
+    // Call agent to generate chapter. When the service generates scenes
+    // concurrently, job progress advances from 25 to 75 as scenes complete.
+    let scenesDone = 0;
+    const agentResponse = await callAgentWithRetry(
+      "generateChapter",
+      {
+        storyId,
+        chapterNumber,
+        previousChapters,
+      },
+      3,
+      1000,
+      async (event) => {
+        if (event.stage === "scene" && typeof event.total === "number") {
+          scenesDone += 1;
+          const progress = 25 + Math.round((50 * scenesDone) / event.total);
+          await updateJobStatus(db, jobId, "processing", progress);
+        }
+      },
+      userId
+    );
 
     if (!agentResponse.success || !agentResponse.data) {
       throw new Error(agentResponse.error || "Agent generation failed");
@@ -91,21 +109,33 @@ async function processChapterGeneration(
 
     await updateJobStatus(db, jobId, "processing", 75);
 
-    const generatedContent = agentResponse.data as {
+    const pythonResponse = agentResponse.data as {
+      success?: boolean;
+      data?: unknown;
+      error?: string | null;
+    };
+
+    // Extract the actual content object from the nested structure
+    if (!pythonResponse.data) {
+      throw new Error("Agent response missing nested data field");
+    }
+
+    const generatedContent = pythonResponse.data as {
       content: string;
       chapterNumber: number;
+      title?: string;
     };
 
     // Parse chapter content (simple extraction - could be enhanced)
     // Extract title if present
     const contentLines = generatedContent.content.split("\n");
-    let title = `Chapter ${chapterNumber}`;
+    let title = generatedContent.title || `Chapter ${chapterNumber}`;
     let content = generatedContent.content;
 
     // Try to extract title from format "Title: [title]"
-    const titleMatch = contentLines.find((line) =>
-      line.toLowerCase().startsWith("title:")
-    );
+    const titleMatch = generatedContent.title
+      ? undefined
+      : contentLines.find((line) => line.toLowerCase().startsWith("title:"));
     if (titleMatch) {
       title = titleMatch.split(":")[1]?.trim() || title;
       const titleIndex = contentLines.indexOf(titleMatch);
@@ -1,8 +1,11 @@
 import { onRequest } from "firebase-functions/v2/https";
-import { callAgentWithRetry } from "./agentService";
+import { callAgentWithRetry, getAgentUsage } from "./agentService";
 import { requireStoryOwnership } from "./authService";
 import * as logger from "firebase-functions/logger";
-import { checkAndIncrementAiUsage } from "./aiUsageService";
+import {
+  checkAndIncrementAiUsage,
+  recordTokenUsage,
+} from "./aiUsageService";
 import { corsOptions } from "./corsConfig";
 
 export const generateNextLines = onRequest(
@@ -19,17 +22,48 @@ export const generateNextLines = onRequest(
         return;
       }
 
-      const { content, cursorPosition, chapterId } = request.body;
+      const {
+        content,
+        cursorPosition,
+        chapterId,
+        prefix,
+        suffix,
+        baseHash,
+        edits,
+        contentHash,
+        regenerate,
+      } = request.body;
+
+      // The text around the cursor can be sent as the full chapter content,
+      // a pre-sliced prefix/suffix window, or edits against the agent's
+      // cached chapter buffer (baseHash + edits, requires chapterId).
+      const hasWindow = typeof prefix === "string";
+      const hasDelta = typeof baseHash === "string" && Array.isArray(edits);
 
       // Validate required parameters
-      if (!content || typeof content !== "string") {
+      if (
+        !hasWindow &&
+        !hasDelta &&
+        (!content || typeof content !== "string")
+      ) {
         response.status(400).json({
-          error: "content is required and must be a string",
+          error:
+            "content is required and must be a string (or send prefix, or baseHash and edits)",
         });
         return;
       }
 
-      if (cursorPosition === undefined || typeof cursorPosition !== "number") {
+      if (hasDelta && !chapterId) {
+        response.status(400).json({
+          error: "chapterId is required when sending baseHash and edits",
+        });
+        return;
+      }
+
+      if (
+        !hasWindow &&
+        (cursorPosition === undefined || typeof cursorPosition !== "number")
+      ) {
         response.status(400).json({
           error: "cursorPosition is required and must be a number",
         });
@@ -37,12 +71,25 @@ export const generateNextLines = onRequest(
       }
 
       // Call agent synchronously
-      const agentResponse = await callAgentWithRetry("generateNextLines", {
-        storyId,
-        content,
-        cursorPosition,
-        chapterId, // Optional: helps identify which chapter for better context
-      });
+      const agentResponse = await callAgentWithRetry(
+        "generateNextLines",
+        {
+          storyId,
+          content,
+          cursorPosition: cursorPosition ?? 0,
+          chapterId, // Optional: helps identify which chapter for better context
+          prefix,
+          suffix,
+          baseHash,
+          edits,
+          contentHash,
+          regenerate: regenerate === true, // Skip suggestions cached for the same prompt
+        },
+        3,
+        1000,
+        undefined,
+        userId
+      );
 
       if (!agentResponse.success || !agentResponse.data) {
         response.status(500).json({
@@ -52,6 +99,11 @@ export const generateNextLines = onRequest(
         return;
       }
 
+      await recordTokenUsage(
+        userId,
+        "generateNextLines",
+        getAgentUsage(agentResponse)
+      );
       response.status(200).json(agentResponse.data);
     } catch (error) {
       logger.error("Error in generateNextLines", error);
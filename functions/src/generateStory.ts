@@ -27,14 +27,16 @@ export const generateStory = onRequest(
       });
 
       // Start processing asynchronously (don't await)
-      processStoryGeneration(jobId, storyId, { genre, tone, length }).catch(
-        (error) => {
-          logger.error(
-            `Error in background story generation for job ${jobId}`,
-            error
-          );
-        }
-      );
+      processStoryGeneration(jobId, storyId, userId, {
+        genre,
+        tone,
+        length,
+      }).catch((error) => {
+        logger.error(
+          `Error in background story generation for job ${jobId}`,
+          error
+        );
+      });
 
       response.status(202).json({
         jobId,
@@ -57,18 +59,38 @@ export const generateStory = onRequest(
 async function processStoryGeneration(
   jobId: string,
   storyId: string,
+  userId: string,
   options: { genre?: string; tone?: string; length?: string }
 ): Promise<void> {
   try {
     await updateJobStatus(db, jobId, "processing", 0);
 
-    // Call agent to generate story
-    const agentResponse = await callAgentWithRetry("generateStory", {
-      storyId,
-      genre: options.genre,
-      tone: options.tone,
-      length: options.length,
-    });
+    // Call agent to generate story. When the service generates chapters
+    // separately, job progress advances as chapters complete. A retry resumes
+    // from the chapters already checkpointed by the service.
+    let chaptersDone = 0;
+    const agentResponse = await callAgentWithRetry(
+      "generateStory",
+      {
+        storyId,
+        genre: options.genre,
+        tone: options.tone,
+        length: options.length,
+      },
+      3,
+      1000,
+      async (event) => {
+        if (event.stage === "chapter" && typeof event.total === "number") {
+          chaptersDone += 1;
+          const progress = Math.min(
+            90,
+            Math.round((90 * chaptersDone) / event.total)
+          );
+          await updateJobStatus(db, jobId, "processing", progress);
+        }
+      },
+      userId
+    );
 
     if (!agentResponse.success || !agentResponse.data) {
       throw new Error(agentResponse.error || "Agent generation failed");
@@ -28,3 +28,4 @@ export {
 export { authenticate } from "./authenticate";
 export { getData } from "./getData";
 export { generateNextLines } from "./generateNextLines";
+export { prefetchChapter } from "./prefetchChapter";
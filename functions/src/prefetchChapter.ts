@@ -0,0 +1,41 @@
+import { onRequest } from "firebase-functions/v2/https";
+import { callAgent } from "./agentService";
+import { requireStoryOwnership } from "./authService";
+import * as logger from "firebase-functions/logger";
+import { corsOptions } from "./corsConfig";
+
+/**
+ * Warm the agent's caches for a chapter the author just opened, so the first
+ * next line suggestion does not pay for the Firestore reads. Best effort:
+ * fired without waiting by the editor, and not counted as AI usage.
+ */
+export const prefetchChapter = onRequest(
+  corsOptions,
+  requireStoryOwnership(async (request, response, userId, storyId) => {
+    try {
+      const { chapterId } = request.body;
+
+      const agentResponse = await callAgent(
+        "prefetchContext",
+        { storyId, chapterId },
+        userId
+      );
+
+      if (!agentResponse.success) {
+        logger.warn("Prefetch failed", {
+          storyId,
+          chapterId,
+          error: agentResponse.error,
+        });
+      }
+
+      response.status(204).send();
+    } catch (error) {
+      logger.error("Error in prefetchChapter", error);
+      response.status(500).json({
+        error: "Internal server error",
+        details: error instanceof Error ? error.message : String(error),
+      });
+    }
+  })
+);
@@ -0,0 +1,273 @@
+"""Story-affinity routing: requests for a story are served by one owner instance, picked by consistent hashing."""
+import bisect
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import httpx
+
+# Handle imports for both direct execution and module import
+try:
+    from .metrics import metrics
+except ImportError:
+    # Add parent directory to path for direct execution
+    current_dir = Path(__file__).parent
+    parent_dir = current_dir.parent.parent
+    if str(parent_dir) not in sys.path:
+        sys.path.insert(0, str(parent_dir))
+    from agents.storyAgent.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Base URLs of every instance taking part, this one included, comma-separated (unset: affinity disabled)
+AFFINITY_PEERS = os.getenv("AFFINITY_PEERS", "")
+# This instance's base URL, exactly as it appears in AFFINITY_PEERS
+AFFINITY_SELF = os.getenv("AFFINITY_SELF", "")
+# Points per instance on the hash ring; more points spread stories more evenly
+AFFINITY_VNODES = int(os.getenv("AFFINITY_VNODES", "64"))
+# Seconds to wait for a connection to the owner before serving the request here
+AFFINITY_CONNECT_TIMEOUT = float(os.getenv("AFFINITY_CONNECT_TIMEOUT", "1"))
+# Seconds an owner that could not be reached is skipped (its stories move to the next instance on the ring)
+AFFINITY_PEER_COOLDOWN = float(os.getenv("AFFINITY_PEER_COOLDOWN", "30"))
+
+# Header marking a forwarded request, so it is never forwarded again
+HOP_HEADER = b"x-affinity-hop"
+# Hop-by-hop headers, not passed on by the forwarding proxy
+_HOP_BY_HOP = {b"connection", b"keep-alive", b"transfer-encoding", b"te", b"upgrade", b"host", b"content-length"}
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+    """
+    Consistent-hash ring over instance names.
+
+    Each instance is placed at `vnodes` points; a key belongs to the first
+    instance clockwise from its hash. Adding or removing an instance only
+    moves the keys of the arcs next to its points, so most stories keep
+    their owner when the instance set changes.
+    """
+
+    def __init__(self, nodes: Iterable[str], vnodes: int = AFFINITY_VNODES):
+        self.nodes = sorted(set(nodes))
+        points = sorted((_hash(f"{node}#{index}"), node) for node in self.nodes for index in range(vnodes))
+        self._hashes = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owner(self, key: str, skip: Iterable[str] = ()) -> Optional[str]:
+        """
+        The instance that owns key.
+
+        Args:
+            key: Routing key (a story ID)
+            skip: Instances to pass over, e.g. ones that cannot be reached
+
+        Returns:
+            The first instance clockwise from the key's hash that is not skipped,
+            or None if every instance is skipped
+        """
+        if not self._hashes:
+            return None
+        skip = set(skip)
+        start = bisect.bisect(self._hashes, _hash(key))
+        for offset in range(len(self._owners)):
+            node = self._owners[(start + offset) % len(self._owners)]
+            if node not in skip:
+                return node
+        return None
+
+
+def routing_key(body: bytes) -> Optional[str]:
+    """The story ID of an agent request body, or None if it has none."""
+    try:
+        story_id = (json.loads(body).get("parameters") or {}).get("storyId")
+    except (ValueError, AttributeError):
+        return None
+    return story_id if isinstance(story_id, str) and story_id else None
+
+
+class StoryAffinity:
+    """
+    Which instance owns each story, and the proxy that forwards requests to it.
+
+    The owner is picked on a HashRing over AFFINITY_PEERS. When an owner cannot
+    be reached it is skipped for AFFINITY_PEER_COOLDOWN seconds: its stories
+    go to the next instance on the ring, which may be this one.
+    """
+
+    def __init__(self, peers: Optional[List[str]] = None, self_url: str = AFFINITY_SELF):
+        if peers is None:
+            peers = [peer.strip().rstrip("/") for peer in AFFINITY_PEERS.split(",") if peer.strip()]
+        self.self_url = self_url.rstrip("/")
+        self.ring = HashRing(peers)
+        self.enabled = len(self.ring.nodes) > 1 and self.self_url in self.ring.nodes
+        if peers and not self.enabled:
+            logger.warning(f"Story affinity disabled: AFFINITY_SELF {self_url!r} is not one of several AFFINITY_PEERS")
+            print(f"[AFFINITY] Story affinity disabled: AFFINITY_SELF {self_url!r} is not one of several AFFINITY_PEERS")
+        # Peer -> time until which it is skipped
+        self._down: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self._client: Optional[httpx.AsyncClient] = None
+
+    def _get_client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(None, connect=AFFINITY_CONNECT_TIMEOUT),
+                limits=httpx.Limits(max_connections=None, max_keepalive_connections=32),
+            )
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _unreachable(self) -> List[str]:
+        now = time.monotonic()
+        with self._lock:
+            return [peer for peer, until in self._down.items() if until > now]
+
+    def _mark_down(self, peer: str) -> None:
+        with self._lock:
+            self._down[peer] = time.monotonic() + AFFINITY_PEER_COOLDOWN
+
+    def owner(self, story_id: str) -> Optional[str]:
+        """The reachable instance that owns a story."""
+        return self.ring.owner(story_id, skip=self._unreachable())
+
+    async def forward(self, owner: str, scope: Dict[str, Any], body: bytes, send: Any) -> bool:
+        """
+        Proxy the request to its owner and stream the response back.
+
+        Returns:
+            False if the owner could not be reached, and nothing was sent yet
+        """
+        url = f"{owner}{scope['path']}"
+        if scope.get("query_string"):
+            url += "?" + scope["query_string"].decode("latin-1")
+        headers: List[Tuple[bytes, bytes]] = [
+            (name, value) for name, value in scope["headers"] if name not in _HOP_BY_HOP
+        ]
+        headers.append((HOP_HEADER, self.self_url.encode("latin-1")))
+
+        start = time.monotonic()
+        client = self._get_client()
+        try:
+            request = client.build_request("POST", url, headers=headers, content=body)
+            response = await client.send(request, stream=True)
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            self._mark_down(owner)
+            logger.warning(f"Story owner {owner} unreachable, serving here: {e}")
+            print(f"[AFFINITY] Story owner {owner} unreachable, serving here: {e}")
+            return False
+        except httpx.TransportError as e:
+            # The owner may have started the action: do not run it a second time here
+            logger.warning(f"Forwarded request to {owner} failed: {e}")
+            metrics.increment("affinity.forward_errors")
+            payload = json.dumps({"success": False, "error": f"Story owner {owner} failed: {e}"}).encode("utf-8")
+            await send({"type": "http.response.start", "status": 502, "headers": [(b"content-type", b"application/json")]})
+            await send({"type": "http.response.body", "body": payload, "more_body": False})
+            return True
+
+        metrics.increment("affinity.requests", route="forwarded")
+        try:
+            await send({
+                "type": "http.response.start",
+                "status": response.status_code,
+                "headers": [
+                    (name, value) for name, value in response.headers.raw if name.lower() not in _HOP_BY_HOP
+                ],
+            })
+            # Raw bytes: the owner's content encoding (e.g. gzip) is passed through as is
+            async for chunk in response.aiter_raw():
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        except httpx.HTTPError as e:
+            # The response has started: all that is left is to end it
+            logger.warning(f"Forwarded request to {owner} failed: {e}")
+            metrics.increment("affinity.forward_errors")
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            await response.aclose()
+            metrics.observe("affinity.forward_seconds", time.monotonic() - start)
+        return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Ring membership and unreachable peers, for /metrics."""
+        return {
+            "enabled": self.enabled,
+            "self": self.self_url,
+            "peers": self.ring.nodes,
+            "unreachable": self._unreachable(),
+        }
+
+
+# Process-wide ring; disabled unless AFFINITY_PEERS and AFFINITY_SELF are set
+story_affinity = StoryAffinity()
+
+
+class AffinityRouter:
+    """
+    ASGI middleware that sends each story's agent requests to the instance owning the story.
+
+    Requests this instance owns, requests without a story, and requests
+    already forwarded once are served here. Others are proxied to their owner
+    (see StoryAffinity), streaming the response back as it arrives, so
+    /agent/execute/stream keeps its progress events. A request whose owner
+    cannot be reached is served here.
+    """
+
+    def __init__(self, app: Any, path_prefix: str = "/agent/execute", affinity: Optional[StoryAffinity] = None):
+        self.app = app
+        self.path_prefix = path_prefix
+        self.affinity = affinity or story_affinity
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if (
+            not self.affinity.enabled
+            or scope["type"] != "http"
+            or scope["method"] != "POST"
+            or not scope["path"].startswith(self.path_prefix)
+            or any(name == HOP_HEADER for name, _ in scope["headers"])
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        # The story ID is in the body: read it all, then replay it to whoever serves the request
+        body = bytearray()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.extend(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+
+        story_id = routing_key(bytes(body))
+        owner = self.affinity.owner(story_id) if story_id else None
+        if owner is not None and owner != self.affinity.self_url:
+            if await self.affinity.forward(owner, scope, bytes(body), send):
+                return
+            route = "fallback"
+        else:
+            route = "local"
+        metrics.increment("affinity.requests", route=route)
+
+        replayed = False
+
+        async def receive_buffered() -> Dict[str, Any]:
+            nonlocal replayed
+            if not replayed:
+                replayed = True
+                return {"type": "http.request", "body": bytes(body), "more_body": False}
+            return await receive()
+
+        await self.app(scope, receive_buffered, send)
@@ -1,8 +1,10 @@
 """Main ADK agent implementation for story generation."""
+import asyncio
+import logging
 import os
 import sys
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Any, Callable, Dict, Optional
 
 # Handle imports for both direct execution and module import
 try:
@@ -14,6 +16,11 @@ try:
         PlotBrainstormingTool,
         NextLineGenerationTool,
     )
+    from .context_builder import StoryContextBuilder
+    from .llm_provider import LLMProvider, get_shared_llm_provider
+    from .single_flight import SingleFlight, canonical_key
+    from .deadline import DeadlineExceeded, check_deadline, deadline_scope
+    from .usage import usage_scope
 except ImportError:
     # Add parent directory to path for direct execution
     current_dir = Path(__file__).parent
@@ -28,6 +35,13 @@ except ImportError:
         PlotBrainstormingTool,
         NextLineGenerationTool,
     )
+    from agents.storyAgent.context_builder import StoryContextBuilder
+    from agents.storyAgent.llm_provider import LLMProvider, get_shared_llm_provider
+    from agents.storyAgent.single_flight import SingleFlight, canonical_key
+    from agents.storyAgent.deadline import DeadlineExceeded, check_deadline, deadline_scope
+    from agents.storyAgent.usage import usage_scope
+
+logger = logging.getLogger(__name__)
 
 
 class StoryAgent:
@@ -51,42 +65,115 @@ class StoryAgent:
 
         self.location = location
 
-        # Initialize tools
-        self.story_tool = StoryGenerationTool(self.project_id, self.location)
-        self.chapter_tool = ChapterGenerationTool(self.project_id, self.location)
-        self.brainstorm_tool = BrainstormingTool(self.project_id, self.location)
-        self.character_tool = CharacterBrainstormingTool(self.project_id, self.location)
-        self.plot_tool = PlotBrainstormingTool(self.project_id, self.location)
-        self.next_line_tool = NextLineGenerationTool(self.project_id, self.location)
+        # Tools are constructed on first use so startup stays cheap
+        self._tools: Dict[type, Any] = {}
+
+        # Identical concurrent requests (frontend retries, several tabs) share one execution
+        self._single_flight = SingleFlight()
+        self._context_builder = StoryContextBuilder(self.project_id)
+
+    def _get_tool(self, tool_class: type) -> Any:
+        """Return the tool instance for a class, constructing it on first use."""
+        tool = self._tools.get(tool_class)
+        if tool is None:
+            tool = tool_class(self.project_id, self.location)
+            self._tools[tool_class] = tool
+        return tool
+
+    @property
+    def llm_provider(self) -> LLMProvider:
+        """The LLM provider shared by all tools."""
+        return get_shared_llm_provider(self.project_id, self.location)
+
+    @property
+    def story_tool(self) -> StoryGenerationTool:
+        return self._get_tool(StoryGenerationTool)
+
+    @property
+    def chapter_tool(self) -> ChapterGenerationTool:
+        return self._get_tool(ChapterGenerationTool)
+
+    @property
+    def brainstorm_tool(self) -> BrainstormingTool:
+        return self._get_tool(BrainstormingTool)
+
+    @property
+    def character_tool(self) -> CharacterBrainstormingTool:
+        return self._get_tool(CharacterBrainstormingTool)
+
+    @property
+    def plot_tool(self) -> PlotBrainstormingTool:
+        return self._get_tool(PlotBrainstormingTool)
+
+    @property
+    def next_line_tool(self) -> NextLineGenerationTool:
+        return self._get_tool(NextLineGenerationTool)
 
     async def generate_next_lines(
         self,
         story_id: str,
-        content: str,
+        content: Optional[str],
         cursorPosition: int,
         chapter_id: Optional[str] = None,
+        prefix: Optional[str] = None,
+        suffix: Optional[str] = None,
+        base_hash: Optional[str] = None,
+        edits: Optional[list] = None,
+        content_hash: Optional[str] = None,
+        regenerate: bool = False,
     ) -> Dict[str, Any]:
         """
         Generate 3 next line suggestions based on chapter content and cursor position.
 
         Args:
             story_id: Firestore story document ID
-            content: Current content of the chapter being edited
-            cursorPosition: Character index where the new line should be inserted
+            content: Current content of the chapter being edited (optional with prefix or base_hash)
+            cursorPosition: Insertion point, in UTF-16 code units (a JavaScript string index)
             chapter_id: Optional chapter document ID for better context and validation
+            prefix: Optional pre-sliced text before the cursor
+            suffix: Optional pre-sliced text after the cursor
+            base_hash: Optional hash of the server-side chapter buffer the edits apply to
+            edits: Optional edits against the chapter buffer
+            content_hash: Optional hash of the chapter content after the edits
+            regenerate: Bypass suggestions cached for the same prompt
 
         Returns:
             Dictionary containing the suggestions array.
         """
-        return await self.next_line_tool.execute(story_id, content, cursorPosition, chapter_id)
+        return await self.next_line_tool.execute(
+            story_id, content, cursorPosition, chapter_id,
+            prefix=prefix,
+            suffix=suffix,
+            base_hash=base_hash,
+            edits=edits,
+            content_hash=content_hash,
+            regenerate=regenerate,
+        )
+
+    async def prefetch_context(self, story_id: str, chapter_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Warm the caches and provider connection used by next line suggestions for a chapter.
+
+        Args:
+            story_id: Firestore story document ID
+            chapter_id: Optional chapter document ID the author opened
+
+        Returns:
+            Dictionary with the parts that were warmed and the time taken
+        """
+        return await self.next_line_tool.prefetch(story_id, chapter_id)
 
-        
     async def generate_story(
         self,
         story_id: str,
         genre: Optional[str] = None,
         tone: Optional[str] = None,
         length: Optional[str] = None,
+        mode: Optional[str] = None,
+        chapter_count: Optional[int] = None,
+        run_id: Optional[str] = None,
+        restart: bool = False,
+        on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
     ) -> Dict[str, Any]:
         """
         Generate a complete story.
@@ -96,17 +183,31 @@ class StoryAgent:
             genre: Story genre
             tone: Story tone
             length: Story length
+            mode: Optional generation mode ("single" or "chapters")
+            chapter_count: Optional number of chapters (chapters mode)
+            run_id: Optional checkpoint ID to resume (chapters mode)
+            restart: Discard existing checkpoints (chapters mode)
+            on_progress: Optional callback receiving progress events
 
         Returns:
             Generated story content
         """
-        return await self.story_tool.execute(story_id, genre, tone, length)
+        return await self.story_tool.execute(
+            story_id, genre, tone, length,
+            mode=mode,
+            chapter_count=chapter_count,
+            run_id=run_id,
+            restart=restart,
+            on_progress=on_progress,
+        )
 
     async def generate_chapter(
         self,
         story_id: str,
         chapter_number: int,
         previous_chapters: Optional[list] = None,
+        mode: Optional[str] = None,
+        on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
     ) -> Dict[str, Any]:
         """
         Generate a chapter.
@@ -115,11 +216,15 @@ class StoryAgent:
             story_id: Firestore story document ID
             chapter_number: Chapter number to generate
             previous_chapters: Optional list of previous chapters
+            mode: Optional generation mode ("single" or "scenes")
+            on_progress: Optional callback receiving progress events
 
         Returns:
             Generated chapter content
         """
-        return await self.chapter_tool.execute(story_id, chapter_number, previous_chapters)
+        return await self.chapter_tool.execute(
+            story_id, chapter_number, previous_chapters, mode=mode, on_progress=on_progress
+        )
 
     async def brainstorm_ideas(
         self,
@@ -182,29 +287,92 @@ class StoryAgent:
         self,
         action: str,
         parameters: Dict[str, Any],
+        timeout: Optional[float] = None,
+        on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
     ) -> Dict[str, Any]:
         """
         Execute agent action dynamically.
 
+        Concurrent calls with the same action, parameters and story version are
+        deduplicated: the duplicates await the in-flight result instead of
+        starting new work. A call made after the story changed does not join
+        one started before.
+
+        Token usage of the provider calls is attributed to the action and story
+        (see usage.py); a deduplicated call's usage goes to every caller that
+        shares it.
+
         Args:
             action: Action to perform (generateStory/generateChapter/brainstorm/etc.)
             parameters: Parameters for the action
+            timeout: Optional time budget in seconds; Firestore and LLM calls made
+                for this action are cut short when it runs out
+            on_progress: Optional callback receiving progress events from long-running
+                actions. Calls with a callback are not deduplicated, since only the
+                first caller would see the progress. Neither are calls with
+                "regenerate" set, which ask for a result other than the current one.
 
         Returns:
             Result from the agent execution
+
+        Raises:
+            DeadlineExceeded: If the time budget runs out before a stage can start
+        """
+        with deadline_scope(timeout), usage_scope(action, parameters.get("storyId")):
+            check_deadline(action)
+            if on_progress is not None or parameters.get("regenerate"):
+                return await self._dispatch(action, parameters, on_progress)
+            key = canonical_key(action, parameters, await self._story_version(parameters.get("storyId")))
+            if self._single_flight.is_in_flight(key):
+                logger.info(f"Joining in-flight {action} request")
+                print(f"[AGENT] Joining in-flight {action} request")
+            return await self._single_flight.do(key, lambda: self._dispatch(action, parameters))
+
+    async def _story_version(self, story_id: Any) -> Optional[str]:
+        """
+        Version of the story an action works on, for the deduplication key.
+
+        Comes from the story context, which the action builds anyway and which is
+        cached (STORY_CONTEXT_CACHE_TTL) or revalidated with name-only reads.
+        None when there is no story or it cannot be read; the action itself
+        then reports the error.
         """
+        if not isinstance(story_id, str) or not story_id:
+            return None
+        try:
+            context = await asyncio.to_thread(self._context_builder.build_story_context, story_id)
+        except DeadlineExceeded:
+            raise
+        except Exception:
+            return None
+        return context.version
+
+    async def _dispatch(
+        self,
+        action: str,
+        parameters: Dict[str, Any],
+        on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+    ) -> Dict[str, Any]:
+        """Route an action to the matching tool."""
         if action == "generateStory":
             return await self.generate_story(
                 parameters.get("storyId"),
                 parameters.get("genre"),
                 parameters.get("tone"),
                 parameters.get("length"),
+                mode=parameters.get("mode"),
+                chapter_count=parameters.get("chapterCount"),
+                run_id=parameters.get("runId"),
+                restart=bool(parameters.get("restart", False)),
+                on_progress=on_progress,
             )
         elif action == "generateChapter":
             return await self.generate_chapter(
                 parameters.get("storyId"),
                 parameters.get("chapterNumber"),
                 parameters.get("previousChapters"),
+                mode=parameters.get("mode"),
+                on_progress=on_progress,
             )
         elif action == "brainstormIdeas":
             return await self.brainstorm_ideas(
@@ -225,12 +393,10 @@ class StoryAgent:
                 parameters.get("plotType", "conflict"),
             )
         elif action == "generateNextLines":
-            import logging
-            logger = logging.getLogger(__name__)
             story_id = parameters.get('storyId')
             cursor_pos = parameters.get('cursorPosition')
             has_chapter_id = bool(parameters.get('chapterId'))
-            content_length = len(parameters.get('content', ''))
+            content_length = len(parameters.get('content') or '')
             
             logger.info(f"generateNextLines called with storyId={story_id}, cursorPosition={cursor_pos}, content_length={content_length}, hasChapterId={has_chapter_id}")
             print(f"[AGENT] generateNextLines called: storyId={story_id}, cursorPosition={cursor_pos}, content_length={content_length}, hasChapterId={has_chapter_id}")
@@ -240,12 +406,23 @@ class StoryAgent:
                 parameters.get("content"),
                 parameters.get("cursorPosition"),
                 parameters.get("chapterId"),  # Optional
+                prefix=parameters.get("prefix"),
+                suffix=parameters.get("suffix"),
+                base_hash=parameters.get("baseHash"),
+                edits=parameters.get("edits"),
+                content_hash=parameters.get("contentHash"),
+                regenerate=bool(parameters.get("regenerate")),
             )
             
             result_info = f"result keys: {list(result.keys())}" if isinstance(result, dict) else f"result type: {type(result)}"
             logger.info(f"generateNextLines completed, {result_info}")
             print(f"[AGENT] generateNextLines completed, {result_info}")
             return result
+        elif action == "prefetchContext":
+            return await self.prefetch_context(
+                parameters.get("storyId"),
+                parameters.get("chapterId"),
+            )
         else:
             raise ValueError(f"Unknown action: {action}")
 
@@ -0,0 +1,237 @@
+"""Offline batch runs of agent actions over many stories (see run-batch.py)."""
+import asyncio
+import json
+import multiprocessing
+import os
+import queue
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+# Handle imports for both direct execution and module import
+try:
+    from .agent import StoryAgent
+    from .context_builder import get_firestore_client, preload_story_contexts
+    from .response_encoding import encode_json
+    from .story_context import StoryContext
+except ImportError:
+    # Add parent directory to path for direct execution
+    current_dir = Path(__file__).parent
+    parent_dir = current_dir.parent.parent
+    if str(parent_dir) not in sys.path:
+        sys.path.insert(0, str(parent_dir))
+    from agents.storyAgent.agent import StoryAgent
+    from agents.storyAgent.context_builder import get_firestore_client, preload_story_contexts
+    from agents.storyAgent.response_encoding import encode_json
+    from agents.storyAgent.story_context import StoryContext
+
+# Concurrent agent calls per worker process
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+# Seconds between throughput reports
+BATCH_REPORT_INTERVAL = float(os.getenv("BATCH_REPORT_INTERVAL", "10"))
+
+# Story ID with its preloaded context (None when the context is read from Firestore)
+StoryItem = Tuple[str, Optional[StoryContext]]
+
+
+def _documents(collection: Optional[Dict[str, Dict[str, Any]]]) -> List[Dict[str, Any]]:
+    """Subcollection of an export ({document ID: data}) as documents with "id"."""
+    return [{**data, "id": doc_id} for doc_id, data in (collection or {}).items()]
+
+
+def load_export(path: str) -> Dict[str, StoryContext]:
+    """
+    Load a dataset written by functions/src/export-prod-data.ts (EXPORT_FILE).
+
+    Args:
+        path: JSON file shaped {"stories": {story ID: {...story, "__chapters": {...}, ...}}}
+
+    Returns:
+        Story contexts keyed by story ID
+    """
+    with open(path, "r", encoding="utf-8") as export_file:
+        stories = json.load(export_file).get("stories", {})
+
+    contexts = {}
+    for story_id, data in stories.items():
+        story = {key: value for key, value in data.items() if not key.startswith("__")}
+        story["id"] = story_id
+        contexts[story_id] = StoryContext.from_documents(
+            story,
+            _documents(data.get("__characters")),
+            _documents(data.get("__places")),
+            _documents(data.get("__plots")),
+            _documents(data.get("__chapters")),
+        )
+    return contexts
+
+
+def list_firestore_stories(project_id: Optional[str] = None) -> List[str]:
+    """IDs of every story in Firestore (the emulator when FIRESTORE_EMULATOR_HOST is set)."""
+    return [doc.id for doc in get_firestore_client(project_id).collection("stories").list_documents()]
+
+
+def completed_stories(output_path: str, include_failed: bool = False) -> Set[str]:
+    """
+    Story IDs already recorded in an output file, used to resume an interrupted run.
+
+    Args:
+        output_path: JSONL file written by run_batch
+        include_failed: Also count stories whose last result was a failure
+
+    Returns:
+        Set of story IDs to skip
+    """
+    done: Set[str] = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, "r", encoding="utf-8") as output_file:
+        for line in output_file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # A line cut short by a crash; the story is simply run again
+                continue
+            if record.get("success") or include_failed:
+                done.add(record["storyId"])
+            else:
+                done.discard(record["storyId"])
+    return done
+
+
+async def _run_shard_async(
+    items: List[StoryItem],
+    action: str,
+    parameters: Dict[str, Any],
+    concurrency: int,
+    timeout: Optional[float],
+    results: Any,
+) -> None:
+    # Tools run LLM and Firestore calls in threads; give every concurrent call one
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=max(32, concurrency * 4)))
+    agent = StoryAgent()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run_story(story_id: str) -> None:
+        async with semaphore:
+            start = time.monotonic()
+            record: Dict[str, Any] = {"storyId": story_id, "action": action}
+            try:
+                data = await agent.execute_agent(action, {**parameters, "storyId": story_id}, timeout=timeout)
+                record.update(success=True, data=data, error=None)
+            except Exception as error:
+                record.update(success=False, data=None, error=str(error))
+            record["seconds"] = round(time.monotonic() - start, 3)
+            results.put(record)
+
+    await asyncio.gather(*(run_story(story_id) for story_id, _ in items))
+
+
+def run_shard(
+    items: List[StoryItem],
+    action: str,
+    parameters: Dict[str, Any],
+    concurrency: int,
+    timeout: Optional[float],
+    results: Any,
+) -> int:
+    """
+    Run one action for every story of a shard, in a worker process.
+
+    Args:
+        items: Stories of the shard
+        action: Agent action (as accepted by StoryAgent.execute_agent)
+        parameters: Action parameters; storyId is added per story
+        concurrency: Agent calls in flight at once
+        timeout: Deadline per story (seconds), or None
+        results: Queue receiving one record per story
+
+    Returns:
+        Number of stories run
+    """
+    preload_story_contexts({story_id: context for story_id, context in items if context is not None})
+    asyncio.run(_run_shard_async(items, action, parameters, concurrency, timeout, results))
+    return len(items)
+
+
+def run_batch(
+    items: List[StoryItem],
+    action: str,
+    parameters: Dict[str, Any],
+    output_path: str,
+    processes: int,
+    concurrency: int = BATCH_CONCURRENCY,
+    timeout: Optional[float] = None,
+) -> Dict[str, Any]:
+    """
+    Shard stories across a process pool and append one JSON line per story to output_path.
+
+    Every line is flushed as soon as its story finishes, so the output file is
+    also the checkpoint: pass completed_stories(output_path) to skip finished
+    stories on the next run.
+
+    Args:
+        items: Stories to run
+        action: Agent action
+        parameters: Action parameters shared by every story
+        output_path: JSONL file to append results to
+        processes: Worker processes
+        concurrency: Concurrent agent calls per process
+        timeout: Deadline per story (seconds), or None
+
+    Returns:
+        Summary with story counts, elapsed seconds and stories per minute
+    """
+    processes = max(1, min(processes, len(items)))
+    shards = [items[index::processes] for index in range(processes)]
+    total = len(items)
+    succeeded = failed = 0
+    start = time.monotonic()
+    last_report = start
+
+    def report() -> None:
+        elapsed = time.monotonic() - start
+        rate = (succeeded + failed) / elapsed * 60 if elapsed > 0 else 0.0
+        print(f"[BATCH] {succeeded + failed}/{total} stories, {failed} failed, {rate:.1f} stories/min")
+
+    print(f"[BATCH] Running {action} for {total} stories in {processes} processes x {concurrency} concurrent calls")
+    # Spawned workers start clean: no Firestore/gRPC state or threads inherited from this process
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager, open(output_path, "ab") as output_file:
+        results = manager.Queue()
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context) as pool:
+            futures = [
+                pool.submit(run_shard, shard, action, parameters, concurrency, timeout, results)
+                for shard in shards
+            ]
+            while True:
+                try:
+                    record = results.get(timeout=1.0)
+                except queue.Empty:
+                    if all(future.done() for future in futures) and results.empty():
+                        break
+                else:
+                    output_file.write(encode_json(record) + b"\n")
+                    output_file.flush()
+                    if record["success"]:
+                        succeeded += 1
+                    else:
+                        failed += 1
+                if time.monotonic() - last_report >= BATCH_REPORT_INTERVAL:
+                    last_report = time.monotonic()
+                    report()
+            for future in futures:
+                # Surface a worker that crashed outside the per-story error handling
+                future.result()
+
+    report()
+    elapsed = time.monotonic() - start
+    return {
+        "stories": total,
+        "succeeded": succeeded,
+        "failed": failed,
+        "seconds": round(elapsed, 1),
+        "storiesPerMinute": round(total / elapsed * 60, 1) if elapsed > 0 else None,
+    }
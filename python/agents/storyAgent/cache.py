@@ -0,0 +1,202 @@
+"""Cache backends for story contexts, suggestions and other warm state."""
+import os
+import pickle
+import sqlite3
+import tempfile
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Optional
+
+
+class CacheBackend(ABC):
+    """Abstract base class for cache backends.
+
+    Values are returned as stored; callers must treat cached values as read-only.
+    """
+
+    @abstractmethod
+    def get(self, key: str) -> Optional[Any]:
+        """
+        Look up a value.
+
+        Args:
+            key: Cache key
+
+        Returns:
+            The cached value, or None if missing or expired
+        """
+        pass
+
+    @abstractmethod
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        """
+        Store a value.
+
+        Args:
+            key: Cache key
+            value: Picklable value to store
+            ttl: Time to live in seconds
+        """
+        pass
+
+    @abstractmethod
+    def delete(self, key: str) -> None:
+        """Remove a value if present."""
+        pass
+
+
+class MemoryCache(CacheBackend):
+    """In-process LRU cache with per-entry expiry. Not shared between workers."""
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Any]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class SQLiteCache(CacheBackend):
+    """
+    Cache stored in a local SQLite file, shared by every worker process on the host.
+
+    Calls do disk I/O and may wait up to 5 s for another process's write lock:
+    callers on the event loop run them in a thread.
+    """
+
+    def __init__(self, path: str, max_entries: int = 4096):
+        self.path = path
+        self.max_entries = max_entries
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                "key TEXT PRIMARY KEY, value BLOB NOT NULL, expires_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS cache_expires_at ON cache (expires_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> Optional[Any]:
+        row = self._connect().execute(
+            "SELECT value FROM cache WHERE key = ? AND expires_at >= ?", (key, time.time())
+        ).fetchone()
+        if row is None:
+            return None
+        return pickle.loads(row[0])
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        conn = self._connect()
+        conn.execute(
+            "INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)",
+            (key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), time.time() + ttl),
+        )
+        # Keep the file bounded: drop expired rows, then the soonest-to-expire overflow
+        conn.execute("DELETE FROM cache WHERE expires_at < ?", (time.time(),))
+        conn.execute(
+            "DELETE FROM cache WHERE key IN ("
+            "SELECT key FROM cache ORDER BY expires_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_entries,),
+        )
+
+    def delete(self, key: str) -> None:
+        self._connect().execute("DELETE FROM cache WHERE key = ?", (key,))
+
+
+class RedisCache(CacheBackend):
+    """Cache stored in Redis (or any Redis-compatible server). Requires the redis package."""
+
+    def __init__(self, url: str, prefix: str = "storyAgent:"):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CACHE_BACKEND=redis requires the 'redis' package (pip install redis)")
+        self.prefix = prefix
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key: str) -> Optional[Any]:
+        data = self.client.get(self.prefix + key)
+        if data is None:
+            return None
+        return pickle.loads(data)
+
+    def set(self, key: str, value: Any, ttl: float) -> None:
+        self.client.set(
+            self.prefix + key,
+            pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL),
+            px=max(1, int(ttl * 1000)),
+        )
+
+    def delete(self, key: str) -> None:
+        self.client.delete(self.prefix + key)
+
+
+def create_cache() -> CacheBackend:
+    """
+    Factory function to create a cache backend based on environment variables.
+
+    Environment variables:
+    - CACHE_BACKEND: "memory" (default), "sqlite" (shared by local worker processes) or "redis"
+    - CACHE_PATH: SQLite file path (default: <tmpdir>/story-agent-cache.sqlite3)
+    - REDIS_URL: Redis connection URL (default: redis://localhost:6379/0)
+    - CACHE_MAX_ENTRIES: Maximum number of entries for memory/sqlite backends
+
+    Returns:
+        CacheBackend instance
+    """
+    backend = os.getenv("CACHE_BACKEND", "memory").lower()
+    max_entries = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+
+    if backend == "sqlite":
+        path = os.getenv("CACHE_PATH", os.path.join(tempfile.gettempdir(), "story-agent-cache.sqlite3"))
+        return SQLiteCache(path, max_entries=max_entries)
+    if backend == "redis":
+        return RedisCache(os.getenv("REDIS_URL", "redis://localhost:6379/0"))
+    if backend != "memory":
+        raise ValueError(f"Unknown CACHE_BACKEND: {backend}")
+    return MemoryCache(max_entries=max_entries)
+
+
+_cache: Optional[CacheBackend] = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> CacheBackend:
+    """Return the process-wide cache backend, creating it on first use."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = create_cache()
+    return _cache
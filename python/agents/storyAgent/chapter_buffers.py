@@ -0,0 +1,172 @@
+"""Server-side chapter text buffers for delta uploads from the editor."""
+import hashlib
+import os
+import re
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+# Handle imports for both direct execution and module import
+try:
+    from .cache import get_cache
+except ImportError:
+    # Add parent directory to path for direct execution
+    current_dir = Path(__file__).parent
+    parent_dir = current_dir.parent.parent
+    if str(parent_dir) not in sys.path:
+        sys.path.insert(0, str(parent_dir))
+    from agents.storyAgent.cache import get_cache
+
+# How long an idle chapter buffer is kept (seconds)
+CHAPTER_BUFFER_TTL = float(os.getenv("CHAPTER_BUFFER_TTL", "1800"))
+
+# Characters outside the Basic Multilingual Plane: one code point in Python, two UTF-16 code units in JavaScript
+_ASTRAL = re.compile("[\U00010000-\U0010FFFF]")
+
+
+class StaleChapterBufferError(ValueError):
+    """Raised when a delta cannot be applied because the server's buffer is missing or out of date."""
+
+
+def content_hash(content: str) -> str:
+    """Return the SHA-256 hex digest of chapter content (UTF-8)."""
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def _code_point_range(content: str, start: int, end: int) -> Tuple[int, int]:
+    """Convert a range of UTF-16 code units in content to Python string indexes."""
+    encoded = content.encode("utf-16-le") if _ASTRAL.search(content) else None
+    length = len(content) if encoded is None else len(encoded) // 2
+    if not 0 <= start <= end <= length:
+        raise StaleChapterBufferError(f"Edit range {start}-{end} is outside the chapter buffer")
+    if encoded is None:
+        return start, end
+    try:
+        return len(encoded[:2 * start].decode("utf-16-le")), len(encoded[:2 * end].decode("utf-16-le"))
+    except UnicodeDecodeError:
+        raise StaleChapterBufferError(f"Edit range {start}-{end} splits a character") from None
+
+
+def code_point_index(content: str, offset: int) -> int:
+    """
+    Python string index of a UTF-16 code unit offset (a JavaScript string index) into content.
+
+    Offsets outside the text are clamped to it; one inside a surrogate pair
+    moves to the start of that character.
+    """
+    offset = max(0, offset)
+    try:
+        return _code_point_range(content, offset, offset)[0]
+    except StaleChapterBufferError:
+        encoded = content.encode("utf-16-le")
+        return len(encoded[:2 * offset].decode("utf-16-le", errors="ignore"))
+
+
+def apply_edits(content: str, edits: List[Dict[str, Any]]) -> str:
+    """
+    Apply a list of text edits to content.
+
+    Each edit is {"start": int, "end": int, "text": str} and replaces the
+    text between start and end with text. Offsets are UTF-16 code units, i.e.
+    JavaScript string indexes, as the editor sends them; they differ from
+    Python string indexes after characters such as emoji. Edits are applied in
+    order, each against the result of the previous one.
+
+    Args:
+        content: Base content
+        edits: Edits to apply
+
+    Returns:
+        The edited content
+    """
+    for edit in edits:
+        try:
+            start = int(edit.get("start", 0))
+            end = int(edit.get("end", start))
+        except (AttributeError, TypeError, ValueError, OverflowError):
+            raise StaleChapterBufferError(f"Invalid edit: {edit!r}") from None
+        text = edit.get("text") or ""
+        if not isinstance(text, str):
+            raise StaleChapterBufferError(f"Invalid edit: {edit!r}")
+        start, end = _code_point_range(content, start, end)
+        content = content[:start] + text + content[end:]
+    return content
+
+
+class ChapterBufferStore:
+    """Keeps the latest known text of each chapter so the editor can send deltas instead of full content."""
+
+    def _key(self, story_id: str, chapter_id: str) -> str:
+        return f"chapter_buffer:{story_id}:{chapter_id}"
+
+    def get(self, story_id: str, chapter_id: str) -> Optional[Tuple[str, str]]:
+        """
+        Return the cached buffer for a chapter.
+
+        Returns:
+            Tuple of (content hash, content), or None if there is no buffer
+        """
+        entry = get_cache().get(self._key(story_id, chapter_id))
+        if entry is None:
+            return None
+        return entry["hash"], entry["content"]
+
+    def put(self, story_id: str, chapter_id: str, content: str) -> str:
+        """
+        Store the full content of a chapter.
+
+        Returns:
+            Hash of the stored content
+        """
+        digest = content_hash(content)
+        get_cache().set(
+            self._key(story_id, chapter_id),
+            {"hash": digest, "content": content},
+            CHAPTER_BUFFER_TTL,
+        )
+        return digest
+
+    def apply_delta(
+        self,
+        story_id: str,
+        chapter_id: str,
+        base_hash: str,
+        edits: List[Dict[str, Any]],
+        expected_hash: Optional[str] = None,
+    ) -> Tuple[str, str]:
+        """
+        Apply edits to a chapter buffer and store the result.
+
+        Args:
+            story_id: Firestore story document ID
+            chapter_id: Chapter document ID
+            base_hash: Hash of the content the edits were made against
+            edits: Edits to apply (see apply_edits)
+            expected_hash: Optional hash of the content after the edits, used to verify the result
+
+        Returns:
+            Tuple of (new content hash, new content)
+
+        Raises:
+            StaleChapterBufferError: If the buffer is missing, does not match base_hash,
+                or the result does not match expected_hash. The client should resend full content.
+        """
+        buffer = self.get(story_id, chapter_id)
+        if buffer is None:
+            raise StaleChapterBufferError(f"No buffer for chapter {chapter_id}")
+        current_hash, content = buffer
+        if current_hash != base_hash:
+            raise StaleChapterBufferError(f"Buffer for chapter {chapter_id} does not match baseHash")
+
+        content = apply_edits(content, edits)
+        digest = content_hash(content)
+        if expected_hash and digest != expected_hash:
+            raise StaleChapterBufferError(f"Edited buffer for chapter {chapter_id} does not match contentHash")
+
+        # Store even when unchanged to refresh the buffer's TTL
+        get_cache().set(
+            self._key(story_id, chapter_id),
+            {"hash": digest, "content": content},
+            CHAPTER_BUFFER_TTL,
+        )
+        return digest, content
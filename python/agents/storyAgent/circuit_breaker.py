@@ -0,0 +1,163 @@
+"""Circuit breakers that make LLM calls fail fast while a provider is degraded."""
+import os
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+# Handle imports for both direct execution and module import
+try:
+    from .metrics import metrics
+except ImportError:
+    # Add parent directory to path for direct execution
+    current_dir = Path(__file__).parent
+    parent_dir = current_dir.parent.parent
+    if str(parent_dir) not in sys.path:
+        sys.path.insert(0, str(parent_dir))
+    from agents.storyAgent.metrics import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# Consecutive failures (errors or latency SLO breaches) that open a circuit
+FAILURE_THRESHOLD = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+# Seconds an open circuit waits before letting a probe call through
+RECOVERY_TIMEOUT = float(os.getenv("CIRCUIT_RECOVERY_TIMEOUT", "30"))
+
+# Latency SLO per action class (seconds); slower calls count as failures
+LATENCY_SLOS = {
+    "interactive": float(os.getenv("CIRCUIT_SLO_INTERACTIVE", "10")),
+    "brainstorm": float(os.getenv("CIRCUIT_SLO_BRAINSTORM", "60")),
+    "long_form": float(os.getenv("CIRCUIT_SLO_LONG_FORM", "180")),
+}
+
+
+class CircuitOpenError(RuntimeError):
+    """Raised instead of calling a provider whose circuit is open."""
+
+
+class CircuitBreaker:
+    """
+    Tracks the health of one provider for one action class.
+
+    Closed: calls pass through. After failure_threshold consecutive failures the
+    circuit opens and calls fail immediately with CircuitOpenError. Once
+    recovery_timeout has passed, one probe call is let through (half-open): its
+    success closes the circuit, its failure re-opens it.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = FAILURE_THRESHOLD,
+        recovery_timeout: float = RECOVERY_TIMEOUT,
+        latency_slo: Optional[float] = None,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.latency_slo = latency_slo
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def before_call(self) -> None:
+        """
+        Check whether a call may proceed.
+
+        Raises:
+            CircuitOpenError: If the circuit is open, or half-open with a probe already running
+        """
+        with self._lock:
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.recovery_timeout:
+                self._set_state(HALF_OPEN)
+            if self.state == CLOSED:
+                return
+            if self.state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return
+
+        metrics.increment("circuit.rejections", circuit=self.name)
+        retry_in = max(0.0, self.recovery_timeout - (time.monotonic() - self.opened_at))
+        raise CircuitOpenError(f"Circuit {self.name} is {self.state}; failing fast (retry in {retry_in:.0f}s)")
+
+    def record_success(self, latency: float) -> None:
+        """Record a completed call; calls slower than the latency SLO count as failures."""
+        if self.latency_slo is not None and latency > self.latency_slo:
+            metrics.increment("circuit.slo_breaches", circuit=self.name)
+            self.record_failure()
+            return
+        with self._lock:
+            self._probe_in_flight = False
+            self.consecutive_failures = 0
+            if self.state != CLOSED:
+                self._set_state(CLOSED)
+
+    def release(self) -> None:
+        """Forget a call that ended without telling us anything about the provider."""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        """Record a failed call, opening the circuit if the threshold is reached."""
+        with self._lock:
+            self._probe_in_flight = False
+            self.consecutive_failures += 1
+            if self.state == HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+                if self.state != OPEN:
+                    metrics.increment("circuit.opened", circuit=self.name)
+                self._set_state(OPEN)
+
+    def _set_state(self, state: str) -> None:
+        """Change state and publish it as a gauge (0 closed, 1 half-open, 2 open). Caller holds the lock."""
+        self.state = state
+        metrics.set_gauge("circuit.state", _STATE_VALUES[state], circuit=self.name)
+
+    def status(self) -> Dict[str, Any]:
+        """Current state for /health and /metrics."""
+        with self._lock:
+            return {
+                "state": self.state,
+                "consecutiveFailures": self.consecutive_failures,
+                "latencySlo": self.latency_slo,
+            }
+
+
+class CircuitBreakerRegistry:
+    """One circuit breaker per (provider, action class)."""
+
+    def __init__(self):
+        self._breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, provider: str, action_class: str) -> CircuitBreaker:
+        """Return the breaker for a provider and action class, creating it on first use."""
+        key = (provider, action_class)
+        with self._lock:
+            breaker = self._breakers.get(key)
+            if breaker is None:
+                breaker = CircuitBreaker(f"{provider}/{action_class}", latency_slo=LATENCY_SLOS.get(action_class))
+                self._breakers[key] = breaker
+            return breaker
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """Status of every breaker, keyed by name."""
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {breaker.name: breaker.status() for breaker in breakers}
+
+    def any_open(self) -> bool:
+        """Whether any circuit is currently open."""
+        with self._lock:
+            return any(breaker.state == OPEN for breaker in self._breakers.values())
+
+
+# Process-wide registry
+circuit_breakers = CircuitBreakerRegistry()
@@ -1,29 +1,106 @@
 """Context builder for aggregating story context from Firestore."""
 import os
-from typing import Dict, List, Any, Optional
-from google.cloud import firestore
+import sys
+import threading
+from pathlib import Path
+from typing import Dict, Any, Optional
+
+# Handle imports for both direct execution and module import
+try:
+    from .cache import get_cache
+    from .context_snapshot import context_snapshot, story_version
+    from .deadline import stage_timeout
+    from .story_context import StoryContext
+    from .traffic_recorder import note_story
+except ImportError:
+    # Add parent directory to path for direct execution
+    current_dir = Path(__file__).parent
+    parent_dir = current_dir.parent.parent
+    if str(parent_dir) not in sys.path:
+        sys.path.insert(0, str(parent_dir))
+    from agents.storyAgent.cache import get_cache
+    from agents.storyAgent.context_snapshot import context_snapshot, story_version
+    from agents.storyAgent.deadline import stage_timeout
+    from agents.storyAgent.story_context import StoryContext
+    from agents.storyAgent.traffic_recorder import note_story
+
+# How long a built story context is served from cache (seconds, 0 disables)
+STORY_CONTEXT_CACHE_TTL = float(os.getenv("STORY_CONTEXT_CACHE_TTL", "30"))
+# Upper bound for a single Firestore read (seconds); shortened by the request deadline if one is set
+FIRESTORE_TIMEOUT = float(os.getenv("FIRESTORE_TIMEOUT", "30"))
+
+# Firestore clients shared by every builder, keyed by project ID.
+# google.cloud.firestore is imported lazily because it is the slowest import
+# in the service and is not needed to answer /health.
+_firestore_clients: Dict[Optional[str], Any] = {}
+_firestore_clients_lock = threading.Lock()
+
+# Subcollections of a story document, in the order they are versioned
+STORY_COLLECTIONS = ("characters", "places", "plots", "chapters")
+
+# Contexts loaded from an exported dataset (see batch_runner.py), served instead of Firestore
+_preloaded_contexts: Dict[str, StoryContext] = {}
+
+
+def get_firestore_client(project_id: Optional[str] = None):
+    """
+    Return the shared Firestore client for a project, creating it on first use.
+
+    Args:
+        project_id: GCP project ID (uses the default project if not provided)
+
+    Returns:
+        google.cloud.firestore.Client instance
+    """
+    client = _firestore_clients.get(project_id)
+    if client is not None:
+        return client
+
+    with _firestore_clients_lock:
+        client = _firestore_clients.get(project_id)
+        if client is None:
+            from google.cloud import firestore
+
+            # The Firestore client automatically uses the emulator when
+            # FIRESTORE_EMULATOR_HOST environment variable is set
+            if project_id:
+                client = firestore.Client(project=project_id)
+            else:
+                client = firestore.Client()
+            _firestore_clients[project_id] = client
+    return client
+
+
+def preload_story_contexts(contexts: Dict[str, StoryContext]) -> None:
+    """
+    Serve the given contexts without reading Firestore.
+
+    Used when running tools over an exported dataset rather than a live database.
+
+    Args:
+        contexts: Story contexts keyed by story ID
+    """
+    _preloaded_contexts.update(contexts)
+
+
+def preloaded_story_context(story_id: str) -> Optional[StoryContext]:
+    """The preloaded context of a story, or None if it is read from Firestore."""
+    return _preloaded_contexts.get(story_id)
 
 
 class StoryContextBuilder:
     """Builds comprehensive context from Firestore for story generation."""
 
     def __init__(self, project_id: Optional[str] = None):
-        """Initialize Firestore client."""
-        # Check if running with emulator
-        emulator_host = os.getenv("FIRESTORE_EMULATOR_HOST")
-        
-        if project_id:
-            self.db = firestore.Client(project=project_id)
-        else:
-            self.db = firestore.Client()
-        
-        # Configure emulator if FIRESTORE_EMULATOR_HOST is set
-        # The Firestore client automatically uses the emulator when 
-        # FIRESTORE_EMULATOR_HOST environment variable is set
-        if emulator_host:
-            os.environ["FIRESTORE_EMULATOR_HOST"] = emulator_host
-
-    def build_story_context(self, story_id: str) -> Dict[str, Any]:
+        """Initialize the builder. The Firestore client is created on first use."""
+        self.project_id = project_id
+
+    @property
+    def db(self):
+        """Shared Firestore client for this builder's project."""
+        return get_firestore_client(self.project_id)
+
+    def build_story_context(self, story_id: str) -> StoryContext:
         """
         Build complete context for a story from Firestore.
 
@@ -31,10 +108,38 @@ class StoryContextBuilder:
             story_id: The Firestore document ID of the story
 
         Returns:
-            Dictionary containing story data, characters, places, plots, and chapters
+            StoryContext with the story, characters, places, plots, and chapters
         """
+        context = self._load_story_context(story_id)
+        note_story(context)
+        return context
+
+    def _load_story_context(self, story_id: str) -> StoryContext:
+        """The preloaded context, else the cached one, else the snapshotted one if still current, else a fresh read."""
+        preloaded = _preloaded_contexts.get(story_id)
+        if preloaded is not None:
+            return preloaded
+        context_snapshot.touch(story_id)
+
+        # Versioned key: shared cache backends may still hold contexts pickled in an older layout
+        cache_key = f"story_context:v4:{story_id}"
+        if STORY_CONTEXT_CACHE_TTL > 0:
+            cached = get_cache().get(cache_key)
+            if cached is not None:
+                return cached
+
+        context = context_snapshot.restore(story_id, self._read_story_version)
+        if context is None:
+            context = self._fetch_story_context(story_id)
+
+        if STORY_CONTEXT_CACHE_TTL > 0:
+            get_cache().set(cache_key, context, STORY_CONTEXT_CACHE_TTL)
+        return context
+
+    def _fetch_story_context(self, story_id: str) -> StoryContext:
+        """Read the story document and its subcollections from Firestore."""
         story_ref = self.db.collection("stories").document(story_id)
-        story_doc = story_ref.get()
+        story_doc = story_ref.get(timeout=stage_timeout(FIRESTORE_TIMEOUT, "Firestore read"))
 
         if not story_doc.exists:
             raise ValueError(f"Story {story_id} not found")
@@ -42,100 +147,108 @@ class StoryContextBuilder:
         story_data = story_doc.to_dict()
         story_data["id"] = story_doc.id
 
-        # Fetch all subcollections in parallel
-        characters = self._fetch_collection(story_ref.collection("characters"))
-        places = self._fetch_collection(story_ref.collection("places"))
-        plots = self._fetch_collection(story_ref.collection("plots"))
-        chapters = self._fetch_collection(story_ref.collection("chapters"))
-
-        # Sort chapters by number if available
-        chapters.sort(key=lambda x: x.get("chapterNumber", 0))
-
-        return {
-            "story": story_data,
-            "characters": characters,
-            "places": places,
-            "plots": plots,
-            "chapters": chapters,
-        }
-
-    def _fetch_collection(self, collection_ref) -> List[Dict[str, Any]]:
-        """Fetch all documents from a collection."""
-        docs = collection_ref.stream()
-        return [{"id": doc.id, **doc.to_dict()} for doc in docs]
-
-    def format_context_for_prompt(self, context: Dict[str, Any]) -> str:
+        # Fetch all subcollections
+        collections = [
+            list(story_ref.collection(name).stream(timeout=stage_timeout(FIRESTORE_TIMEOUT, "Firestore read")))
+            for name in STORY_COLLECTIONS
+        ]
+        characters, places, plots, chapters = (
+            [{"id": doc.id, **doc.to_dict()} for doc in docs] for docs in collections
+        )
+
+        # Chapters are sorted by number while building the context
+        version = story_version(story_doc, collections)
+        context = StoryContext.from_documents(story_data, characters, places, plots, chapters, version)
+        context_snapshot.note_fetched(story_id, context, version)
+        return context
+
+    def _read_story_version(self, story_id: str) -> Optional[str]:
+        """
+        The story's current version (see context_snapshot.story_version), or None if it does not exist.
+
+        Reads the story document, and only the names and update times of its
+        subcollection documents, not their content.
+        """
+        story_ref = self.db.collection("stories").document(story_id)
+        story_doc = story_ref.get(timeout=stage_timeout(FIRESTORE_TIMEOUT, "Firestore read"))
+        if not story_doc.exists:
+            return None
+        collections = [
+            list(
+                story_ref.collection(name)
+                .select(["__name__"])
+                .stream(timeout=stage_timeout(FIRESTORE_TIMEOUT, "Firestore read"))
+            )
+            for name in STORY_COLLECTIONS
+        ]
+        return story_version(story_doc, collections)
+
+    def format_context_for_prompt(self, context: StoryContext) -> str:
         """
         Format context into a readable prompt string for the AI model.
 
         Args:
-            context: The context dictionary from build_story_context
+            context: The context from build_story_context
 
         Returns:
             Formatted string with all context information
         """
-        story = context.get("story", {})
-        characters = context.get("characters", [])
-        places = context.get("places", [])
-        plots = context.get("plots", [])
-        chapters = context.get("chapters", [])
-
+        story = context.story
         prompt_parts = []
 
         # Story metadata
         prompt_parts.append("=== STORY CONTEXT ===")
-        prompt_parts.append(f"Title: {story.get('title', 'Untitled')}")
-        prompt_parts.append(f"Genre: {story.get('genre', 'Not specified')}")
-        prompt_parts.append(f"Tone: {story.get('tone', 'Not specified')}")
-        if story.get("description"):
-            prompt_parts.append(f"Description: {story.get('description')}")
+        prompt_parts.append(f"Title: {story.title or 'Untitled'}")
+        prompt_parts.append(f"Genre: {story.genre or 'Not specified'}")
+        prompt_parts.append(f"Tone: {story.tone or 'Not specified'}")
+        if story.description:
+            prompt_parts.append(f"Description: {story.description}")
 
         # Characters
-        if characters:
+        if context.characters:
             prompt_parts.append("\n=== CHARACTERS ===")
-            for char in characters:
-                char_info = f"- {char.get('name', 'Unnamed')}"
-                if char.get("role"):
-                    char_info += f" (Role: {char.get('role')})"
-                if char.get("backstory"):
-                    char_info += f"\n  Backstory: {char.get('backstory')}"
-                if char.get("traits"):
-                    char_info += f"\n  Traits: {char.get('traits')}"
-                if char.get("motivations"):
-                    char_info += f"\n  Motivations: {char.get('motivations')}"
+            for char in context.characters:
+                char_info = f"- {char.name or 'Unnamed'}"
+                if char.role:
+                    char_info += f" (Role: {char.role})"
+                if char.backstory:
+                    char_info += f"\n  Backstory: {char.backstory}"
+                if char.traits:
+                    char_info += f"\n  Traits: {char.traits}"
+                if char.motivations:
+                    char_info += f"\n  Motivations: {char.motivations}"
                 prompt_parts.append(char_info)
 
         # Places
-        if places:
+        if context.places:
             prompt_parts.append("\n=== PLACES ===")
-            for place in places:
-                place_info = f"- {place.get('name', 'Unnamed')}"
-                if place.get("description"):
-                    place_info += f": {place.get('description')}"
-                if place.get("atmosphere"):
-                    place_info += f"\n  Atmosphere: {place.get('atmosphere')}"
+            for place in context.places:
+                place_info = f"- {place.name or 'Unnamed'}"
+                if place.description:
+                    place_info += f": {place.description}"
+                if place.atmosphere:
+                    place_info += f"\n  Atmosphere: {place.atmosphere}"
                 prompt_parts.append(place_info)
 
         # Plots
-        if plots:
+        if context.plots:
             prompt_parts.append("\n=== PLOTS ===")
-            for plot in plots:
-                plot_info = f"- {plot.get('title', 'Untitled Plot')}"
-                if plot.get("description"):
-                    plot_info += f": {plot.get('description')}"
-                if plot.get("type"):
-                    plot_info += f"\n  Type: {plot.get('type')}"
+            for plot in context.plots:
+                plot_info = f"- {plot.title or 'Untitled Plot'}"
+                if plot.description:
+                    plot_info += f": {plot.description}"
+                if plot.type:
+                    plot_info += f"\n  Type: {plot.type}"
                 prompt_parts.append(plot_info)
 
         # Existing chapters summary
+        chapters = context.chapters
         if chapters:
             prompt_parts.append(f"\n=== EXISTING CHAPTERS ({len(chapters)} total) ===")
             for chapter in chapters[:5]:  # Show first 5 chapters
-                chapter_num = chapter.get("chapterNumber", "?")
-                title = chapter.get("title", "Untitled")
-                prompt_parts.append(f"Chapter {chapter_num}: {title}")
+                chapter_num = chapter.number if chapter.number is not None else "?"
+                prompt_parts.append(f"Chapter {chapter_num}: {chapter.title or 'Untitled'}")
             if len(chapters) > 5:
                 prompt_parts.append(f"... and {len(chapters) - 5} more chapters")
 
         return "\n".join(prompt_parts)
-
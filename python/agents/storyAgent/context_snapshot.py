@@ -0,0 +1,322 @@
+"""On-disk snapshot of the hottest story contexts, so a restarted instance starts warm."""
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import mmap
+import os
+import pickle
+import struct
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+# Handle imports for both direct execution and module import
+try:
+    from .metrics import metrics
+    from .story_context import StoryContext
+except ImportError:
+    # Add parent directory to path for direct execution
+    current_dir = Path(__file__).parent
+    parent_dir = current_dir.parent.parent
+    if str(parent_dir) not in sys.path:
+        sys.path.insert(0, str(parent_dir))
+    from agents.storyAgent.metrics import metrics
+    from agents.storyAgent.story_context import StoryContext
+
+logger = logging.getLogger(__name__)
+
+# File the snapshot is written to and restored from (unset: snapshots disabled)
+CONTEXT_SNAPSHOT_PATH = os.getenv("CONTEXT_SNAPSHOT_PATH", "")
+# Seconds between snapshots while serving (one is also written on shutdown)
+CONTEXT_SNAPSHOT_INTERVAL = float(os.getenv("CONTEXT_SNAPSHOT_INTERVAL", "300"))
+# Most-requested stories kept in the snapshot
+CONTEXT_SNAPSHOT_MAX_STORIES = int(os.getenv("CONTEXT_SNAPSHOT_MAX_STORIES", "200"))
+
+# File layout: magic, index length, JSON index, then one pickled record per story.
+# The index gives each record's offset and length in the data section, so a
+# record is only decoded when its story is first requested.
+_MAGIC = b"STORYCTX"
+_HEADER = struct.Struct("<8sQ")
+_FORMAT_VERSION = 3
+
+# (formatted story context, previous chapters text), as built by the next line tool
+PromptBlock = Tuple[str, str]
+
+
+def story_version(story_doc: Any, collections: Iterable[Iterable[Any]]) -> str:
+    """
+    Fingerprint of a story's documents: changes whenever any of them is written, added or deleted.
+
+    Args:
+        story_doc: Snapshot of the story document
+        collections: Snapshots of the documents of each subcollection, in a fixed order;
+            only their IDs and update times are used, so name-only queries suffice
+
+    Returns:
+        Hex digest over the update times of every document
+    """
+    digest = hashlib.sha1(f"{story_doc.id}@{_update_time(story_doc)}".encode("utf-8"))
+    for documents in collections:
+        stamps = sorted(f"{doc.id}@{_update_time(doc)}" for doc in documents)
+        digest.update(("|" + ",".join(stamps)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _update_time(doc: Any) -> str:
+    update_time = getattr(doc, "update_time", None)
+    return update_time.isoformat() if update_time is not None else ""
+
+
+class ContextSnapshot:
+    """
+    Keeps the contexts of the most-requested stories and writes them to disk.
+
+    Every story context built from Firestore is kept with its version (see
+    story_version) along with the prompt blocks built from it, and stories are
+    ranked by how often they are requested. save() writes the top
+    max_stories to one file; load() maps that file into memory on startup and
+    reads only its index. The first request for a snapshotted story checks the
+    story's version against Firestore with name-only queries, which skip the
+    chapter text that dominates a full read: if nothing changed, the snapshotted
+    context and prompt blocks are used, otherwise the story is read in full as
+    usual. Either way the snapshot entry is then consumed.
+    """
+
+    def __init__(self, path: str = CONTEXT_SNAPSHOT_PATH, max_stories: int = CONTEXT_SNAPSHOT_MAX_STORIES):
+        self.path = path
+        self.max_stories = max_stories
+        self._hits: Counter = Counter()
+        # story_id -> (version, context) for contexts read or restored in this process
+        self._contexts: Dict[str, Tuple[str, StoryContext]] = {}
+        # story_id -> {chapter key: prompt block}, built from the context in _contexts
+        self._prompts: Dict[str, Dict[str, PromptBlock]] = {}
+        # Entries of the loaded snapshot not requested yet: story_id -> index entry
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._map: Optional[mmap.mmap] = None
+        self._data_start = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def touch(self, story_id: str) -> None:
+        """Count a request for a story's context."""
+        if self.enabled:
+            with self._lock:
+                self._hits[story_id] += 1
+
+    def note_fetched(self, story_id: str, context: StoryContext, version: str) -> None:
+        """Keep a context just read from Firestore, replacing any older one and its prompt blocks."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._contexts[story_id] = (version, context)
+            self._prompts.pop(story_id, None)
+            self._pending.pop(story_id, None)
+            if len(self._contexts) > 2 * self.max_stories:
+                self._trim()
+
+    def note_prompt(self, story_id: str, chapter_id: Optional[str], block: PromptBlock, context: StoryContext) -> None:
+        """Keep a prompt block built from a story's context."""
+        if not self.enabled:
+            return
+        with self._lock:
+            held = self._contexts.get(story_id)
+            # Only blocks built from the context that will be snapshotted with them
+            if held is not None and held[1] is context:
+                self._prompts.setdefault(story_id, {})[chapter_id or ""] = block
+
+    def prompt_block(self, story_id: str, chapter_id: Optional[str], context: StoryContext) -> Optional[PromptBlock]:
+        """A kept prompt block for a chapter, if it was built from this very context."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            held = self._contexts.get(story_id)
+            if held is None or held[1] is not context:
+                return None
+            return self._prompts.get(story_id, {}).get(chapter_id or "")
+
+    def restore(self, story_id: str, read_version: Callable[[str], Optional[str]]) -> Optional[StoryContext]:
+        """
+        The snapshotted context of a story, if its documents have not changed since.
+
+        Args:
+            story_id: Firestore story document ID
+            read_version: Returns the story's current version, or None if it no longer exists
+
+        Returns:
+            The restored context, or None if the story is not in the snapshot or changed
+        """
+        with self._lock:
+            entry = self._pending.pop(story_id, None)
+            mapped = self._map
+        if entry is None or mapped is None:
+            return None
+
+        if read_version(story_id) != entry["version"]:
+            metrics.increment("context_snapshot.restored", result="stale")
+            return None
+        start = self._data_start + entry["offset"]
+        try:
+            record = pickle.loads(mapped[start:start + entry["length"]])
+        except Exception as e:
+            # Written by a different version of the story context classes
+            logger.warning(f"Could not restore story {story_id} from snapshot: {e}")
+            metrics.increment("context_snapshot.restored", result="unreadable")
+            return None
+        with self._lock:
+            # A full read that finished meanwhile is at least as new
+            if story_id not in self._contexts:
+                self._contexts[story_id] = (entry["version"], record["context"])
+                self._prompts[story_id] = record["prompts"]
+        metrics.increment("context_snapshot.restored", result="hit")
+        return record["context"]
+
+    def _trim(self) -> None:
+        """Drop the least-requested contexts beyond max_stories. Caller holds the lock."""
+        ranked = sorted(self._contexts, key=lambda story_id: self._hits[story_id], reverse=True)
+        for story_id in ranked[self.max_stories:]:
+            self._contexts.pop(story_id, None)
+            self._prompts.pop(story_id, None)
+
+    def load(self) -> int:
+        """
+        Map the snapshot file and read its index; records are decoded on first request.
+
+        Returns:
+            Number of stories in the snapshot (0 if there is none or it is unreadable)
+        """
+        if not self.enabled or not os.path.exists(self.path):
+            return 0
+        try:
+            with open(self.path, "rb") as snapshot_file:
+                mapped = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, index_length = _HEADER.unpack_from(mapped, 0)
+            if magic != _MAGIC:
+                raise ValueError("not a story context snapshot")
+            index = json.loads(mapped[_HEADER.size:_HEADER.size + index_length])
+            if index.get("format") != _FORMAT_VERSION:
+                raise ValueError(f"unsupported format {index.get('format')}")
+        except (OSError, ValueError, struct.error) as e:
+            logger.warning(f"Ignoring context snapshot {self.path}: {e}")
+            print(f"[SNAPSHOT] Ignoring context snapshot {self.path}: {e}")
+            return 0
+
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+            self._map = mapped
+            self._data_start = _HEADER.size + index_length
+            self._pending = index["stories"]
+            for story_id, entry in self._pending.items():
+                self._hits[story_id] += entry["hits"]
+        age = time.time() - index["savedAt"]
+        logger.info(f"Loaded context snapshot with {len(self._pending)} stories, {age:.0f}s old")
+        print(f"[SNAPSHOT] Loaded context snapshot with {len(self._pending)} stories, {age:.0f}s old")
+        return len(self._pending)
+
+    def save(self) -> int:
+        """
+        Write the most-requested stories' contexts and prompt blocks to the snapshot file.
+
+        Snapshotted stories not requested since the last load are carried over
+        as they are. The file is replaced atomically, so concurrent saves from
+        several workers never leave a mixed file, and request counts are
+        halved afterwards so the ranking follows recent traffic.
+
+        Returns:
+            Number of stories written
+        """
+        if not self.enabled:
+            return 0
+        start = time.monotonic()
+        with self._lock:
+            candidates = [story_id for story_id in self._contexts if story_id not in self._pending]
+            candidates += list(self._pending)
+            candidates.sort(key=lambda story_id: self._hits[story_id], reverse=True)
+            chosen = candidates[:self.max_stories]
+            held = {story_id: self._contexts[story_id] for story_id in chosen if story_id in self._contexts}
+            prompts = {story_id: dict(self._prompts.get(story_id, {})) for story_id in held}
+            pending = {story_id: self._pending[story_id] for story_id in chosen if story_id not in held}
+            hits = {story_id: self._hits[story_id] for story_id in chosen}
+            mapped, data_start = self._map, self._data_start
+
+        index: Dict[str, Dict[str, Any]] = {}
+        records = []
+        offset = 0
+        for story_id in chosen:
+            if story_id in held:
+                version, context = held[story_id]
+                record = pickle.dumps({"context": context, "prompts": prompts[story_id]}, pickle.HIGHEST_PROTOCOL)
+            else:
+                version = pending[story_id]["version"]
+                source = data_start + pending[story_id]["offset"]
+                record = mapped[source:source + pending[story_id]["length"]]
+            index[story_id] = {"version": version, "hits": hits[story_id], "offset": offset, "length": len(record)}
+            records.append(record)
+            offset += len(record)
+
+        header = json.dumps({"format": _FORMAT_VERSION, "savedAt": time.time(), "stories": index}).encode("utf-8")
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        # A temp file of its own per save: with WORKERS > 1 every worker saves to the same path,
+        # and the last complete file to be renamed wins
+        descriptor, temp_path = tempfile.mkstemp(prefix=f"{os.path.basename(self.path)}.", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(descriptor, "wb") as snapshot_file:
+                snapshot_file.write(_HEADER.pack(_MAGIC, len(header)))
+                snapshot_file.write(header)
+                for record in records:
+                    snapshot_file.write(record)
+            # The loaded map keeps the old file's data readable after the rename
+            os.replace(temp_path, self.path)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(temp_path)
+            raise
+
+        with self._lock:
+            for story_id in list(self._hits):
+                self._hits[story_id] //= 2
+                if not self._hits[story_id] and story_id not in self._contexts and story_id not in self._pending:
+                    del self._hits[story_id]
+        seconds = time.monotonic() - start
+        metrics.observe("context_snapshot.save_seconds", seconds)
+        metrics.set_gauge("context_snapshot.bytes", _HEADER.size + len(header) + offset)
+        logger.info(f"Saved context snapshot with {len(index)} stories in {seconds:.3f}s")
+        print(f"[SNAPSHOT] Saved context snapshot with {len(index)} stories in {seconds:.3f}s")
+        return len(index)
+
+    async def run(self, interval: float = CONTEXT_SNAPSHOT_INTERVAL) -> None:
+        """Save every interval seconds; run as a task while serving."""
+        while True:
+            await asyncio.sleep(interval)
+            await self.save_in_thread()
+
+    async def save_in_thread(self) -> None:
+        """save() off the event loop, logging instead of raising if the file cannot be written."""
+        try:
+            await asyncio.to_thread(self.save)
+        except OSError as e:
+            logger.warning(f"Failed to save context snapshot: {e}")
+            print(f"[SNAPSHOT] Failed to save context snapshot: {e}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Snapshot state for /metrics."""
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "contexts": len(self._contexts),
+                "pendingRestore": len(self._pending),
+            }
+
+
+# Process-wide snapshot
+context_snapshot = ContextSnapshot()
@@ -0,0 +1,101 @@
+"""Request deadlines, carried from the HTTP layer to Firestore and LLM calls."""
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+
+# Absolute deadline (time.monotonic()) of the request being served, if the caller set one.
+# Context variables are copied into tasks and asyncio.to_thread calls, so every stage
+# of a request sees its deadline without threading it through each signature.
+_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """Raised when a request's deadline has passed before a stage could start."""
+
+
+@contextmanager
+def deadline_scope(timeout: Optional[float]) -> Iterator[None]:
+    """
+    Set the deadline for the enclosed code.
+
+    A nested scope can only shorten the current deadline, never extend it.
+
+    Args:
+        timeout: Seconds from now, or None to keep the current deadline
+    """
+    if timeout is None:
+        yield
+        return
+    deadline = time.monotonic() + timeout
+    current = _deadline.get()
+    if current is not None:
+        deadline = min(deadline, current)
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def current_deadline() -> Optional[float]:
+    """The current absolute deadline (time.monotonic()), or None if there is none."""
+    return _deadline.get()
+
+
+def set_deadline(deadline: Optional[float]) -> None:
+    """
+    Replace the current deadline, extending it if need be.
+
+    Unlike deadline_scope this is not undone on exit: it is meant to be run in
+    the copied context of a task (see SingleFlight), whose later stages then see
+    the new deadline.
+
+    Args:
+        deadline: Absolute deadline (time.monotonic()), or None for no deadline
+    """
+    _deadline.set(deadline)
+
+
+def remaining() -> Optional[float]:
+    """Seconds left before the current deadline, or None if there is no deadline."""
+    deadline = _deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def check_deadline(stage: str) -> None:
+    """
+    Raise if the current deadline has passed.
+
+    Args:
+        stage: Name of the stage about to start, used in the error message
+
+    Raises:
+        DeadlineExceeded: If no time is left
+    """
+    left = remaining()
+    if left is not None and left <= 0:
+        raise DeadlineExceeded(f"Deadline exceeded before {stage}")
+
+
+def stage_timeout(default: float, stage: str = "next stage") -> float:
+    """
+    Timeout for one stage: its default, capped by the time left before the deadline.
+
+    Args:
+        default: The stage's own timeout in seconds
+        stage: Name of the stage, used in the error message
+
+    Returns:
+        Timeout in seconds
+
+    Raises:
+        DeadlineExceeded: If no time is left
+    """
+    check_deadline(stage)
+    left = remaining()
+    if left is None:
+        return default
+    return min(default, left)
@@ -0,0 +1,269 @@
+"""Long-lived editor sessions that serve next-line suggestions over a WebSocket."""
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# Handle imports for both direct execution and module import
+try:
+    from .chapter_buffers import StaleChapterBufferError, apply_edits, code_point_index, content_hash
+    from .deadline import deadline_scope
+    from .metrics import metrics
+    from .ngram_suggester import NgramModel, ngram_models
+    from .scheduler import scheduler
+    from .tools.next_line_generation import NEXT_LINE_DEADLINE, NUMBER_OF_SUGGESTIONS, NextLineGenerationTool
+except ImportError:
+    # Add parent directory to path for direct execution
+    current_dir = Path(__file__).parent
+    parent_dir = current_dir.parent.parent
+    if str(parent_dir) not in sys.path:
+        sys.path.insert(0, str(parent_dir))
+    from agents.storyAgent.chapter_buffers import StaleChapterBufferError, apply_edits, code_point_index, content_hash
+    from agents.storyAgent.deadline import deadline_scope
+    from agents.storyAgent.metrics import metrics
+    from agents.storyAgent.ngram_suggester import NgramModel, ngram_models
+    from agents.storyAgent.scheduler import scheduler
+    from agents.storyAgent.tools.next_line_generation import (
+        NEXT_LINE_DEADLINE,
+        NUMBER_OF_SUGGESTIONS,
+        NextLineGenerationTool,
+    )
+
+# How long a session reuses its story context before reloading it (seconds)
+SESSION_CONTEXT_TTL = float(os.getenv("SESSION_CONTEXT_TTL", "300"))
+
+Send = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class EditorSession:
+    """
+    State of one editor connection, bound to a story and optionally a chapter.
+
+    The session loads the story context once and keeps the chapter text and
+    cursor up to date from the client's events, so a suggestion costs only the
+    LLM call. A new suggestion request, or any change to the text, cancels the
+    suggestion still being generated.
+
+    Client messages:
+        {"type": "content", "content": str, "cursorPosition"?: int}
+        {"type": "edits", "baseHash": str, "edits": [{"start", "end", "text"}], "contentHash"?: str, "cursorPosition"?: int}
+            (edit offsets and cursorPosition in UTF-16 code units, see chapter_buffers.apply_edits)
+        {"type": "cursor", "cursorPosition": int}
+        {"type": "suggest", "requestId"?: any, "cursorPosition"?: int}
+        {"type": "refresh"}  (reload the story context)
+
+    Server messages:
+        {"type": "ready", "storyId", "chapterId"}
+        {"type": "ack", "contentHash"}
+        {"type": "needsFullContent", "error"}
+        {"type": "instant", "requestId", "suggestions"}  (n-gram drafts, sent before the LLM answers)
+        {"type": "suggestion", "requestId", "index", "text"}
+        {"type": "done", "requestId", "suggestions"}
+        {"type": "error", "requestId"?, "error"}
+    """
+
+    def __init__(
+        self,
+        tool: NextLineGenerationTool,
+        story_id: str,
+        chapter_id: Optional[str],
+        send: Send,
+        tenant: Optional[str] = None,
+    ):
+        """
+        Initialize the session.
+
+        Args:
+            tool: Next line tool used to build prompts and generate suggestions
+            story_id: Firestore story document ID
+            chapter_id: Optional chapter document ID
+            send: Coroutine function that delivers a message to the client
+            tenant: Who the session's LLM calls are scheduled for (defaults to the story)
+        """
+        self.tool = tool
+        self.story_id = story_id
+        self.chapter_id = chapter_id
+        self.send = send
+        self.tenant = tenant or story_id
+        self.content = ""
+        self.content_hash = content_hash("")
+        self.cursor = 0
+        self._formatted_context = ""
+        self._previous_chapters_text = ""
+        self._context_loaded_at: Optional[float] = None
+        # (content hash, cursor) last fed to the story's n-gram model
+        self._ngram_key: Optional[Tuple[str, int]] = None
+        self._suggestion_task: Optional[asyncio.Task] = None
+
+    async def open(self) -> None:
+        """Load the story context and the last known chapter text, then tell the client the session is ready."""
+        await self._load_context()
+        if self.chapter_id:
+            buffer = await asyncio.to_thread(self.tool.chapter_buffers.get, self.story_id, self.chapter_id)
+            if buffer is not None:
+                self.content_hash, self.content = buffer
+                self.cursor = len(self.content)
+        await self.send({"type": "ready", "storyId": self.story_id, "chapterId": self.chapter_id})
+
+    async def close(self) -> None:
+        """
+        Cancel pending work and store the chapter text so HTTP delta uploads can continue from it.
+
+        Also hands the chapter in the story's n-gram model back to the Firestore sync.
+        """
+        self._cancel_suggestion()
+        if self.chapter_id and self.content:
+            await asyncio.to_thread(self.tool.chapter_buffers.put, self.story_id, self.chapter_id, self.content)
+        if self.chapter_id and self._ngram_key is not None:
+            model = ngram_models.peek(self.story_id)
+            if model is not None:
+                await asyncio.to_thread(self._release_live_text, model)
+
+
+    async def handle(self, message: Dict[str, Any]) -> None:
+        """
+        Process one message from the client.
+
+        Args:
+            message: Decoded JSON message
+        """
+        message_type = message.get("type")
+        cursor: Optional[int] = None
+        if "cursorPosition" in message:
+            try:
+                cursor = int(message["cursorPosition"])
+            except (TypeError, ValueError, OverflowError):
+                await self.send({
+                    "type": "error",
+                    "requestId": message.get("requestId"),
+                    "error": f"Invalid cursorPosition: {message['cursorPosition']!r}",
+                })
+                return
+            # The client counts UTF-16 code units; content and edits convert it against their new text
+            if message_type not in ("content", "edits"):
+                self.cursor = code_point_index(self.content, cursor)
+
+        if message_type == "content":
+            self._cancel_suggestion()
+            self._set_content(message.get("content") or "")
+            if cursor is not None:
+                self.cursor = code_point_index(self.content, cursor)
+            await self.send({"type": "ack", "contentHash": self.content_hash})
+        elif message_type == "edits":
+            self._cancel_suggestion()
+            await self._apply_edits(message, cursor)
+        elif message_type == "cursor":
+            self._cancel_suggestion()
+        elif message_type == "suggest":
+            self._cancel_suggestion()
+            self._suggestion_task = asyncio.create_task(self._suggest(message.get("requestId")))
+            self._suggestion_task.add_done_callback(self._suggestion_done)
+        elif message_type == "refresh":
+            await self._load_context(refresh=True)
+            await self.send({"type": "ready", "storyId": self.story_id, "chapterId": self.chapter_id})
+        else:
+            await self.send({"type": "error", "error": f"Unknown message type: {message_type}"})
+
+    def _set_content(self, content: str) -> None:
+        self.content = content
+        self.content_hash = content_hash(content)
+        self.cursor = min(self.cursor, len(content))
+
+    async def _apply_edits(self, message: Dict[str, Any], cursor: Optional[int] = None) -> None:
+        """Apply a delta to the session's copy of the chapter, or ask for the full text if it does not fit."""
+        try:
+            if message.get("baseHash") != self.content_hash:
+                raise StaleChapterBufferError("Session text does not match baseHash")
+            content = apply_edits(self.content, message.get("edits") or [])
+            digest = content_hash(content)
+            expected_hash = message.get("contentHash")
+            if expected_hash and digest != expected_hash:
+                raise StaleChapterBufferError("Edited session text does not match contentHash")
+        except StaleChapterBufferError as error:
+            metrics.increment("session.stale_edits")
+            await self.send({"type": "needsFullContent", "error": str(error)})
+            return
+        self.content = content
+        self.content_hash = digest
+        self.cursor = min(self.cursor, len(content)) if cursor is None else code_point_index(content, cursor)
+        await self.send({"type": "ack", "contentHash": digest})
+
+    async def _load_context(self, refresh: bool = False) -> None:
+        """Build the story-level prompt context and the story's n-gram model off the event loop."""
+        self._formatted_context, self._previous_chapters_text = await asyncio.to_thread(
+            self.tool.load_prompt_context, self.story_id, self.chapter_id, refresh
+        )
+        await asyncio.to_thread(self.tool.ngram_model, self.story_id)
+        self._context_loaded_at = time.monotonic()
+
+    async def _instant_suggestions(self, prefix_text: str) -> List[str]:
+        """N-gram continuations from the author's own text, including the live chapter."""
+        model = await asyncio.to_thread(self.tool.ngram_model, self.story_id)
+        if self.chapter_id and self._ngram_key != (self.content_hash, self.cursor):
+            # The live text is split at the cursor so the model cannot simply echo
+            # the text that already follows it
+            await asyncio.to_thread(self._feed_live_text, model)
+            self._ngram_key = (self.content_hash, self.cursor)
+        suggestions, _ = self.tool.repair_suggestions(model.suggest(prefix_text, NUMBER_OF_SUGGESTIONS))
+        return suggestions
+
+    def _feed_live_text(self, model: NgramModel) -> None:
+        model.update_source(self.chapter_id, self.content[:self.cursor], pinned=True)
+        model.update_source(f"{self.chapter_id}:after-cursor", self.content[self.cursor:], pinned=True)
+
+    def _release_live_text(self, model: NgramModel) -> None:
+        """Replace the split live text with the whole chapter, no longer pinned."""
+        model.remove_source(f"{self.chapter_id}:after-cursor")
+        model.unpin(self.chapter_id)
+        model.update_source(self.chapter_id, self.content)
+
+    def _suggestion_done(self, task: asyncio.Task) -> None:
+        """Log a suggestion that failed outside its own error handling, e.g. sending to a closed socket."""
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is not None:
+            metrics.increment("session.suggestion_errors")
+            print(f"[SESSION ERROR] Suggestion task failed for story {self.story_id}: {error!r}")
+
+    def _cancel_suggestion(self) -> None:
+        if self._suggestion_task is not None and not self._suggestion_task.done():
+            self._suggestion_task.cancel()
+            metrics.increment("session.cancelled_suggestions")
+        self._suggestion_task = None
+
+    async def _suggest(self, request_id: Any) -> None:
+        """Generate suggestions for the current cursor and push each one as soon as it is ready."""
+        start = time.monotonic()
+        suggestions = []
+        try:
+            with deadline_scope(NEXT_LINE_DEADLINE):
+                if self._context_loaded_at is None or start - self._context_loaded_at > SESSION_CONTEXT_TTL:
+                    await self._load_context(refresh=self._context_loaded_at is not None)
+                prefix_text, suffix_text = self.tool.slice_content(self.content, self.cursor)
+                instant = await self._instant_suggestions(prefix_text)
+                if instant:
+                    metrics.observe("session.instant_seconds", time.monotonic() - start)
+                    await self.send({"type": "instant", "requestId": request_id, "suggestions": instant})
+                async with scheduler.admit(self.tenant, "generateNextLines"):
+                    async for text in self.tool.stream_suggestions(
+                        self._formatted_context,
+                        prefix_text,
+                        suffix_text,
+                        self._previous_chapters_text,
+                        deadline=start + NEXT_LINE_DEADLINE,
+                    ):
+                        if not suggestions:
+                            metrics.observe("session.first_suggestion_seconds", time.monotonic() - start)
+                        await self.send({"type": "suggestion", "requestId": request_id, "index": len(suggestions), "text": text})
+                        suggestions.append(text)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            print(f"[SESSION ERROR] Suggestion failed for story {self.story_id}: {error}")
+            await self.send({"type": "error", "requestId": request_id, "error": str(error)})
+            return
+        metrics.observe("session.suggestion_seconds", time.monotonic() - start)
+        await self.send({"type": "done", "requestId": request_id, "suggestions": suggestions})
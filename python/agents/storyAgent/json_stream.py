@@ -0,0 +1,84 @@
+"""Incremental parser for JSON arrays streamed token by token from an LLM."""
+import json
+from typing import Any, List
+
+
+class JSONArrayStreamParser:
+    """
+    Parses the first top-level JSON array in a stream of text chunks.
+
+    Each array element is returned as soon as it is complete, so callers can act
+    on it (or stop the upstream generation) before the model finishes. Text before
+    the opening bracket (preamble, code fences) and after the closing bracket is
+    ignored. If the array sits inside an object (e.g. {"items": [...]}), the first
+    array found is used.
+    """
+
+    def __init__(self):
+        self.done = False
+        self._started = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._item: List[str] = []
+
+    def feed(self, chunk: str) -> List[Any]:
+        """
+        Consume a chunk of text.
+
+        Args:
+            chunk: Next piece of the model's output
+
+        Returns:
+            Array elements completed by this chunk, in order
+
+        Raises:
+            ValueError: If a completed element is not valid JSON
+        """
+        items: List[Any] = []
+        for char in chunk:
+            if self.done:
+                break
+
+            if not self._started:
+                if char == "[":
+                    self._started = True
+                continue
+
+            if self._in_string:
+                self._item.append(char)
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"':
+                self._in_string = True
+                self._item.append(char)
+            elif char in "[{":
+                self._depth += 1
+                self._item.append(char)
+            elif char in "]}" and self._depth > 0:
+                self._depth -= 1
+                self._item.append(char)
+            elif char == "," and self._depth == 0:
+                self._emit(items)
+            elif char == "]":
+                self._emit(items)
+                self.done = True
+            else:
+                self._item.append(char)
+        return items
+
+    def _emit(self, items: List[Any]) -> None:
+        """Parse the buffered element, if any, and append it to items."""
+        text = "".join(self._item).strip()
+        self._item = []
+        if text:
+            try:
+                items.append(json.loads(text))
+            except json.JSONDecodeError as e:
+                raise ValueError(f"Invalid JSON array element: {e}. Element text: {text[:200]}")
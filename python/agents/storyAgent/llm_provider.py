@@ -1,11 +1,37 @@
 """LLM provider abstraction for supporting multiple AI backends."""
+import asyncio
 import os
+import sys
 import json
-import re
+import time
 from abc import ABC, abstractmethod
-from typing import Optional, Dict, Any, List
+from pathlib import Path
+from typing import Optional, Dict, Any, List, AsyncIterator
 import httpx
 
+# Handle imports for both direct execution and module import
+try:
+    from .circuit_breaker import CircuitBreaker, circuit_breakers
+    from .deadline import DeadlineExceeded, check_deadline, stage_timeout
+    from .json_stream import JSONArrayStreamParser
+    from .metrics import metrics
+    from .usage import UsageRecord, record_usage
+except ImportError:
+    # Add parent directory to path for direct execution
+    current_dir = Path(__file__).parent
+    parent_dir = current_dir.parent.parent
+    if str(parent_dir) not in sys.path:
+        sys.path.insert(0, str(parent_dir))
+    from agents.storyAgent.circuit_breaker import CircuitBreaker, circuit_breakers
+    from agents.storyAgent.deadline import DeadlineExceeded, check_deadline, stage_timeout
+    from agents.storyAgent.json_stream import JSONArrayStreamParser
+    from agents.storyAgent.metrics import metrics
+    from agents.storyAgent.usage import UsageRecord, record_usage
+
+
+# Upper bound for a single LLM call (seconds); shortened by the request deadline if one is set
+REQUEST_TIMEOUT = 300.0
+
 
 class LLMProvider(ABC):
     """Abstract base class for LLM providers."""
@@ -43,6 +69,124 @@ class LLMProvider(ABC):
         """
         pass
 
+    async def stream_structured_content(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        response_schema: Dict[str, Any],
+    ) -> AsyncIterator[Any]:
+        """
+        Yield structured items as soon as each one is available.
+
+        Providers without streaming support yield the items of
+        generate_structured_content once it completes.
+
+        Args:
+            system_prompt: System-level instructions for the AI
+            user_prompt: User-level prompt with the actual task
+            response_schema: JSON schema defining the expected response structure
+
+        Yields:
+            Array items from the structured response
+        """
+        for item in await self.generate_structured_content(system_prompt, user_prompt, response_schema):
+            yield item
+
+    async def generate_candidates(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        count: int,
+        max_tokens: int = 64,
+        stop: Optional[List[str]] = None,
+    ) -> List[str]:
+        """
+        Generate several independent short completions for the same prompt.
+
+        The default implementation runs count generate_content calls concurrently
+        in worker threads. Failed candidates are dropped, so fewer than count
+        results may be returned.
+
+        Args:
+            system_prompt: System-level instructions for the AI
+            user_prompt: User-level prompt with the actual task
+            count: Number of candidates to generate
+            max_tokens: Maximum output tokens per candidate (ignored by the default implementation)
+            stop: Stop sequences ending each candidate (ignored by the default implementation)
+
+        Returns:
+            List of up to count candidate texts
+
+        Raises:
+            Exception: The first error, if every candidate failed
+        """
+        prompt = f"{system_prompt}\n\n{user_prompt}"
+        results = await asyncio.gather(
+            *(asyncio.to_thread(self.generate_content, prompt) for _ in range(count)),
+            return_exceptions=True,
+        )
+        return _collect_candidates(results)
+
+
+    async def warm_up(self) -> None:
+        """
+        Prepare the backend before the first request (e.g. load the model).
+
+        Called from server startup. The default implementation does nothing.
+        """
+        pass
+
+    async def keep_warm(self) -> None:
+        """
+        Keep the backend warm while the service is idle.
+
+        Runs as a background task for the lifetime of the server; the default
+        implementation returns immediately.
+        """
+        pass
+
+
+def _record_gemini_usage(result: Dict[str, Any], model: str, start: float) -> None:
+    """Record the usageMetadata of a Gemini response (all candidates together)."""
+    usage = result.get("usageMetadata") or {}
+    elapsed = time.monotonic() - start
+    record_usage(UsageRecord(
+        provider="google_ai_studio",
+        model=model,
+        input_tokens=usage.get("promptTokenCount"),
+        output_tokens=usage.get("candidatesTokenCount"),
+        time_to_first_token=None,
+        generation_seconds=elapsed,
+        total_seconds=elapsed,
+    ))
+
+
+def _record_ollama_usage(result: Dict[str, Any], model: str, start: float) -> None:
+    """Record the token counts and durations (reported in nanoseconds) of an Ollama response."""
+    elapsed = time.monotonic() - start
+    eval_duration = result.get("eval_duration")
+    first_token = None
+    if "prompt_eval_duration" in result:
+        first_token = (result.get("load_duration", 0) + result["prompt_eval_duration"]) / 1e9
+    record_usage(UsageRecord(
+        provider="ollama",
+        model=model,
+        input_tokens=result.get("prompt_eval_count"),
+        output_tokens=result.get("eval_count"),
+        time_to_first_token=first_token,
+        generation_seconds=eval_duration / 1e9 if eval_duration is not None else elapsed,
+        total_seconds=elapsed,
+    ))
+
+
+def _collect_candidates(results: List[Any]) -> List[str]:
+    """Keep successful candidate texts; raise the first error if none succeeded."""
+    candidates = [result for result in results if isinstance(result, str)]
+    errors = [result for result in results if isinstance(result, BaseException)]
+    if not candidates and errors:
+        raise errors[0]
+    return candidates
+
 
 class GoogleAIStudioProvider(LLMProvider):
     """Google AI Studio (Gemini) provider using REST API with API key."""
@@ -59,10 +203,38 @@ class GoogleAIStudioProvider(LLMProvider):
         self.api_key = api_key
         self.model_name = model_name
         self.base_url = "https://generativelanguage.googleapis.com/v1beta"
+        self._async_client: Optional[httpx.AsyncClient] = None
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        """Return the shared async HTTP client, creating it on first use."""
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(timeout=REQUEST_TIMEOUT)
+        return self._async_client
+
+    async def warm_up(self) -> None:
+        """
+        Open a pooled connection to the API so the first request skips the TLS handshake.
+
+        Fetches the model's metadata, which costs no quota. The round trip is
+        recorded as llm.warm_up_seconds.
+        """
+        start = time.monotonic()
+        try:
+            response = await self._get_async_client().get(
+                f"{self.base_url}/models/{self.model_name}",
+                params={"key": self.api_key},
+            )
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            metrics.increment("llm.warm_up_failures", provider="google_ai_studio")
+            print(f"[GOOGLE_AI_STUDIO_PROVIDER] Warm-up of {self.model_name} failed: {e!r}")
+            return
+        metrics.observe("llm.warm_up_seconds", time.monotonic() - start, provider="google_ai_studio", model=self.model_name)
 
     def generate_content(self, prompt: str) -> str:
         """Generate content using Google AI Studio API."""
         url = f"{self.base_url}/models/{self.model_name}:generateContent"
+        start = time.monotonic()
         
         try:
             response = httpx.post(
@@ -73,10 +245,11 @@ class GoogleAIStudioProvider(LLMProvider):
                     }]
                 },
                 params={"key": self.api_key},
-                timeout=300.0,
+                timeout=stage_timeout(REQUEST_TIMEOUT, "LLM call"),
             )
             response.raise_for_status()
             result = response.json()
+            _record_gemini_usage(result, self.model_name, start)
             
             # Extract text from response
             if "candidates" in result and len(result["candidates"]) > 0:
@@ -107,9 +280,11 @@ class GoogleAIStudioProvider(LLMProvider):
             f"{user_prompt}\n\n"
             "IMPORTANT: Output ONLY the JSON array."
         )
+        start = time.monotonic()
 
         try:
-            response = httpx.post(
+            # Async client: a structured call can take the whole LLM round trip, which must not block the loop
+            response = await self._get_async_client().post(
                 url,
                 json={
                     "contents": [{
@@ -121,11 +296,11 @@ class GoogleAIStudioProvider(LLMProvider):
                     }
                 },
                 params={"key": self.api_key},
-                timeout=300.0,
+                timeout=stage_timeout(REQUEST_TIMEOUT, "LLM call"),
             )
             response.raise_for_status()
             result = response.json()
-            
+            _record_gemini_usage(result, self.model_name, start)
             
             print(f"[GOOGLE_AI_STUDIO_PROVIDER] Google AI Studio API response: {result}")
             if "candidates" in result and result["candidates"]:
@@ -165,14 +340,74 @@ class GoogleAIStudioProvider(LLMProvider):
             
             return []
 
+        except DeadlineExceeded:
+            # Out of time is not the same as no output: let the caller report the timeout
+            raise
+        except httpx.TimeoutException as e:
+            # The request timeout is capped by the deadline, so this may be the deadline passing
+            check_deadline("the end of the LLM call")
+            print(f"[ERROR] API Call failed: {e!r}")
+            return []
         except Exception as e:
             print(f"[ERROR] API Call failed: {e}")
             return []
 
+    async def generate_candidates(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        count: int,
+        max_tokens: int = 64,
+        stop: Optional[List[str]] = None,
+    ) -> List[str]:
+        """Generate count candidates in a single request using Gemini's candidateCount."""
+        url = f"{self.base_url}/models/{self.model_name}:generateContent"
+        generation_config: Dict[str, Any] = {
+            "candidateCount": count,
+            "maxOutputTokens": max_tokens,
+        }
+        if stop:
+            generation_config["stopSequences"] = stop[:5]  # Gemini accepts at most 5
+        start = time.monotonic()
+
+        try:
+            response = await self._get_async_client().post(
+                url,
+                json={
+                    "contents": [{
+                        "parts": [{"text": f"{system_prompt}\n\n{user_prompt}"}]
+                    }],
+                    "generationConfig": generation_config,
+                },
+                params={"key": self.api_key},
+                timeout=stage_timeout(REQUEST_TIMEOUT, "LLM call"),
+            )
+            response.raise_for_status()
+            result = response.json()
+        except httpx.RequestError as e:
+            raise RuntimeError(f"Failed to connect to Google AI Studio API: {e}")
+        except httpx.HTTPStatusError as e:
+            raise RuntimeError(f"Google AI Studio API error: {e.response.status_code} - {e.response.text}")
+        _record_gemini_usage(result, self.model_name, start)
+
+        candidates = []
+        for candidate in result.get("candidates", []):
+            parts = candidate.get("content", {}).get("parts", [])
+            if parts and "text" in parts[0]:
+                candidates.append(parts[0]["text"])
+        return candidates
+
 class OllamaProvider(LLMProvider):
     """Ollama local LLM provider."""
 
-    def __init__(self, base_url: str = "http://localhost:11434", model_name: str = "llama3.2"):
+    def __init__(
+        self,
+        base_url: str = "http://localhost:11434",
+        model_name: str = "llama3.2",
+        structured_format: str = "schema",
+        keep_alive: str = "30m",
+        keep_warm_interval: float = 240.0,
+    ):
         """
         Initialize Ollama provider.
 
@@ -180,13 +415,31 @@ class OllamaProvider(LLMProvider):
             base_url: Ollama API base URL (default: http://localhost:11434)
             model_name: Model name to use (default: llama3.2)
                       Common models: llama3.2, mistral, phi3, gemma2, etc.
+            structured_format: How structured output is constrained:
+                      "schema" passes the JSON schema as Ollama's native `format` (Ollama 0.5+),
+                      "json" uses the older `format: "json"` mode, "none" relies on the prompt only
+            keep_alive: How long Ollama keeps the model loaded after a request (e.g. "30m", "-1" for forever)
+            keep_warm_interval: Seconds of idleness after which the model is pinged to keep it resident
+                      (0 disables pinging)
         """
         self.base_url = base_url.rstrip("/")
         self.model_name = model_name
         self.api_url = f"{self.base_url}/api/generate"
+        self.structured_format = structured_format
+        self.keep_alive = keep_alive
+        self.keep_warm_interval = keep_warm_interval
+        self._async_client: Optional[httpx.AsyncClient] = None
+        self._last_used = time.monotonic()
+
+    def _get_async_client(self) -> httpx.AsyncClient:
+        """Return the shared async HTTP client, creating it on first use."""
+        if self._async_client is None:
+            self._async_client = httpx.AsyncClient(timeout=REQUEST_TIMEOUT)
+        return self._async_client
 
     def generate_content(self, prompt: str) -> str:
         """Generate content using Ollama."""
+        self._last_used = start = time.monotonic()
         try:
             response = httpx.post(
                 self.api_url,
@@ -194,11 +447,13 @@ class OllamaProvider(LLMProvider):
                     "model": self.model_name,
                     "prompt": prompt,
                     "stream": False,
+                    "keep_alive": self.keep_alive,
                 },
-                timeout=300.0,  # 5 minutes timeout
+                timeout=stage_timeout(REQUEST_TIMEOUT, "LLM call"),
             )
             response.raise_for_status()
             result = response.json()
+            _record_ollama_usage(result, self.model_name, start)
             return result.get("response", "")
         except httpx.RequestError as e:
             raise RuntimeError(f"Failed to connect to Ollama at {self.base_url}: {e}")
@@ -211,9 +466,24 @@ class OllamaProvider(LLMProvider):
         user_prompt: str,
         response_schema: Dict[str, Any],
     ) -> List[str]:
-        """Generate structured content using Ollama with JSON parsing."""
-        # Since Ollama doesn't natively support JSON schema, enhance the prompt
-        # to explicitly request JSON format
+        """Generate structured content using Ollama, parsing the JSON array as it streams."""
+        return [
+            item async for item in self.stream_structured_content(system_prompt, user_prompt, response_schema)
+        ]
+
+    async def stream_structured_content(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        response_schema: Dict[str, Any],
+    ) -> AsyncIterator[Any]:
+        """
+        Stream structured content from Ollama, yielding each array item once it is complete.
+
+        Generation is aborted as soon as the array closes or the schema's maxItems
+        items have been parsed, instead of waiting for the model to stop talking.
+        """
+        # Describe the schema in the prompt as well; it helps models that ignore `format`
         schema_description = json.dumps(response_schema, indent=2)
         enhanced_prompt = f"""{system_prompt}
 
@@ -224,52 +494,191 @@ IMPORTANT: You MUST respond with ONLY a valid JSON array that matches this schem
 
 Do not include any text before or after the JSON array. Return ONLY the JSON array."""
 
+        payload: Dict[str, Any] = {
+            "model": self.model_name,
+            "prompt": enhanced_prompt,
+            "stream": True,
+            "keep_alive": self.keep_alive,
+        }
+        if self.structured_format == "schema":
+            payload["format"] = response_schema
+        elif self.structured_format == "json":
+            payload["format"] = "json"
+
+        self._last_used = start = time.monotonic()
+        max_items = response_schema.get("maxItems")
+        parser = JSONArrayStreamParser()
+        received: List[str] = []
+        count = 0
+        first_token_at: Optional[float] = None
+        final_chunk: Optional[Dict[str, Any]] = None
+
         try:
-            response = httpx.post(
-                self.api_url,
-                json={
-                    "model": self.model_name,
-                    "prompt": enhanced_prompt,
-                    "stream": False,
-                },
-                timeout=300.0,  # 5 minutes timeout
-            )
-            response.raise_for_status()
-            result = response.json()
-            response_text = result.get("response", "").strip()
-            
-            # Try to extract JSON from the response (may have extra text)
-            # Look for JSON array pattern
-            json_match = re.search(r'\[.*\]', response_text, re.DOTALL)
-            if json_match:
-                response_text = json_match.group(0)
-            
-            # Parse JSON response
-            try:
-                json_data = json.loads(response_text)
-                # Extract the array from the response
-                if isinstance(json_data, list):
-                    return json_data
-                elif isinstance(json_data, dict) and "items" in json_data:
-                    return json_data["items"]
-                else:
-                    raise ValueError(f"Unexpected JSON structure: {json_data}")
-            except json.JSONDecodeError as e:
-                raise ValueError(
-                    f"Failed to parse JSON response from Ollama: {e}. "
-                    f"Response text: {response_text[:200]}..."
-                )
+            async with self._get_async_client().stream(
+                "POST", self.api_url, json=payload, timeout=stage_timeout(REQUEST_TIMEOUT, "LLM call")
+            ) as response:
+                if response.is_error:
+                    await response.aread()
+                    response.raise_for_status()
+
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    if chunk.get("error"):
+                        raise RuntimeError(f"Ollama API error: {chunk['error']}")
+
+                    if chunk.get("done"):
+                        final_chunk = chunk
+                    text = chunk.get("response", "")
+                    if text and first_token_at is None:
+                        first_token_at = time.monotonic()
+                    received.append(text)
+                    for item in parser.feed(text):
+                        count += 1
+                        yield item
+                        if max_items and count >= max_items:
+                            # Leaving the stream closes the connection, which stops generation
+                            return
+                    if parser.done or chunk.get("done"):
+                        break
         except httpx.RequestError as e:
             raise RuntimeError(f"Failed to connect to Ollama at {self.base_url}: {e}")
         except httpx.HTTPStatusError as e:
             raise RuntimeError(f"Ollama API error: {e.response.status_code} - {e.response.text}")
+        finally:
+            if final_chunk is not None:
+                _record_ollama_usage(final_chunk, self.model_name, start)
+            elif first_token_at is not None:
+                # Stopped before Ollama's final statistics: each streamed chunk is one token
+                end = time.monotonic()
+                record_usage(UsageRecord(
+                    provider="ollama",
+                    model=self.model_name,
+                    input_tokens=None,
+                    output_tokens=sum(1 for text in received if text),
+                    time_to_first_token=first_token_at - start,
+                    generation_seconds=end - first_token_at,
+                    total_seconds=end - start,
+                ))
+
+        if not parser.done and count == 0:
+            response_text = "".join(received).strip()
+            raise ValueError(
+                f"Failed to parse JSON response from Ollama: no complete JSON array found. "
+                f"Response text: {response_text[:200]}..."
+            )
+
+    async def generate_candidates(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        count: int,
+        max_tokens: int = 64,
+        stop: Optional[List[str]] = None,
+    ) -> List[str]:
+        """Generate count candidates as parallel short Ollama calls with different seeds."""
+        self._last_used = start = time.monotonic()
+        base_seed = int.from_bytes(os.urandom(3), "big")
+
+        async def generate_one(seed: int) -> str:
+            options: Dict[str, Any] = {"seed": seed, "num_predict": max_tokens}
+            if stop:
+                options["stop"] = stop
+            try:
+                response = await self._get_async_client().post(
+                    self.api_url,
+                    json={
+                        "model": self.model_name,
+                        "system": system_prompt,
+                        "prompt": user_prompt,
+                        "stream": False,
+                        "options": options,
+                        "keep_alive": self.keep_alive,
+                    },
+                    timeout=stage_timeout(REQUEST_TIMEOUT, "LLM call"),
+                )
+                response.raise_for_status()
+                result = response.json()
+                _record_ollama_usage(result, self.model_name, start)
+                return result.get("response", "")
+            except httpx.RequestError as e:
+                raise RuntimeError(f"Failed to connect to Ollama at {self.base_url}: {e}")
+            except httpx.HTTPStatusError as e:
+                raise RuntimeError(f"Ollama API error: {e.response.status_code} - {e.response.text}")
+
+        results = await asyncio.gather(
+            *(generate_one(base_seed + i) for i in range(count)),
+            return_exceptions=True,
+        )
+        return _collect_candidates(results)
+
+
+    async def warm_up(self) -> None:
+        """
+        Load the model into memory and keep it resident for keep_alive.
+
+        An empty prompt makes Ollama load the model without generating anything.
+        The round trip is recorded as llm.warm_up_seconds and Ollama's reported
+        load time as llm.model_load_seconds.
+        """
+        start = time.monotonic()
+        try:
+            response = await self._get_async_client().post(
+                self.api_url,
+                json={"model": self.model_name, "prompt": "", "keep_alive": self.keep_alive},
+            )
+            response.raise_for_status()
+            result = response.json()
+        except httpx.HTTPError as e:
+            metrics.increment("llm.warm_up_failures", provider="ollama")
+            print(f"[OLLAMA_PROVIDER] Warm-up of {self.model_name} failed: {e!r}")
+            return
+
+        elapsed = time.monotonic() - start
+        self._last_used = time.monotonic()
+        metrics.observe("llm.warm_up_seconds", elapsed, provider="ollama", model=self.model_name)
+        # load_duration is reported by Ollama in nanoseconds; it is near zero if the model was already loaded
+        load_duration = result.get("load_duration")
+        if load_duration is not None:
+            metrics.observe("llm.model_load_seconds", load_duration / 1e9, provider="ollama", model=self.model_name)
+        print(f"[OLLAMA_PROVIDER] Warmed up {self.model_name} in {elapsed:.2f}s")
+
+    async def keep_warm(self) -> None:
+        """Ping the model whenever it has been idle for keep_warm_interval seconds."""
+        if self.keep_warm_interval <= 0:
+            return
+        while True:
+            idle = time.monotonic() - self._last_used
+            if idle >= self.keep_warm_interval:
+                await self.warm_up()
+                idle = 0.0
+            await asyncio.sleep(self.keep_warm_interval - idle)
 
 
 class MockProvider(LLMProvider):
     """Mock provider for testing without any AI calls."""
 
+    @staticmethod
+    def _record(prompt: str, outputs: List[str]) -> None:
+        """Record usage with token counts estimated at four characters per token."""
+        record_usage(UsageRecord(
+            provider="mock",
+            model=None,
+            input_tokens=len(prompt) // 4,
+            output_tokens=sum(len(output) for output in outputs) // 4,
+            time_to_first_token=0.0,
+            generation_seconds=0.0,
+            total_seconds=0.0,
+        ))
+
     def generate_content(self, prompt: str) -> str:
         """Generate mock content."""
+        content = self._mock_content(prompt)
+        self._record(prompt, [content])
+        return content
+
+    def _mock_content(self, prompt: str) -> str:
         # Simple mock that returns formatted responses based on prompt content
         if "character" in prompt.lower():
             return """1. **Aria Blackwood** - A mysterious scholar with a hidden past, seeking ancient knowledge. Key traits: Intelligent, secretive, determined. Backstory: Former member of a secret organization, now on the run. Motivations: To uncover the truth about her family's disappearance.
@@ -314,6 +723,11 @@ Prompt received: {prompt[:100]}...
         response_schema: Dict[str, Any],
     ) -> List[str]:
         """Generate mock structured content for testing."""
+        suggestions = self._mock_suggestions(user_prompt)
+        self._record(f"{system_prompt}\n\n{user_prompt}", suggestions)
+        return suggestions
+
+    def _mock_suggestions(self, user_prompt: str) -> List[str]:
         # Return mock suggestions based on context
         # Check if the prompt mentions next lines or continuation
         if "next line" in user_prompt.lower() or "continuation" in user_prompt.lower() or "[INSERTION_POINT]" in user_prompt:
@@ -330,6 +744,138 @@ Prompt received: {prompt[:100]}...
                 "Mock suggestion 3 for structured content testing.",
             ]
 
+    async def generate_candidates(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        count: int,
+        max_tokens: int = 64,
+        stop: Optional[List[str]] = None,
+    ) -> List[str]:
+        """Generate mock candidates for testing."""
+        lines = [
+            "The morning light filtered through the curtains, casting long shadows across the room.",
+            "She paused, considering her next words carefully before speaking.",
+            "A sense of unease settled over him as he realized what was about to happen.",
+        ]
+        candidates = [lines[i % len(lines)] for i in range(count)]
+        self._record(f"{system_prompt}\n\n{user_prompt}", candidates)
+        return candidates
+
+
+class CircuitBreakingProvider(LLMProvider):
+    """Wraps a provider so that calls go through the circuit breaker for one action class."""
+
+    def __init__(self, provider: LLMProvider, action_class: str):
+        """
+        Initialize the wrapper.
+
+        Args:
+            provider: The provider to call
+            action_class: Action class whose latency SLO applies ("interactive", "brainstorm", "long_form")
+        """
+        self.provider = provider
+        self.action_class = action_class
+        self.breaker: CircuitBreaker = circuit_breakers.get(type(provider).__name__, action_class)
+
+    def __getattr__(self, name: str) -> Any:
+        # Expose the wrapped provider's attributes (model_name, base_url, ...)
+        return getattr(self.provider, name)
+
+    def _record(self, start: float, result: Any = None) -> None:
+        """Record a call outcome; an empty structured result counts as a failure."""
+        if isinstance(result, list) and not result:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success(time.monotonic() - start)
+
+    def generate_content(self, prompt: str) -> str:
+        self.breaker.before_call()
+        start = time.monotonic()
+        try:
+            result = self.provider.generate_content(prompt)
+        except (DeadlineExceeded, asyncio.CancelledError):
+            # The caller ran out of time or went away; that says nothing about the provider's health
+            self.breaker.release()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self._record(start)
+        return result
+
+    async def generate_structured_content(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        response_schema: Dict[str, Any],
+    ) -> List[str]:
+        self.breaker.before_call()
+        start = time.monotonic()
+        try:
+            result = await self.provider.generate_structured_content(system_prompt, user_prompt, response_schema)
+        except (DeadlineExceeded, asyncio.CancelledError):
+            # The caller ran out of time or went away; that says nothing about the provider's health
+            self.breaker.release()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self._record(start, result)
+        return result
+
+    async def stream_structured_content(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        response_schema: Dict[str, Any],
+    ) -> AsyncIterator[Any]:
+        self.breaker.before_call()
+        start = time.monotonic()
+        count = 0
+        try:
+            async for item in self.provider.stream_structured_content(system_prompt, user_prompt, response_schema):
+                count += 1
+                yield item
+        except (DeadlineExceeded, asyncio.CancelledError, GeneratorExit):
+            # The caller ran out of time or went away; that says nothing about the provider's health
+            self.breaker.release()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self._record(start, [] if count == 0 else None)
+
+    async def generate_candidates(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        count: int,
+        max_tokens: int = 64,
+        stop: Optional[List[str]] = None,
+    ) -> List[str]:
+        self.breaker.before_call()
+        start = time.monotonic()
+        try:
+            result = await self.provider.generate_candidates(
+                system_prompt, user_prompt, count, max_tokens=max_tokens, stop=stop
+            )
+        except (DeadlineExceeded, asyncio.CancelledError):
+            # The caller ran out of time or went away; that says nothing about the provider's health
+            self.breaker.release()
+            raise
+        except Exception:
+            self.breaker.record_failure()
+            raise
+        self._record(start, result)
+        return result
+
+    async def warm_up(self) -> None:
+        await self.provider.warm_up()
+
+    async def keep_warm(self) -> None:
+        await self.provider.keep_warm()
+
 
 def get_llm_provider(project_id: Optional[str] = None, location: str = "us-central1") -> LLMProvider:
     """
@@ -340,6 +886,9 @@ def get_llm_provider(project_id: Optional[str] = None, location: str = "us-centr
     - USE_OLLAMA: If set to "true", use Ollama for local development
     - OLLAMA_BASE_URL: Ollama API base URL (default: http://localhost:11434)
     - OLLAMA_MODEL: Model name to use (default: phi4-mini)
+    - OLLAMA_STRUCTURED_FORMAT: "schema" (default, Ollama 0.5+), "json" or "none" for structured output
+    - OLLAMA_KEEP_ALIVE: How long Ollama keeps the model loaded (default: 30m)
+    - OLLAMA_KEEP_WARM_INTERVAL: Idle seconds before the model is pinged (default: 240, 0 disables)
     - USE_MOCK: If set to "true", use mock provider (no AI calls, for testing)
     - GOOGLE_AI_STUDIO_MODEL: Model name for Google AI Studio (default: gemini-2.0-flash-exp for free tier)
 
@@ -360,9 +909,7 @@ def get_llm_provider(project_id: Optional[str] = None, location: str = "us-centr
     
     if use_ollama:
         print("Using Ollama LLM Provider.")
-        base_url = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
-        model_name = os.getenv("OLLAMA_MODEL", "phi4-mini")
-        return OllamaProvider(base_url=base_url, model_name=model_name)
+        return _ollama_provider_from_env()
     
     # Prefer Google AI Studio API if API key is provided
     if google_ai_studio_api_key:
@@ -372,7 +919,54 @@ def get_llm_provider(project_id: Optional[str] = None, location: str = "us-centr
     
     # Default to ollama
     print("Using Ollama Provider.")
-    base_url = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
-    model_name = os.getenv("OLLAMA_MODEL", "phi4-mini")
-    return OllamaProvider(base_url=base_url, model_name=model_name)
+    return _ollama_provider_from_env()
+
+
+def _ollama_provider_from_env() -> OllamaProvider:
+    """Create an OllamaProvider from the OLLAMA_* environment variables."""
+    return OllamaProvider(
+        base_url=os.getenv("OLLAMA_BASE_URL", "http://localhost:11434"),
+        model_name=os.getenv("OLLAMA_MODEL", "phi4-mini"),
+        structured_format=os.getenv("OLLAMA_STRUCTURED_FORMAT", "schema"),
+        keep_alive=os.getenv("OLLAMA_KEEP_ALIVE", "30m"),
+        keep_warm_interval=float(os.getenv("OLLAMA_KEEP_WARM_INTERVAL", "240")),
+    )
+
+
 
+
+# Providers are stateless HTTP clients, so every tool can share one instance.
+_shared_providers: Dict[tuple, LLMProvider] = {}
+
+
+def get_shared_llm_provider(
+    project_id: Optional[str] = None,
+    location: str = "us-central1",
+    action_class: Optional[str] = None,
+) -> LLMProvider:
+    """
+    Return a process-wide LLM provider, creating it with get_llm_provider on first use.
+
+    Args:
+        project_id: GCP project ID (passed through to get_llm_provider)
+        location: GCP location (not used, kept for backward compatibility)
+        action_class: If given, wrap the provider in the circuit breaker for this
+                      action class ("interactive", "brainstorm", "long_form")
+
+    Returns:
+        LLMProvider instance shared by all callers with the same arguments
+    """
+    key = (project_id, location)
+    provider = _shared_providers.get(key)
+    if provider is None:
+        provider = get_llm_provider(project_id, location)
+        _shared_providers[key] = provider
+
+    if action_class is None:
+        return provider
+    wrapped_key = (project_id, location, action_class)
+    wrapped = _shared_providers.get(wrapped_key)
+    if wrapped is None:
+        wrapped = CircuitBreakingProvider(provider, action_class)
+        _shared_providers[wrapped_key] = wrapped
+    return wrapped
@@ -0,0 +1,132 @@
+"""Event loop lag monitoring, with the stack of whatever blocks the loop."""
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+from pathlib import Path
+from typing import Any, Deque, Dict, List, Optional
+
+# Handle imports for both direct execution and module import
+try:
+    from .metrics import metrics
+except ImportError:
+    # Add parent directory to path for direct execution
+    current_dir = Path(__file__).parent
+    parent_dir = current_dir.parent.parent
+    if str(parent_dir) not in sys.path:
+        sys.path.insert(0, str(parent_dir))
+    from agents.storyAgent.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds between lag measurements (0 disables the watchdog)
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+# Lag (seconds) after which the loop counts as stalled and the blocking stack is captured
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.25"))
+# Stalls kept for /metrics
+LOOP_STALLS_KEPT = int(os.getenv("LOOP_STALLS_KEPT", "20"))
+# Innermost frames kept from a stalled loop's stack
+LOOP_STALL_STACK_DEPTH = 20
+
+_PACKAGE_DIR = str(Path(__file__).parent)
+
+
+class LoopWatchdog:
+    """
+    Measures how late the event loop runs a periodic callback, and catches what blocks it.
+
+    A heartbeat coroutine on the loop sleeps for `interval` and records how much
+    later than that it woke up (event_loop.lag_seconds). A watchdog thread checks
+    the last heartbeat: when the loop has not come back for `threshold` seconds,
+    something is running on it without yielding, and the thread captures the
+    loop thread's stack at that moment. The stall is logged, counted
+    (event_loop.stalls) and kept for /metrics with its final duration
+    (event_loop.stall_seconds).
+    """
+
+    def __init__(
+        self,
+        interval: float = LOOP_LAG_INTERVAL,
+        threshold: float = LOOP_STALL_THRESHOLD,
+        kept: int = LOOP_STALLS_KEPT,
+    ):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls: Deque[Dict[str, Any]] = deque(maxlen=kept)
+        self.max_lag = 0.0
+        self._last_beat = time.monotonic()
+        self._loop_thread: Optional[int] = None
+        self._current_stall: Optional[Dict[str, Any]] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    async def run(self) -> None:
+        """Heartbeat; run as a task on the loop being watched. Starts the watchdog thread."""
+        self._loop_thread = threading.get_ident()
+        self._last_beat = time.monotonic()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._watch, name="loop-watchdog", daemon=True)
+        self._thread.start()
+        try:
+            while True:
+                before = time.monotonic()
+                await asyncio.sleep(self.interval)
+                now = time.monotonic()
+                lag = max(0.0, now - before - self.interval)
+                metrics.observe("event_loop.lag_seconds", lag)
+                with self._lock:
+                    self._last_beat = now
+                    self.max_lag = max(self.max_lag, lag)
+                    stall, self._current_stall = self._current_stall, None
+                    if stall is not None:
+                        stall["seconds"] = round(lag + self.interval, 3)
+                if stall is not None:
+                    metrics.observe("event_loop.stall_seconds", stall["seconds"])
+                    logger.warning(f"Event loop blocked for {stall['seconds']:.3f}s in {stall['where']}")
+                    print(f"[LOOP] Event loop blocked for {stall['seconds']:.3f}s in {stall['where']}")
+        finally:
+            self._stop.set()
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.threshold / 4):
+            with self._lock:
+                blocked_for = time.monotonic() - self._last_beat - self.interval
+                if blocked_for < self.threshold or self._current_stall is not None:
+                    continue
+                stall = self._capture(blocked_for)
+                self._current_stall = stall
+                self.stalls.append(stall)
+            metrics.increment("event_loop.stalls")
+
+    def _capture(self, blocked_for: float) -> Dict[str, Any]:
+        """Describe what the loop thread is running now. Caller holds the lock."""
+        frame = sys._current_frames().get(self._loop_thread)
+        stack: List[str] = []
+        where = "unknown"
+        if frame is not None:
+            summary = traceback.extract_stack(frame)[-LOOP_STALL_STACK_DEPTH:]
+            stack = [f"{Path(entry.filename).name}:{entry.lineno} {entry.name}" for entry in summary]
+            # Innermost frame of our own code, rather than the library call it blocked in
+            own = [line for line, entry in zip(stack, summary) if entry.filename.startswith(_PACKAGE_DIR)]
+            where = (own or stack)[-1] if stack else where
+        return {
+            "at": time.time(),
+            # Updated with the full duration once the loop comes back
+            "seconds": round(blocked_for, 3),
+            "where": where,
+            "stack": stack,
+        }
+
+    def snapshot(self) -> Dict[str, Any]:
+        """Worst lag seen and the recent stalls with their stacks, for /metrics."""
+        with self._lock:
+            return {"maxLagSeconds": round(self.max_lag, 4), "stalls": [dict(stall) for stall in self.stalls]}
+
+
+# Process-wide watchdog
+loop_watchdog = LoopWatchdog()
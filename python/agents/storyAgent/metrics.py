@@ -0,0 +1,93 @@
+"""In-process metrics registry for the story agent service."""
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Deque, Dict, Iterator, Tuple
+
+# Samples kept per timing series for percentile estimates
+RESERVOIR_SIZE = 1024
+
+
+def _series_key(name: str, labels: Dict[str, Any]) -> str:
+    """Format a metric name and its labels as name{key=value,...}."""
+    if not labels:
+        return name
+    label_text = ",".join(f"{key}={labels[key]}" for key in sorted(labels))
+    return f"{name}{{{label_text}}}"
+
+
+class Metrics:
+    """Thread-safe counters, gauges and timings, reported as a JSON snapshot on /metrics.
+
+    Values are per process; with several workers each worker reports its own.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, float] = {}
+        self._timings: Dict[str, Tuple[Dict[str, float], Deque[float]]] = {}
+
+    def increment(self, name: str, value: float = 1, **labels: Any) -> None:
+        """Add value to a counter."""
+        key = _series_key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name: str, value: float, **labels: Any) -> None:
+        """Set a gauge to value."""
+        key = _series_key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name: str, value: float, **labels: Any) -> None:
+        """Record one sample (usually seconds) in a timing series."""
+        key = _series_key(name, labels)
+        with self._lock:
+            series = self._timings.get(key)
+            if series is None:
+                series = ({"count": 0, "sum": 0.0, "min": value, "max": value}, deque(maxlen=RESERVOIR_SIZE))
+                self._timings[key] = series
+            stats, samples = series
+            stats["count"] += 1
+            stats["sum"] += value
+            stats["min"] = min(stats["min"], value)
+            stats["max"] = max(stats["max"], value)
+            samples.append(value)
+
+    @contextmanager
+    def timer(self, name: str, **labels: Any) -> Iterator[None]:
+        """Context manager that observes the elapsed wall-clock seconds."""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(name, time.monotonic() - start, **labels)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Return all metrics as plain data.
+
+        Returns:
+            Dictionary with "counters", "gauges" and "timings"; each timing has
+            count, sum, min, max and p50/p95/p99 over its most recent samples
+        """
+        with self._lock:
+            timings = {}
+            for key, (stats, samples) in self._timings.items():
+                ordered = sorted(samples)
+                summary = dict(stats)
+                for percentile in (50, 95, 99):
+                    index = min(len(ordered) - 1, int(len(ordered) * percentile / 100))
+                    summary[f"p{percentile}"] = ordered[index]
+                timings[key] = summary
+            return {
+                "counters": dict(self._counters),
+                "gauges": dict(self._gauges),
+                "timings": timings,
+            }
+
+
+# Process-wide registry
+metrics = Metrics()
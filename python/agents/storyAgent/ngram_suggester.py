@@ -0,0 +1,335 @@
+"""Local n-gram continuation model built from a story's own chapters."""
+import hashlib
+import os
+import re
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+if TYPE_CHECKING:
+    from .story_context import Chapter
+
+# Longest n-gram kept (the next word is predicted from up to NGRAM_ORDER - 1 previous tokens)
+NGRAM_ORDER = int(os.getenv("NGRAM_ORDER", "4"))
+# Longest continuation produced (tokens, punctuation included)
+NGRAM_MAX_TOKENS = int(os.getenv("NGRAM_MAX_TOKENS", "24"))
+# Stories whose models are kept in memory
+NGRAM_MAX_STORIES = int(os.getenv("NGRAM_MAX_STORIES", "64"))
+# How often a story's model is re-synced with its chapters (seconds)
+NGRAM_SYNC_INTERVAL = float(os.getenv("NGRAM_SYNC_INTERVAL", "60"))
+# Count changes kept outside a model's flat index before it is rebuilt (at least; grows with the index)
+NGRAM_COMPACT_MIN = int(os.getenv("NGRAM_COMPACT_MIN", "4096"))
+
+_TOKEN = re.compile(r"\w+(?:['’]\w+)*|[^\w\s]")
+_SENTENCE_END = {".", "!", "?"}
+_NO_SPACE_BEFORE = {".", ",", "!", "?", ";", ":", ")", "]", "}", "”", "’", "%"}
+_NO_SPACE_AFTER = {"(", "[", "{", "“", "‘"}
+_MASK_64 = (1 << 64) - 1
+
+
+def _context_key(context: Tuple[int, ...]) -> int:
+    """64-bit key of a context in the flat index (hashes of int tuples are stable across processes)."""
+    return hash(context) & _MASK_64
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into words and punctuation marks."""
+    return _TOKEN.findall(text)
+
+
+def detokenize(tokens: Iterable[str]) -> str:
+    """Join tokens back into text with conventional spacing around punctuation."""
+    parts: List[str] = []
+    previous = None
+    open_quote = False
+    for token in tokens:
+        space = previous is not None and token not in _NO_SPACE_BEFORE and previous not in _NO_SPACE_AFTER
+        if token == '"':
+            # Straight quotes: opening quotes attach to the next word, closing ones to the previous
+            if open_quote:
+                space = False
+            open_quote = not open_quote
+        elif previous == '"' and open_quote:
+            space = False
+        if space:
+            parts.append(" ")
+        parts.append(token)
+        previous = token
+    return "".join(parts)
+
+
+class NgramModel:
+    """
+    Word n-gram counts over a story's text, updated one source (chapter) at a time.
+
+    Each source is stored as an array of token IDs. Counts live in a flat
+    index of three parallel arrays (context key, next token ID, count), sorted
+    by context and then by count, so a lookup is a binary search and the index
+    costs 16 bytes per distinct n-gram. Replacing a source records the
+    difference (old n-grams subtracted, new ones added) in a small overlay,
+    so edits never require a full rebuild; once the overlay grows past a
+    quarter of the index, the index is rebuilt from the sources. N-grams never
+    span two sources.
+    """
+
+    def __init__(self, order: int = NGRAM_ORDER):
+        self.order = order
+        self._vocabulary: Dict[str, int] = {}
+        self._tokens: List[str] = []
+        # Flat index: context keys (sorted), next token IDs and their counts, most frequent first per context
+        self._keys = array("Q")
+        self._next = array("I")
+        self._freqs = array("I")
+        # Count changes since the index was built: context (tuple of up to order - 1 token IDs) -> next token ID -> delta
+        self._changes: Dict[Tuple[int, ...], Dict[int, int]] = {}
+        self._change_count = 0
+        # Source ID -> (content hash, token IDs)
+        self._sources: Dict[str, Tuple[str, array]] = {}
+        self._pinned: Set[str] = set()
+        self._lock = threading.Lock()
+        self.synced_at = 0.0
+
+    def _token_id(self, token: str) -> int:
+        token_id = self._vocabulary.get(token)
+        if token_id is None:
+            token_id = len(self._tokens)
+            self._vocabulary[token] = token_id
+            self._tokens.append(token)
+        return token_id
+
+    def _ngrams(self, ids: array) -> Iterable[Tuple[Tuple[int, ...], int]]:
+        """Every (context, next token ID) pair of a source."""
+        for i, token_id in enumerate(ids):
+            for n in range(min(self.order, i + 1)):
+                yield tuple(ids[i - n:i]), token_id
+
+    def _count(self, ids: array, delta: int) -> None:
+        """Add delta to every n-gram of a source, in the overlay. Caller holds the lock."""
+        for context, token_id in self._ngrams(ids):
+            changes = self._changes.setdefault(context, {})
+            count = changes.get(token_id, 0) + delta
+            if count:
+                if token_id not in changes:
+                    self._change_count += 1
+                changes[token_id] = count
+            else:
+                del changes[token_id]
+                self._change_count -= 1
+                if not changes:
+                    del self._changes[context]
+
+    def _compact(self, force: bool = False) -> None:
+        """Rebuild the flat index from the sources once the overlay is large. Caller holds the lock."""
+        if not force and self._change_count <= max(NGRAM_COMPACT_MIN, len(self._keys) // 4):
+            return
+        counts = Counter(
+            (_context_key(context), token_id)
+            for _, ids in self._sources.values()
+            for context, token_id in self._ngrams(ids)
+        )
+        entries = sorted(counts.items(), key=lambda entry: (entry[0][0], -entry[1], entry[0][1]))
+        self._keys = array("Q", (key for (key, _), _ in entries))
+        self._next = array("I", (token_id for (_, token_id), _ in entries))
+        self._freqs = array("I", (count for _, count in entries))
+        self._changes = {}
+        self._change_count = 0
+
+    def _replace(self, source_id: str, text: str) -> bool:
+        """Set a source's text in the overlay. Caller holds the lock."""
+        digest = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        current = self._sources.get(source_id)
+        if current is not None and current[0] == digest:
+            return False
+        ids = array("I", (self._token_id(token) for token in tokenize(text)))
+        if current is not None:
+            self._count(current[1], -1)
+        self._count(ids, 1)
+        self._sources[source_id] = (digest, ids)
+        return True
+
+    def update_source(self, source_id: str, text: str, pinned: bool = False) -> bool:
+        """
+        Set the text of one source, adjusting counts incrementally.
+
+        Args:
+            source_id: Stable ID of the source (e.g. a chapter ID)
+            text: Current text of the source
+            pinned: Mark the source as live editor text, which sync_chapters will not overwrite
+
+        Returns:
+            Whether the model changed
+        """
+        with self._lock:
+            if pinned:
+                self._pinned.add(source_id)
+            changed = self._replace(source_id, text)
+            self._compact()
+            return changed
+
+    def remove_source(self, source_id: str) -> bool:
+        """
+        Drop a source and its n-gram counts.
+
+        Returns:
+            Whether the source was in the model
+        """
+        with self._lock:
+            self._pinned.discard(source_id)
+            current = self._sources.pop(source_id, None)
+            if current is None:
+                return False
+            self._count(current[1], -1)
+            self._compact()
+            return True
+
+    def unpin(self, source_id: str) -> None:
+        """Let sync_chapters overwrite a source again, e.g. once its editor session has closed."""
+        with self._lock:
+            self._pinned.discard(source_id)
+
+    def sync_chapters(self, chapters: Iterable["Chapter"]) -> int:
+        """
+        Bring the model in line with a story's chapters as stored in Firestore.
+
+        Chapters pinned by an editor session are skipped; their live text is newer.
+
+        Args:
+            chapters: The story's chapters (StoryContext.chapters)
+
+        Returns:
+            Number of chapters whose text changed
+        """
+        changed = 0
+        with self._lock:
+            for chapter in chapters:
+                source_id = chapter.id
+                if not source_id or source_id in self._pinned:
+                    continue
+                if self._replace(source_id, chapter.content):
+                    changed += 1
+            # One rebuild for the whole sync rather than one per chapter
+            self._compact(force=self._change_count > NGRAM_COMPACT_MIN)
+        self.synced_at = time.monotonic()
+        return changed
+
+    def _followers(self, context: Tuple[int, ...]) -> List[int]:
+        """Next token IDs seen after a context, most frequent first. Caller holds the lock."""
+        key = _context_key(context)
+        start = bisect_left(self._keys, key)
+        end = bisect_right(self._keys, key, start)
+        changes = self._changes.get(context)
+        if not changes:
+            return list(self._next[start:end])
+        counts = dict(zip(self._next[start:end], self._freqs[start:end]))
+        for token_id, delta in changes.items():
+            count = counts.get(token_id, 0) + delta
+            if count > 0:
+                counts[token_id] = count
+            else:
+                counts.pop(token_id, None)
+        return sorted(counts, key=lambda token_id: (-counts[token_id], token_id))
+
+    def _ranked_next(self, context: List[Optional[int]], min_context: int = 0) -> List[int]:
+        """Candidate next token IDs, most frequent first, backing off to shorter contexts. Caller holds the lock."""
+        for n in range(min(len(context), self.order - 1), min_context - 1, -1):
+            key = tuple(context[len(context) - n:]) if n else ()
+            if None in key:
+                continue
+            followers = self._followers(key)
+            if followers:
+                return followers
+        return []
+
+    def suggest(self, prefix: str, count: int, max_tokens: int = NGRAM_MAX_TOKENS) -> List[str]:
+        """
+        Continue prefix with the most likely token sequences.
+
+        The k-th suggestion starts with the k-th most likely next token and then
+        follows the most likely path until a sentence end or max_tokens.
+
+        Args:
+            prefix: Text before the cursor
+            count: Number of suggestions wanted
+            max_tokens: Longest continuation, in tokens
+
+        Returns:
+            Up to count distinct continuations (empty if the model knows nothing)
+        """
+        context = [self._vocabulary.get(token) for token in tokenize(prefix)[-(self.order - 1):]]
+        suggestions: List[str] = []
+        with self._lock:
+            # The first token must follow at least the last token of the prefix; a
+            # plain word-frequency guess is not a continuation
+            for first in self._ranked_next(context, min_context=min(1, len(context)))[:count * 3]:
+                path = context + [first]
+                generated = [first]
+                while len(generated) < max_tokens and self._tokens[generated[-1]] not in _SENTENCE_END:
+                    ranked = self._ranked_next(path)
+                    if not ranked:
+                        break
+                    path.append(ranked[0])
+                    generated.append(ranked[0])
+                text = detokenize(self._tokens[token_id] for token_id in generated)
+                if any(character.isalnum() for character in text) and text not in suggestions:
+                    suggestions.append(text)
+                if len(suggestions) >= count:
+                    break
+        return suggestions
+
+
+class NgramModelRegistry:
+    """One n-gram model per story, least recently used stories evicted first."""
+
+    def __init__(self, max_stories: int = NGRAM_MAX_STORIES):
+        self.max_stories = max_stories
+        self._models: "OrderedDict[str, NgramModel]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def peek(self, story_id: str) -> Optional[NgramModel]:
+        """The story's model if it is loaded, without creating or syncing it."""
+        with self._lock:
+            return self._models.get(story_id)
+
+    def get(
+        self,
+        story_id: str,
+        load_chapters: Optional[Callable[[], Iterable["Chapter"]]] = None,
+    ) -> NgramModel:
+        """
+        Return the model for a story, syncing it with its chapters when due.
+
+        If loading the chapters fails, the model is returned as it is.
+
+        Args:
+            story_id: Firestore story document ID
+            load_chapters: Returns the story's chapters; called at most every NGRAM_SYNC_INTERVAL seconds
+
+        Returns:
+            The story's model
+        """
+        with self._lock:
+            model = self._models.get(story_id)
+            if model is None:
+                model = NgramModel()
+                self._models[story_id] = model
+                while len(self._models) > self.max_stories:
+                    self._models.popitem(last=False)
+            else:
+                self._models.move_to_end(story_id)
+
+        due = model.synced_at == 0.0 or time.monotonic() - model.synced_at >= NGRAM_SYNC_INTERVAL
+        if load_chapters is not None and due:
+            try:
+                model.sync_chapters(load_chapters())
+            except Exception as error:
+                # Keep serving the last synced text rather than nothing, and retry after the interval
+                model.synced_at = time.monotonic()
+                print(f"[NGRAM] Could not sync chapters for story {story_id}: {error}")
+        return model
+
+
+# Process-wide registry
+ngram_models = NgramModelRegistry()
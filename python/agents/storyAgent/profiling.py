@@ -0,0 +1,320 @@
+"""On-demand sampling profiles of single agent requests, written as collapsed stacks for flame graphs."""
+import asyncio
+import hmac
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from pathlib import Path
+from types import FrameType
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+
+# Handle imports for both direct execution and module import
+try:
+    from .metrics import metrics
+except ImportError:
+    # Add parent directory to path for direct execution
+    current_dir = Path(__file__).parent
+    parent_dir = current_dir.parent.parent
+    if str(parent_dir) not in sys.path:
+        sys.path.insert(0, str(parent_dir))
+    from agents.storyAgent.metrics import metrics
+
+# Token that enables the X-Profile request header and the /admin/profiles endpoints (unset: both disabled)
+PROFILE_ADMIN_TOKEN = os.getenv("PROFILE_ADMIN_TOKEN", "")
+# Fraction of agent requests profiled without being asked (0 disables sampling)
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# Seconds between stack samples of a profiled request
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+# Directory profiles are written to
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "story-agent-profiles"))
+# Profiles kept on disk (oldest deleted first)
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "50"))
+
+# Profile of the request being served, if it is being profiled
+_active: ContextVar[Optional["RequestProfile"]] = ContextVar("request_profile", default=None)
+
+
+def enabled() -> bool:
+    """Whether any request can be profiled in this process."""
+    return bool(PROFILE_ADMIN_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+
+def is_admin(token: Optional[str]) -> bool:
+    """Whether token is the configured admin token."""
+    return bool(PROFILE_ADMIN_TOKEN) and token is not None and hmac.compare_digest(token, PROFILE_ADMIN_TOKEN)
+
+
+def should_profile(headers: Dict[str, str]) -> Optional[str]:
+    """
+    Decide whether to profile a request.
+
+    Args:
+        headers: Request headers (lowercase names)
+
+    Returns:
+        "header" or "sampled" when the request is to be profiled, else None
+    """
+    if headers.get("x-profile") and is_admin(headers.get("x-admin-token")):
+        return "header"
+    if PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE:
+        return "sampled"
+    return None
+
+
+def _frame_label(frame: FrameType) -> str:
+    code = frame.f_code
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(";", ",")
+
+
+class RequestProfile:
+    """
+    Stack samples of one request.
+
+    A sample is taken every interval from the event loop thread when one of the
+    request's own coroutines is running, and from every worker thread running
+    a call the request handed to the default executor (asyncio.to_thread).
+    Other requests served meanwhile are not sampled. Time the request spends
+    waiting (LLM and Firestore I/O) does not appear: the profile shows where
+    its Python time goes.
+    """
+
+    def __init__(self, name: str, trigger: str, interval: float = PROFILE_INTERVAL):
+        self.id = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.name = name
+        self.trigger = trigger
+        self.interval = interval
+        self.meta: Dict[str, Any] = {}
+        self.samples: Counter = Counter()
+        self.started_at = time.time()
+        self.seconds = 0.0
+        # Frames of the request's coroutines (the middleware and every task it started)
+        self._frames: Set[FrameType] = set()
+        # Worker threads currently running a call for the request
+        self._threads: Set[int] = set()
+        self._loop_thread = threading.get_ident()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_loop, name=f"profiler-{self.id}", daemon=True)
+
+    def add_frame(self, frame: Optional[FrameType]) -> None:
+        if frame is not None:
+            self._frames.add(frame)
+
+    def wrap_call(self, fn: Callable[..., Any]) -> Callable[..., Any]:
+        """Wrap a call submitted to the executor so its worker thread is sampled while it runs."""
+        def profiled_call(*args: Any, **kwargs: Any) -> Any:
+            thread = threading.get_ident()
+            self._threads.add(thread)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._threads.discard(thread)
+        return profiled_call
+
+    def start(self) -> None:
+        self._sampler.start()
+
+    def stop(self) -> None:
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._sampler.join()
+        self.seconds = time.time() - self.started_at
+
+    def _loop_stack(self, frame: Optional[FrameType]) -> Optional[List[str]]:
+        """The loop thread's stack from the request's outermost coroutine down, or None if it is not running one."""
+        stack: List[str] = []
+        outermost = -1
+        while frame is not None:
+            stack.append(_frame_label(frame))
+            if frame in self._frames:
+                outermost = len(stack)
+            frame = frame.f_back
+        if outermost < 0:
+            return None
+        return stack[:outermost][::-1]
+
+    @staticmethod
+    def _thread_stack(frame: Optional[FrameType]) -> List[str]:
+        """A worker thread's stack from the submitted call down."""
+        stack: List[str] = []
+        while frame is not None and not (frame.f_code.co_name == "profiled_call" and frame.f_code.co_filename == __file__):
+            stack.append(_frame_label(frame))
+            frame = frame.f_back
+        return stack[::-1]
+
+    def _sample_loop(self) -> None:
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            stack = self._loop_stack(frames.get(self._loop_thread))
+            if stack:
+                self.samples["loop;" + ";".join(stack)] += 1
+            for thread in list(self._threads):
+                stack = self._thread_stack(frames.get(thread))
+                if stack:
+                    self.samples["thread;" + ";".join(stack)] += 1
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            "id": self.id,
+            "name": self.name,
+            "trigger": self.trigger,
+            "startedAt": datetime.fromtimestamp(self.started_at, timezone.utc).isoformat(),
+            "seconds": round(self.seconds, 3),
+            "samples": sum(self.samples.values()),
+            "intervalSeconds": self.interval,
+            **self.meta,
+        }
+
+    def save(self, directory: str = PROFILE_DIR) -> None:
+        """
+        Write the profile as <id>.collapsed (one "frame;frame;... count" line per stack,
+        the input of flamegraph.pl and speedscope) with its summary in <id>.json.
+        """
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f"{self.id}.collapsed"), "w", encoding="utf-8") as stacks_file:
+            for stack, count in self.samples.most_common():
+                stacks_file.write(f"{stack} {count}\n")
+        with open(os.path.join(directory, f"{self.id}.json"), "w", encoding="utf-8") as summary_file:
+            json.dump(self.summary(), summary_file)
+        _prune(directory)
+
+
+def _prune(directory: str) -> None:
+    """Delete the oldest profiles beyond PROFILE_MAX_FILES."""
+    summaries = sorted(Path(directory).glob("*.json"))
+    for summary_path in summaries[:max(0, len(summaries) - PROFILE_MAX_FILES)]:
+        summary_path.unlink(missing_ok=True)
+        summary_path.with_suffix(".collapsed").unlink(missing_ok=True)
+
+
+@contextmanager
+def profile_scope(name: str, trigger: str, root: Optional[FrameType] = None) -> Iterator[RequestProfile]:
+    """
+    Profile the enclosed request.
+
+    Args:
+        name: What is profiled (e.g. the request path)
+        trigger: Why ("header" or "sampled")
+        root: Frame of the coroutine serving the request; tasks it starts are added by the task factory
+
+    Yields:
+        The profile; the caller saves it
+    """
+    profile = RequestProfile(name, trigger)
+    profile.add_frame(root)
+    token = _active.set(profile)
+    profile.start()
+    try:
+        yield profile
+    finally:
+        profile.stop()
+        _active.reset(token)
+        metrics.increment("profiling.profiles", trigger=trigger)
+
+
+def annotate(**fields: Any) -> None:
+    """Add fields (e.g. action, storyId) to the summary of the request's profile, if it is being profiled."""
+    profile = _active.get()
+    if profile is not None:
+        profile.meta.update(fields)
+
+
+def _task_factory(loop: asyncio.AbstractEventLoop, coro: Any, **kwargs: Any) -> asyncio.Task:
+    # Newer Pythons pass name= and eager_start= here as well as context=
+    task = asyncio.Task(coro, loop=loop, **kwargs)
+    context = kwargs.get("context")
+    profile = context.get(_active) if context is not None else _active.get()
+    if profile is not None:
+        profile.add_frame(getattr(coro, "cr_frame", None))
+    return task
+
+
+class ProfilingExecutor(ThreadPoolExecutor):
+    """Default executor that lets a profiled request's sampler follow its calls into worker threads."""
+
+    def submit(self, fn: Callable[..., Any], /, *args: Any, **kwargs: Any):
+        profile = _active.get()
+        if profile is not None:
+            fn = profile.wrap_call(fn)
+        return super().submit(fn, *args, **kwargs)
+
+
+def install(loop: asyncio.AbstractEventLoop) -> None:
+    """
+    Let profiles follow requests into the tasks and threads they start.
+
+    Does nothing unless profiling is enabled, so unprofiled servers pay nothing.
+    """
+    if not enabled():
+        return
+    loop.set_task_factory(_task_factory)
+    loop.set_default_executor(ProfilingExecutor(thread_name_prefix="asyncio"))
+
+
+def list_profiles(directory: str = PROFILE_DIR) -> List[Dict[str, Any]]:
+    """Summaries of the stored profiles, newest first."""
+    summaries = []
+    for summary_path in sorted(Path(directory).glob("*.json"), reverse=True):
+        try:
+            summaries.append(json.loads(summary_path.read_text(encoding="utf-8")))
+        except (OSError, ValueError):
+            # Deleted or half-written while listing
+            continue
+    return summaries
+
+
+def read_profile(profile_id: str, directory: str = PROFILE_DIR) -> Optional[str]:
+    """Collapsed stacks of a stored profile, or None if there is no such profile."""
+    if not profile_id.replace("-", "").isalnum():
+        return None
+    path = Path(directory) / f"{profile_id}.collapsed"
+    if not path.exists():
+        return None
+    return path.read_text(encoding="utf-8")
+
+
+class ProfilingMiddleware:
+    """
+    ASGI middleware that profiles agent requests picked by should_profile.
+
+    Runs in the same task as request parsing, validation, the endpoint and
+    response encoding, so all of them are covered. The profile ID is returned
+    in the X-Profile-Id response header.
+    """
+
+    def __init__(self, app: Any, path_prefix: str = "/agent/execute"):
+        self.app = app
+        self.path_prefix = path_prefix
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if scope["type"] != "http" or not enabled() or not scope["path"].startswith(self.path_prefix):
+            await self.app(scope, receive, send)
+            return
+        headers = {name.decode("latin-1"): value.decode("latin-1") for name, value in scope["headers"]}
+        trigger = should_profile(headers)
+        if trigger is None:
+            await self.app(scope, receive, send)
+            return
+
+        with profile_scope(scope["path"], trigger, sys._getframe()) as profile:
+            async def send_with_id(message: Dict[str, Any]) -> None:
+                if message["type"] == "http.response.start":
+                    message = {**message, "headers": [*message.get("headers", []), (b"x-profile-id", profile.id.encode())]}
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_id)
+            finally:
+                profile.stop()
+                await asyncio.to_thread(profile.save)
+                print(f"[PROFILE] {profile.name} profiled ({profile.trigger}): {profile.id}, {sum(profile.samples.values())} samples")
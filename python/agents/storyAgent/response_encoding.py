@@ -0,0 +1,118 @@
+"""Fast JSON encoding and negotiated compression for agent responses."""
+import gzip
+import json
+import os
+from typing import Any, Dict, Optional, Tuple
+
+from starlette.responses import Response
+
+# Optional speedups: orjson for encoding, brotli for "br" compression
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Bodies smaller than this are sent uncompressed (bytes)
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "5"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+
+
+def encode_json(payload: Any) -> bytes:
+    """
+    Serialize a payload to compact UTF-8 JSON.
+
+    Uses orjson when installed and falls back to the standard library.
+    Values JSON cannot represent (e.g. Firestore timestamps) are converted with str().
+
+    Args:
+        payload: JSON-like value to serialize
+
+    Returns:
+        Encoded JSON bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(payload, default=str, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str).encode("utf-8")
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """
+    Pick the best supported content encoding from an Accept-Encoding header.
+
+    Args:
+        accept_encoding: Raw Accept-Encoding header value
+
+    Returns:
+        "br", "gzip" or None for identity
+    """
+    if not accept_encoding:
+        return None
+
+    accepted = {}
+    for item in accept_encoding.split(","):
+        token, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[token.strip().lower()] = quality
+
+    wildcard = accepted.get("*", 0.0)
+    if brotli is not None and accepted.get("br", wildcard) > 0:
+        return "br"
+    if accepted.get("gzip", wildcard) > 0:
+        return "gzip"
+    return None
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """Compress a body with the given content encoding ("br" or "gzip")."""
+    if encoding == "br":
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def encode_body(payload: Any, accept_encoding: Optional[str]) -> Tuple[bytes, Optional[str]]:
+    """
+    Encode a payload as JSON and compress it if the client accepts it and it is large enough.
+
+    Args:
+        payload: JSON-like value to serialize
+        accept_encoding: Raw Accept-Encoding header value
+
+    Returns:
+        Tuple of (body bytes, content encoding or None)
+    """
+    body = encode_json(payload)
+    encoding = choose_encoding(accept_encoding) if len(body) >= COMPRESSION_MIN_SIZE else None
+    if encoding:
+        body = compress(body, encoding)
+    return body, encoding
+
+
+def json_response(payload: Any, accept_encoding: Optional[str] = None, status_code: int = 200) -> Response:
+    """
+    Build a JSON response using the fast encoder and negotiated compression.
+
+    Args:
+        payload: JSON-like value to send
+        accept_encoding: Raw Accept-Encoding header of the request
+        status_code: HTTP status code
+
+    Returns:
+        Starlette Response
+    """
+    body, encoding = encode_body(payload, accept_encoding)
+    headers: Dict[str, str] = {"Vary": "Accept-Encoding"}
+    if encoding:
+        headers["Content-Encoding"] = encoding
+    return Response(content=body, status_code=status_code, media_type="application/json", headers=headers)
@@ -0,0 +1,415 @@
+"""Fair scheduling of agent requests between users, with token-bucket quotas."""
+import asyncio
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import AsyncIterator, Deque, Dict, Optional, Set, Tuple
+
+# Handle imports for both direct execution and module import
+try:
+    from .cache import get_cache
+    from .deadline import DeadlineExceeded, remaining
+    from .metrics import metrics
+    from .usage import usage_scope
+except ImportError:
+    # Add parent directory to path for direct execution
+    current_dir = Path(__file__).parent
+    parent_dir = current_dir.parent.parent
+    if str(parent_dir) not in sys.path:
+        sys.path.insert(0, str(parent_dir))
+    from agents.storyAgent.cache import get_cache
+    from agents.storyAgent.deadline import DeadlineExceeded, remaining
+    from agents.storyAgent.metrics import metrics
+    from agents.storyAgent.usage import usage_scope
+
+# Agent requests running at once per worker; later ones wait in the fair queue (0 disables queueing)
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "8"))
+# Of those, slots only interactive actions (INTERACTIVE_ACTIONS) may use, so long generations cannot take them all
+SCHEDULER_INTERACTIVE_RESERVED = int(os.getenv("SCHEDULER_INTERACTIVE_RESERVED", "2"))
+# Agent requests one tenant may have running at once per worker (0: no limit beyond SCHEDULER_CONCURRENCY)
+SCHEDULER_TENANT_CONCURRENCY = int(os.getenv("SCHEDULER_TENANT_CONCURRENCY", "3"))
+# Estimated LLM tokens a user can spend in a burst before their requests lose priority
+SCHEDULER_BUCKET_SIZE = float(os.getenv("SCHEDULER_BUCKET_SIZE", "60000"))
+# Estimated LLM tokens added back to every user's bucket per second
+SCHEDULER_REFILL_RATE = float(os.getenv("SCHEDULER_REFILL_RATE", "500"))
+# Keep bucket levels in the shared cache (CACHE_BACKEND=sqlite/redis) so all workers charge one quota
+SCHEDULER_SHARED_BUCKETS = os.getenv("SCHEDULER_SHARED_BUCKETS", "false").lower() == "true"
+# Buckets kept in memory (least recently used evicted first; an evicted bucket starts full again)
+SCHEDULER_MAX_BUCKETS = int(os.getenv("SCHEDULER_MAX_BUCKETS", "10000"))
+# How often this worker's charges are written to, and levels re-read from, the shared buckets (seconds)
+SCHEDULER_BUCKET_SYNC_INTERVAL = float(os.getenv("SCHEDULER_BUCKET_SYNC_INTERVAL", "1"))
+
+# Starting estimates of the LLM tokens (input + output) one request uses; replaced
+# by a moving average of the usage measured for each action
+DEFAULT_ACTION_COSTS = {
+    "generateNextLines": 1500.0,
+    "prefetchContext": 0.0,
+    "brainstormIdeas": 2500.0,
+    "brainstormCharacter": 2000.0,
+    "brainstormPlot": 2000.0,
+    "generateChapter": 12000.0,
+    "generateStory": 60000.0,
+}
+# Weight of the newest measurement in the moving average
+COST_SMOOTHING = 0.2
+# Actions an author is waiting on in the editor; they may use the reserved slots
+INTERACTIVE_ACTIONS = {"generateNextLines", "prefetchContext"}
+
+
+class ActionCostEstimator:
+    """Expected LLM tokens per action, learned from measured usage."""
+
+    def __init__(self, defaults: Dict[str, float] = DEFAULT_ACTION_COSTS, smoothing: float = COST_SMOOTHING):
+        self.smoothing = smoothing
+        self._costs = dict(defaults)
+        self._lock = threading.Lock()
+
+    def estimate(self, action: str) -> float:
+        with self._lock:
+            return self._costs.get(action, 2000.0)
+
+    def observe(self, action: str, tokens: float) -> None:
+        with self._lock:
+            current = self._costs.get(action)
+            self._costs[action] = tokens if current is None else current + self.smoothing * (tokens - current)
+
+
+class BucketStore:
+    """
+    Token bucket levels per tenant, kept in this process.
+
+    A bucket holds up to size tokens and refills at refill_rate tokens per
+    second. Charges may take it below zero; the tenant is then over quota until
+    it refills.
+    """
+
+    def __init__(self, size: float, refill_rate: float, max_buckets: int = SCHEDULER_MAX_BUCKETS):
+        self.size = size
+        self.refill_rate = refill_rate
+        self.max_buckets = max_buckets
+        self._buckets: "OrderedDict[str, Tuple[float, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _refilled(self, state: Optional[Tuple[float, float]], now: float) -> float:
+        if state is None:
+            return self.size
+        level, updated_at = state
+        return min(self.size, level + (now - updated_at) * self.refill_rate)
+
+    def _load(self, tenant: str) -> Optional[Tuple[float, float]]:
+        return self._buckets.get(tenant)
+
+    def _store(self, tenant: str, state: Tuple[float, float]) -> None:
+        self._buckets[tenant] = state
+        self._buckets.move_to_end(tenant)
+        while len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+
+    def level(self, tenant: str) -> float:
+        """Tokens currently in the tenant's bucket."""
+        with self._lock:
+            return self._refilled(self._load(tenant), time.time())
+
+    def charge(self, tenant: str, tokens: float) -> float:
+        """
+        Take tokens from the tenant's bucket (a negative amount gives them back).
+
+        Returns:
+            The bucket level after the charge
+        """
+        with self._lock:
+            now = time.time()
+            level = min(self.size, self._refilled(self._load(tenant), now) - tokens)
+            self._store(tenant, (level, now))
+            return level
+
+
+class SharedBucketStore(BucketStore):
+    """
+    Bucket levels kept in the shared cache backend, so every worker process charges the same quota.
+
+    Dispatch decisions read an in-process mirror of the levels and never touch
+    the cache backend from the event loop. Charges are applied to the mirror at
+    once and written to the shared buckets in a thread, at most every
+    sync_interval seconds; the same sync re-reads the levels of the tenants this
+    worker charged or looked up, picking up other workers' charges.
+
+    Updates are read-modify-write without a cross-process lock: two workers
+    syncing one tenant at the same instant can lose one batch of charges. The
+    quota is a scheduling hint, so that is tolerated.
+    """
+
+    def __init__(
+        self,
+        size: float,
+        refill_rate: float,
+        max_buckets: int = SCHEDULER_MAX_BUCKETS,
+        sync_interval: float = SCHEDULER_BUCKET_SYNC_INTERVAL,
+    ):
+        super().__init__(size, refill_rate, max_buckets)
+        self.sync_interval = sync_interval
+        # Tokens charged here and not yet written to the shared buckets
+        self._pending: Dict[str, float] = {}
+        # Tenants looked up since the last sync, whose shared level is re-read
+        self._seen: Set[str] = set()
+        self._sync_task: Optional[asyncio.Task] = None
+
+    def level(self, tenant: str) -> float:
+        with self._lock:
+            self._seen.add(tenant)
+        self._schedule_sync()
+        return super().level(tenant)
+
+    def charge(self, tenant: str, tokens: float) -> float:
+        level = super().charge(tenant, tokens)
+        with self._lock:
+            self._pending[tenant] = self._pending.get(tenant, 0.0) + tokens
+        self._schedule_sync()
+        return level
+
+    def _schedule_sync(self) -> None:
+        if self._sync_task is not None and not self._sync_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # Not on the event loop: the next charge or lookup on it syncs
+            return
+        self._sync_task = loop.create_task(self._sync_later())
+
+    async def _sync_later(self) -> None:
+        await asyncio.sleep(self.sync_interval)
+        try:
+            await asyncio.to_thread(self.sync)
+        except Exception as e:
+            # Keep scheduling on the local levels until the backend is back
+            metrics.increment("scheduler.bucket_sync_errors")
+            print(f"[SCHEDULER] Shared bucket sync failed: {e}")
+
+    def sync(self) -> None:
+        """Write pending charges to the shared buckets and refresh the mirror from them. Blocks: run it in a thread."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            tenants = set(pending) | self._seen
+            self._seen = set()
+        for tenant in tenants:
+            key = f"scheduler_bucket:{tenant}"
+            now = time.time()
+            level = self._refilled(get_cache().get(key), now)
+            if tenant in pending:
+                level = min(self.size, level - pending[tenant])
+                # Once the bucket would be full again the entry can expire: a missing bucket is a full one
+                ttl = (self.size - level) / self.refill_rate if self.refill_rate > 0 else 86400
+                get_cache().set(key, (level, now), max(1.0, ttl))
+            with self._lock:
+                # Charges made here while syncing are not in the shared level yet
+                self._store(tenant, (min(self.size, level - self._pending.get(tenant, 0.0)), now))
+
+
+@dataclass
+class _Ticket:
+    tenant: str
+    action: str
+    cost: float
+    start_tag: float
+    admitted: asyncio.Future
+    enqueued_at: float = field(default_factory=time.monotonic)
+    over_quota: bool = False
+
+
+class FairScheduler:
+    """
+    Admits agent requests so that every tenant (user, or story when the user is unknown) gets a fair share.
+
+    At most `concurrency` requests run at once, at most `tenant_concurrency` of
+    them for one tenant, and `interactive_reserved` of the slots are kept for
+    interactive actions, so a user starting several story generations cannot
+    hold every slot while other authors wait for next-line suggestions. Waiting requests are ordered by
+    start-time fair queuing: each tenant's requests get increasing virtual start
+    tags, advanced by their estimated token cost, so a tenant with a long queue
+    of expensive requests does not hold back one that sends a cheap request now.
+    Tenants whose token bucket does not cover their next request are served only
+    when no tenant within quota is waiting, so capacity never sits idle.
+
+    Each request is charged its estimated cost when admitted and corrected to its
+    measured usage when it finishes.
+    """
+
+    def __init__(
+        self,
+        concurrency: int = SCHEDULER_CONCURRENCY,
+        interactive_reserved: int = SCHEDULER_INTERACTIVE_RESERVED,
+        tenant_concurrency: int = SCHEDULER_TENANT_CONCURRENCY,
+        buckets: Optional[BucketStore] = None,
+        costs: Optional[ActionCostEstimator] = None,
+    ):
+        self.concurrency = concurrency
+        # Slots other actions may use; at least one, so they always make progress
+        self.heavy_concurrency = max(1, concurrency - interactive_reserved)
+        self.tenant_concurrency = tenant_concurrency
+        if buckets is None:
+            store = SharedBucketStore if SCHEDULER_SHARED_BUCKETS else BucketStore
+            buckets = store(SCHEDULER_BUCKET_SIZE, SCHEDULER_REFILL_RATE)
+        self.buckets = buckets
+        self.costs = costs or ActionCostEstimator()
+        self._running = 0
+        self._running_heavy = 0
+        self._running_by_tenant: Dict[str, int] = {}
+        self._queued = 0
+        self._waiting: Dict[str, Deque[_Ticket]] = {}
+        # Virtual finish tag of each tenant's last queued request
+        self._last_finish: Dict[str, float] = {}
+        self._virtual_time = 0.0
+
+    @asynccontextmanager
+    async def admit(self, tenant: str, action: str) -> AsyncIterator[None]:
+        """
+        Wait for the tenant's turn, then run the enclosed code.
+
+        Time spent waiting counts against the current deadline: a request still
+        queued when it passes, or whose caller is cancelled, leaves the queue.
+
+        Args:
+            tenant: User ID, or story ID when the user is unknown
+            action: Agent action, used to estimate the request's cost
+
+        Raises:
+            DeadlineExceeded: If the deadline passes while the request is queued
+        """
+        if self.concurrency <= 0:
+            yield
+            return
+
+        ticket = self._enqueue(tenant, action)
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(ticket.admitted), remaining())
+        except (asyncio.CancelledError, asyncio.TimeoutError) as error:
+            if ticket.admitted.done():
+                # Admitted just as the caller gave up: hand the slot on
+                self._finish(ticket, ticket.cost)
+            else:
+                self._remove(ticket)
+            if isinstance(error, asyncio.TimeoutError):
+                metrics.increment("scheduler.expired", action=action)
+                raise DeadlineExceeded(f"Deadline exceeded while queued behind other requests ({action})") from error
+            raise
+
+        wait = time.monotonic() - ticket.enqueued_at
+        metrics.observe(
+            "scheduler.queue_wait_seconds", wait, action=action, quota="over" if ticket.over_quota else "within"
+        )
+        with usage_scope(action) as usage:
+            try:
+                yield
+            finally:
+                summary = usage.summary()
+                used = summary["inputTokens"] + summary["outputTokens"]
+                if summary["calls"]:
+                    self.costs.observe(action, used)
+                self._finish(ticket, used if summary["calls"] else ticket.cost)
+
+    def _enqueue(self, tenant: str, action: str) -> _Ticket:
+        cost = self.costs.estimate(action)
+        start_tag = max(self._virtual_time, self._last_finish.get(tenant, 0.0))
+        self._last_finish[tenant] = start_tag + cost
+        ticket = _Ticket(tenant, action, cost, start_tag, asyncio.get_running_loop().create_future())
+        self._waiting.setdefault(tenant, deque()).append(ticket)
+        self._queued += 1
+        metrics.set_gauge("scheduler.queued", self._queued)
+        return ticket
+
+    def _remove(self, ticket: _Ticket) -> None:
+        queue = self._waiting.get(ticket.tenant)
+        if queue is None or ticket not in queue:
+            return
+        queue.remove(ticket)
+        if not queue:
+            del self._waiting[ticket.tenant]
+        self._queued -= 1
+        metrics.set_gauge("scheduler.queued", self._queued)
+        metrics.increment("scheduler.abandoned", action=ticket.action)
+
+    def _can_start(self, ticket: _Ticket) -> bool:
+        """Whether the ticket fits its tenant's limit and, for other than interactive actions, the shared slots."""
+        if self.tenant_concurrency > 0 and self._running_by_tenant.get(ticket.tenant, 0) >= self.tenant_concurrency:
+            return False
+        return ticket.action in INTERACTIVE_ACTIONS or self._running_heavy < self.heavy_concurrency
+
+    def _next_ticket(self) -> Optional[_Ticket]:
+        """
+        Startable ticket with the lowest start tag, preferring tenants within quota.
+
+        Each tenant offers its oldest ticket that can start now, so an
+        interactive request is not held back by its own tenant's queued
+        generation. None if nothing waiting can start.
+        """
+        candidates = []
+        for queue in self._waiting.values():
+            ticket = next((ticket for ticket in queue if self._can_start(ticket)), None)
+            if ticket is not None:
+                candidates.append(ticket)
+        if not candidates:
+            return None
+        within_quota = [ticket for ticket in candidates if self.buckets.level(ticket.tenant) >= ticket.cost]
+        if within_quota:
+            return min(within_quota, key=lambda ticket: ticket.start_tag)
+        ticket = min(candidates, key=lambda ticket: ticket.start_tag)
+        ticket.over_quota = True
+        return ticket
+
+    def _dispatch(self) -> None:
+        while self._running < self.concurrency and self._waiting:
+            ticket = self._next_ticket()
+            if ticket is None:
+                break
+            queue = self._waiting[ticket.tenant]
+            queue.remove(ticket)
+            if not queue:
+                del self._waiting[ticket.tenant]
+            self._queued -= 1
+            self._running += 1
+            self._running_by_tenant[ticket.tenant] = self._running_by_tenant.get(ticket.tenant, 0) + 1
+            if ticket.action not in INTERACTIVE_ACTIONS:
+                self._running_heavy += 1
+            self._virtual_time = max(self._virtual_time, ticket.start_tag)
+            self.buckets.charge(ticket.tenant, ticket.cost)
+            if ticket.over_quota:
+                metrics.increment("scheduler.over_quota", action=ticket.action)
+            ticket.admitted.set_result(None)
+        metrics.set_gauge("scheduler.queued", self._queued)
+        metrics.set_gauge("scheduler.running", self._running)
+
+    def _finish(self, ticket: _Ticket, used: float) -> None:
+        """Release the ticket's slot and correct its charge to the tokens actually used."""
+        self._running -= 1
+        running = self._running_by_tenant.get(ticket.tenant, 1) - 1
+        if running:
+            self._running_by_tenant[ticket.tenant] = running
+        else:
+            self._running_by_tenant.pop(ticket.tenant, None)
+        if ticket.action not in INTERACTIVE_ACTIONS:
+            self._running_heavy -= 1
+        if used != ticket.cost:
+            self.buckets.charge(ticket.tenant, used - ticket.cost)
+        if ticket.tenant not in self._waiting and self._last_finish.get(ticket.tenant, 0.0) <= self._virtual_time:
+            self._last_finish.pop(ticket.tenant, None)
+        self._dispatch()
+
+    def snapshot(self) -> Dict[str, int]:
+        """Queue state for /metrics."""
+        return {
+            "running": self._running,
+            "runningNonInteractive": self._running_heavy,
+            "queued": self._queued,
+            "waitingTenants": len(self._waiting),
+        }
+
+
+# Process-wide scheduler
+scheduler = FairScheduler()
@@ -1,10 +1,13 @@
 """HTTP server for the story agent service."""
+import asyncio
 import os
 import sys
 import logging
+from contextlib import asynccontextmanager
 from pathlib import Path
-from typing import Dict, Any
-from fastapi import FastAPI, HTTPException
+from typing import Dict, Any, Awaitable, Callable, Optional
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from dotenv import load_dotenv
@@ -28,12 +31,87 @@ if str(parent_dir) not in sys.path:
 
 try:
     # Try relative import first (when used as module)
+    from .affinity import AffinityRouter, story_affinity
     from .agent import StoryAgent
+    from .batch_runner import load_export
+    from .circuit_breaker import circuit_breakers
+    from .context_builder import preload_story_contexts
+    from .context_snapshot import context_snapshot
+    from .deadline import DeadlineExceeded, deadline_scope
+    from .editor_session import EditorSession
+    from .loop_watchdog import LOOP_LAG_INTERVAL, loop_watchdog
+    from .metrics import metrics
+    from .profiling import (
+        ProfilingMiddleware,
+        annotate as annotate_profile,
+        install as install_profiling,
+        is_admin,
+        list_profiles,
+        read_profile,
+    )
+    from .response_encoding import encode_json, json_response
+    from .scheduler import scheduler
+    from .traffic_recorder import TrafficRecorder
+    from .usage import story_usage, usage_scope
 except ImportError:
     # Fall back to absolute import (when run directly)
+    from agents.storyAgent.affinity import AffinityRouter, story_affinity
     from agents.storyAgent.agent import StoryAgent
+    from agents.storyAgent.batch_runner import load_export
+    from agents.storyAgent.circuit_breaker import circuit_breakers
+    from agents.storyAgent.context_builder import preload_story_contexts
+    from agents.storyAgent.context_snapshot import context_snapshot
+    from agents.storyAgent.deadline import DeadlineExceeded, deadline_scope
+    from agents.storyAgent.editor_session import EditorSession
+    from agents.storyAgent.loop_watchdog import LOOP_LAG_INTERVAL, loop_watchdog
+    from agents.storyAgent.metrics import metrics
+    from agents.storyAgent.profiling import (
+        ProfilingMiddleware,
+        annotate as annotate_profile,
+        install as install_profiling,
+        is_admin,
+        list_profiles,
+        read_profile,
+    )
+    from agents.storyAgent.response_encoding import encode_json, json_response
+    from agents.storyAgent.scheduler import scheduler
+    from agents.storyAgent.traffic_recorder import TrafficRecorder
+    from agents.storyAgent.usage import story_usage, usage_scope
 
-app = FastAPI(title="Story Agent Service")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Warm up the LLM provider in the background on startup and keep it warm while idle.
+
+    Also starts the event loop watchdog, which reports loop lag and the stack of
+    any call that blocks the loop, and loads PRELOAD_EXPORT if set. With
+    CONTEXT_SNAPSHOT_PATH set, restores the story context snapshot on startup,
+    saves it periodically and once more on shutdown.
+    """
+    install_profiling(asyncio.get_running_loop())
+    if PRELOAD_EXPORT:
+        contexts = await asyncio.to_thread(load_export, PRELOAD_EXPORT)
+        preload_story_contexts(contexts)
+        print(f"[SERVER] Serving {len(contexts)} stories from {PRELOAD_EXPORT} instead of Firestore")
+    tasks = []
+    if context_snapshot.enabled:
+        await asyncio.to_thread(context_snapshot.load)
+        tasks.append(asyncio.create_task(context_snapshot.run()))
+    if LOOP_LAG_INTERVAL > 0:
+        tasks.append(asyncio.create_task(loop_watchdog.run()))
+    if os.getenv("WARM_UP_PROVIDER", "true").lower() == "true":
+        provider = agent.llm_provider
+        tasks.append(asyncio.create_task(provider.warm_up()))
+        tasks.append(asyncio.create_task(provider.keep_warm()))
+    yield
+    for task in tasks:
+        task.cancel()
+    await story_affinity.aclose()
+    if context_snapshot.enabled:
+        await context_snapshot.save_in_thread()
+
+
+app = FastAPI(title="Story Agent Service", lifespan=lifespan)
 
 # CORS middleware
 app.add_middleware(
@@ -43,11 +121,20 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Profiles requests that ask for it (X-Profile with the admin token) or are sampled
+app.add_middleware(ProfilingMiddleware)
+# Records request shapes to TRACE_FILE for load replay (see benchmarks/replay_benchmark.py)
+app.add_middleware(TrafficRecorder)
+# Outermost: forwards agent requests to the instance owning their story, when AFFINITY_PEERS is set
+app.add_middleware(AffinityRouter)
 
 # Initialize agent
 PROJECT_ID = os.getenv("GOOGLE_CLOUD_PROJECT")
 LOCATION = os.getenv("VERTEX_AI_LOCATION", "us-central1")  # Not used (legacy parameter, kept for compatibility)
 
+# Dataset written by export-prod-data.ts, served instead of Firestore (load tests, replays)
+PRELOAD_EXPORT = os.getenv("PRELOAD_EXPORT", "")
+
 if not PROJECT_ID:
     raise ValueError("GOOGLE_CLOUD_PROJECT environment variable must be set")
 
@@ -58,6 +145,10 @@ class AgentRequest(BaseModel):
     """Request model for agent execution."""
     action: str
     parameters: Dict[str, Any]
+    # Set to false to drop the duplicated "rawResponse" text from brainstorming results
+    includeRawResponse: bool = True
+    # Set to true to get the token usage of the provider calls made for this request
+    includeUsage: bool = False
 
 
 class AgentResponse(BaseModel):
@@ -65,13 +156,93 @@ class AgentResponse(BaseModel):
     success: bool
     data: Any = None
     error: str = None
+    usage: Optional[Dict[str, Any]] = None
+
+
+# How often a running request checks whether its client has gone away (seconds)
+DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", "0.5"))
+
+
+def _request_timeout(http_request: Request) -> Optional[float]:
+    """Time budget in seconds from the X-Deadline-Ms header (milliseconds left), or None."""
+    header = http_request.headers.get("x-deadline-ms")
+    if not header:
+        return None
+    try:
+        return max(0.0, float(header) / 1000)
+    except ValueError:
+        logger.warning(f"Ignoring invalid X-Deadline-Ms header: {header!r}")
+        return None
+
+
+async def _run_while_connected(work: Awaitable[Any], http_request: Request, timeout: Optional[float]) -> Any:
+    """
+    Await work, cancelling it if the client disconnects or the timeout passes.
+
+    Args:
+        work: Coroutine doing the request's work
+        http_request: Incoming request, polled for disconnects
+        timeout: Seconds before giving up, or None to wait as long as the client does
+
+    Returns:
+        The result of work
+
+    Raises:
+        DeadlineExceeded: If the timeout passes first
+        asyncio.CancelledError: If the client disconnects first
+    """
+    task = asyncio.ensure_future(work)
+
+    async def watch_disconnect():
+        while not task.done():
+            if await http_request.is_disconnected():
+                metrics.increment("requests.client_disconnects")
+                print("[SERVER] Client disconnected; cancelling request")
+                task.cancel()
+                return
+            await asyncio.sleep(DISCONNECT_POLL_INTERVAL)
+
+    watcher = asyncio.create_task(watch_disconnect())
+    try:
+        return await asyncio.wait_for(task, timeout)
+    except asyncio.TimeoutError as e:
+        raise DeadlineExceeded(f"Request deadline of {timeout:.1f}s exceeded") from e
+    finally:
+        watcher.cancel()
+
+
+def _tenant(headers: Any, story_id: Optional[str]) -> str:
+    """Who a request is scheduled for: the X-User-Id header, else the story."""
+    return headers.get("x-user-id") or story_id or "anonymous"
+
+
+async def _execute_scheduled(
+    request: AgentRequest,
+    http_request: Request,
+    timeout: Optional[float],
+    on_progress: Optional[Callable[[Dict[str, Any]], None]] = None,
+) -> Any:
+    """Run the action once the fair scheduler admits it. Time spent queued counts against the deadline."""
+    with deadline_scope(timeout):
+        async with scheduler.admit(_tenant(http_request.headers, request.parameters.get("storyId")), request.action):
+            return await agent.execute_agent(request.action, request.parameters, timeout=timeout, on_progress=on_progress)
+
+
+def _strip_raw_response(data: Any) -> Any:
+    """Return the result without its "rawResponse" field."""
+    if isinstance(data, dict) and "rawResponse" in data:
+        return {key: value for key, value in data.items() if key != "rawResponse"}
+    return data
 
 
 @app.post("/agent/execute", response_model=AgentResponse)
-async def execute_agent(request: AgentRequest) -> AgentResponse:
+async def execute_agent(request: AgentRequest, http_request: Request):
     """
     Execute an agent action.
 
+    The response is encoded with the fast JSON encoder and compressed with
+    brotli or gzip when the client's Accept-Encoding allows it.
+
     Actions:
     - generateStory: Generate a complete story
     - generateChapter: Generate a chapter
@@ -79,35 +250,233 @@ async def execute_agent(request: AgentRequest) -> AgentResponse:
     - brainstormCharacter: Generate character ideas
     - brainstormPlot: Generate plot ideas
     - generateNextLines: Generate next line suggestions
+    - prefetchContext: Warm the caches used by next line suggestions for a chapter
+
+    An optional X-Deadline-Ms header gives the milliseconds the caller will
+    wait. Work still running when it expires, or when the client disconnects,
+    is cancelled; an expired deadline returns 504.
+
+    Requests are queued fairly between users (X-User-Id header, else the story)
+    when the worker is busy; see scheduler.py.
+
+    With includeUsage, the response has a "usage" field with the token counts
+    and timings of every provider call made for the request.
+    """
+    timeout = _request_timeout(http_request)
+    annotate_profile(action=request.action, storyId=request.parameters.get("storyId"))
+    with usage_scope(request.action, request.parameters.get("storyId")) as usage:
+        try:
+            logger.info(f"Received agent request: action={request.action}, parameters_keys={list(request.parameters.keys())}")
+            print(f"[SERVER] Received agent request: action={request.action}, parameters_keys={list(request.parameters.keys())}")
+
+            result = await _run_while_connected(
+                _execute_scheduled(request, http_request, timeout),
+                http_request,
+                timeout,
+            )
+            if not request.includeRawResponse:
+                result = _strip_raw_response(result)
+
+            logger.info(f"Agent execution completed successfully for {request.action}")
+            print(f"[SERVER] Agent execution completed successfully for {request.action}")
+            payload = {"success": True, "data": result, "error": None}
+            if request.includeUsage:
+                payload["usage"] = usage.summary()
+            return json_response(payload, http_request.headers.get("accept-encoding"))
+        except DeadlineExceeded as e:
+            metrics.increment("requests.deadline_exceeded", action=request.action)
+            logger.warning(f"Deadline exceeded for agent action {request.action}: {e}")
+            print(f"[SERVER] Deadline exceeded for agent action {request.action}: {e}")
+            payload = {"success": False, "data": None, "error": str(e)}
+            if request.includeUsage:
+                payload["usage"] = usage.summary()
+            return json_response(payload, http_request.headers.get("accept-encoding"), status_code=504)
+        except Exception as e:
+            logger.error(f"Error executing agent action {request.action}: {str(e)}", exc_info=True)
+            print(f"[SERVER ERROR] Error executing agent action {request.action}: {str(e)}")
+            import traceback
+            print(f"[SERVER ERROR] Traceback: {traceback.format_exc()}")
+            payload = {"success": False, "data": None, "error": str(e)}
+            if request.includeUsage:
+                payload["usage"] = usage.summary()
+            return json_response(payload, http_request.headers.get("accept-encoding"))
+
+
+@app.post("/agent/execute/stream")
+async def execute_agent_stream(request: AgentRequest, http_request: Request):
+    """
+    Execute an agent action and stream its progress as newline-delimited JSON.
+
+    Long-running actions (e.g. generateChapter in "scenes" mode) emit
+    {"type": "progress", ...} lines as stages complete. The last line is
+    {"type": "result", "success", "data", "error"} (plus "usage" with
+    includeUsage). If the client disconnects, the action is cancelled.
     """
+    timeout = _request_timeout(http_request)
+    annotate_profile(action=request.action, storyId=request.parameters.get("storyId"))
+    events: asyncio.Queue = asyncio.Queue()
+
+    def on_progress(event: Dict[str, Any]) -> None:
+        events.put_nowait({"type": "progress", **event})
+
+    async def run() -> None:
+        with usage_scope(request.action, request.parameters.get("storyId")) as usage:
+            try:
+                result = await asyncio.wait_for(
+                    _execute_scheduled(request, http_request, timeout, on_progress),
+                    timeout,
+                )
+                if not request.includeRawResponse:
+                    result = _strip_raw_response(result)
+                event = {"type": "result", "success": True, "data": result, "error": None}
+            except (asyncio.TimeoutError, DeadlineExceeded) as e:
+                metrics.increment("requests.deadline_exceeded", action=request.action)
+                event = {"type": "result", "success": False, "data": None, "error": str(e) or "Request deadline exceeded"}
+            except Exception as e:
+                logger.error(f"Error executing agent action {request.action}: {str(e)}", exc_info=True)
+                print(f"[SERVER ERROR] Error executing agent action {request.action}: {str(e)}")
+                event = {"type": "result", "success": False, "data": None, "error": str(e)}
+            if request.includeUsage:
+                event["usage"] = usage.summary()
+            events.put_nowait(event)
+
+    async def stream():
+        task = asyncio.create_task(run())
+        try:
+            while True:
+                event = await events.get()
+                yield encode_json(event) + b"\n"
+                if event["type"] == "result":
+                    break
+        finally:
+            # Also runs when the client disconnects and the response is abandoned
+            task.cancel()
+
+    logger.info(f"Received streaming agent request: action={request.action}")
+    print(f"[SERVER] Received streaming agent request: action={request.action}")
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+# Editor sessions open on this worker
+_active_sessions = 0
+
+
+@app.websocket("/agent/session")
+async def editor_session(websocket: WebSocket, storyId: str, chapterId: Optional[str] = None):
+    """
+    Editor session for next-line suggestions over a WebSocket.
+
+    The story context is loaded once per session; the client streams content,
+    edit and cursor events and receives each suggestion as soon as it is ready.
+    See EditorSession for the message protocol.
+    """
+    global _active_sessions
+    await websocket.accept()
+    session = EditorSession(
+        agent.next_line_tool,
+        storyId,
+        chapterId,
+        websocket.send_json,
+        tenant=_tenant(websocket.headers, storyId),
+    )
+    _active_sessions += 1
+    metrics.increment("session.opened")
+    metrics.set_gauge("session.active", _active_sessions)
+    print(f"[SERVER] Editor session opened: story={storyId}, chapter={chapterId}")
     try:
-        logger.info(f"Received agent request: action={request.action}, parameters_keys={list(request.parameters.keys())}")
-        print(f"[SERVER] Received agent request: action={request.action}, parameters_keys={list(request.parameters.keys())}")
-        
-        result = await agent.execute_agent(request.action, request.parameters)
-        
-        logger.info(f"Agent execution completed successfully for {request.action}")
-        print(f"[SERVER] Agent execution completed successfully for {request.action}")
-        return AgentResponse(success=True, data=result)
+        await session.open()
+        while True:
+            message = await websocket.receive_json()
+            if not isinstance(message, dict):
+                await websocket.send_json({"type": "error", "error": "Messages must be JSON objects"})
+                continue
+            await session.handle(message)
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
-        logger.error(f"Error executing agent action {request.action}: {str(e)}", exc_info=True)
-        print(f"[SERVER ERROR] Error executing agent action {request.action}: {str(e)}")
-        import traceback
-        print(f"[SERVER ERROR] Traceback: {traceback.format_exc()}")
-        return AgentResponse(
-            success=False,
-            error=str(e)
-        )
+        logger.error(f"Editor session error for story {storyId}: {str(e)}", exc_info=True)
+        print(f"[SERVER ERROR] Editor session error for story {storyId}: {str(e)}")
+        try:
+            await websocket.close(code=1011)
+        except RuntimeError:
+            # The socket is already closed
+            pass
+    finally:
+        await session.close()
+        _active_sessions -= 1
+        metrics.set_gauge("session.active", _active_sessions)
+        print(f"[SERVER] Editor session closed: story={storyId}, chapter={chapterId}")
 
 
 @app.get("/health")
 async def health_check():
-    """Health check endpoint."""
-    return {"status": "healthy", "project_id": PROJECT_ID}
+    """Health check endpoint. Reports "degraded" while any LLM circuit is open."""
+    return {
+        "status": "degraded" if circuit_breakers.any_open() else "healthy",
+        "project_id": PROJECT_ID,
+        "circuits": circuit_breakers.snapshot(),
+    }
 
 
-if __name__ == "__main__":
+@app.get("/metrics")
+async def get_metrics():
+    """Metrics snapshot for this worker process."""
+    snapshot = metrics.snapshot()
+    snapshot["circuits"] = circuit_breakers.snapshot()
+    snapshot["storyUsage"] = story_usage.top()
+    snapshot["scheduler"] = scheduler.snapshot()
+    snapshot["eventLoop"] = loop_watchdog.snapshot()
+    snapshot["contextSnapshot"] = context_snapshot.snapshot()
+    snapshot["affinity"] = story_affinity.snapshot()
+    return snapshot
+
+
+def _require_admin(http_request: Request) -> None:
+    """Reject requests without the admin token (X-Admin-Token); 404 when no token is configured."""
+    if not is_admin(http_request.headers.get("x-admin-token")):
+        raise HTTPException(status_code=404, detail="Not found")
+
+
+@app.get("/admin/profiles")
+async def get_profiles(http_request: Request):
+    """Summaries of the request profiles stored on this worker, newest first."""
+    _require_admin(http_request)
+    return {"profiles": await asyncio.to_thread(list_profiles)}
+
+
+@app.get("/admin/profiles/{profile_id}", response_class=PlainTextResponse)
+async def get_profile(profile_id: str, http_request: Request):
+    """One profile as collapsed stacks, ready for flamegraph.pl or speedscope."""
+    _require_admin(http_request)
+    stacks = await asyncio.to_thread(read_profile, profile_id)
+    if stacks is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return PlainTextResponse(stacks)
+
+
+def run_server():
+    """
+    Run the server with uvicorn.
+
+    Environment variables:
+    - PORT: Port to listen on (Cloud Run sets PORT=8080, default to 8000 for local dev)
+    - WORKERS: Number of pre-forked worker processes (default: 1)
+
+    With more than one worker, CACHE_BACKEND defaults to "sqlite" so that all
+    workers share story contexts and suggestions instead of each re-reading Firestore.
+    """
     import uvicorn
-    port = int(os.getenv("PORT", "8000"))  # Cloud Run sets PORT=8080, default to 8000 for local dev
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    port = int(os.getenv("PORT", "8000"))
+    workers = int(os.getenv("WORKERS", "1"))
+
+    if workers > 1:
+        os.environ.setdefault("CACHE_BACKEND", "sqlite")
+        logger.info(f"Starting {workers} workers with CACHE_BACKEND={os.environ['CACHE_BACKEND']}")
+        uvicorn.run("agents.storyAgent.server:app", host="0.0.0.0", port=port, workers=workers)
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=port)
+
+
+if __name__ == "__main__":
+    run_server()
 
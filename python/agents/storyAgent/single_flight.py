@@ -0,0 +1,133 @@
+"""Single-flight deduplication of identical concurrent calls."""
+import asyncio
+import contextvars
+import hashlib
+import json
+import sys
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+# Handle imports for both direct execution and module import
+try:
+    from .deadline import DeadlineExceeded, current_deadline, remaining, set_deadline
+    from .usage import UsageLedger, add_usage, detach_ledger
+except ImportError:
+    # Add parent directory to path for direct execution
+    current_dir = Path(__file__).parent
+    parent_dir = current_dir.parent.parent
+    if str(parent_dir) not in sys.path:
+        sys.path.insert(0, str(parent_dir))
+    from agents.storyAgent.deadline import DeadlineExceeded, current_deadline, remaining, set_deadline
+    from agents.storyAgent.usage import UsageLedger, add_usage, detach_ledger
+
+
+def canonical_key(*parts: Any) -> str:
+    """
+    Build a stable hash for a set of JSON-like values.
+
+    Dict keys are sorted so that parameter order does not matter.
+
+    Args:
+        parts: Values to include in the key
+
+    Returns:
+        Hex digest identifying the values
+    """
+    encoded = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class _Flight:
+    """One shared call and the callers waiting on it."""
+    task: asyncio.Task
+    context: contextvars.Context
+    deadline: Optional[float]
+    ledger: Optional[UsageLedger]
+    waiters: int = 0
+
+    def extend(self, deadline: Optional[float]) -> None:
+        """Let the call run until the later of its deadline and a new caller's (None: no deadline)."""
+        if self.deadline is None or (deadline is not None and deadline <= self.deadline):
+            return
+        self.deadline = deadline
+        # The task is suspended while another task runs, so its context can be entered here
+        self.context.run(set_deadline, deadline)
+
+
+class SingleFlight:
+    """Runs at most one call per key at a time; concurrent callers share its result."""
+
+    def __init__(self):
+        self._inflight: Dict[str, _Flight] = {}
+
+    def in_flight(self) -> int:
+        """Number of calls currently running."""
+        return len(self._inflight)
+
+    def is_in_flight(self, key: str) -> bool:
+        """Whether a call with this key is currently running."""
+        return key in self._inflight
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Run fn, or wait for the already running call with the same key.
+
+        The call runs in its own task, so a caller that is cancelled (for example
+        because its client disconnected) does not cancel the work for the others.
+        Once every caller waiting on a call has been cancelled, the call itself is
+        cancelled so no work is spent on a result nobody will read.
+
+        The call runs until the latest request deadline among its callers (see
+        deadline.py), or without one if any caller has none; each caller still
+        stops waiting at its own deadline. Its token usage (see usage.py) is
+        added to the ledger of every caller that receives its outcome.
+
+        Args:
+            key: Deduplication key
+            fn: Coroutine function to run if no call with this key is in flight
+
+        Returns:
+            The result of the shared call (exceptions are re-raised to every caller)
+
+        Raises:
+            DeadlineExceeded: If the caller's deadline passes before the call finishes
+        """
+        deadline = current_deadline()
+        flight = self._inflight.get(key)
+        if flight is None:
+            context = contextvars.copy_context()
+            ledger = context.run(detach_ledger)
+            task = asyncio.get_running_loop().create_task(fn(), context=context)
+            flight = _Flight(task, context, deadline, ledger)
+            self._inflight[key] = flight
+            task.add_done_callback(lambda t: self._forget(key, t))
+        else:
+            flight.extend(deadline)
+        flight.waiters += 1
+        try:
+            return await asyncio.wait_for(asyncio.shield(flight.task), remaining())
+        except (asyncio.CancelledError, TimeoutError) as error:
+            if flight.task.done():
+                # The call itself failed (or this caller was cancelled as it finished)
+                raise
+            if self._inflight.get(key) is flight and flight.waiters == 1:
+                # Last waiter gone: stop the work and let the next caller start afresh
+                flight.task.cancel()
+                del self._inflight[key]
+            if isinstance(error, asyncio.CancelledError):
+                raise
+            raise DeadlineExceeded("Deadline exceeded waiting for a shared call") from None
+        finally:
+            flight.waiters -= 1
+            if flight.task.done() and flight.ledger is not None:
+                add_usage(flight.ledger.records)
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        """Drop a finished call and mark its exception as retrieved."""
+        flight = self._inflight.get(key)
+        if flight is not None and flight.task is task:
+            del self._inflight[key]
+        if not task.cancelled():
+            task.exception()
@@ -0,0 +1,125 @@
+"""Checkpoints for multi-chapter story generation, so a failed run resumes instead of restarting."""
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+# Handle imports for both direct execution and module import
+try:
+    from .cache import MemoryCache, get_cache
+    from .context_builder import FIRESTORE_TIMEOUT, get_firestore_client
+except ImportError:
+    # Add parent directory to path for direct execution
+    current_dir = Path(__file__).parent
+    parent_dir = current_dir.parent.parent
+    if str(parent_dir) not in sys.path:
+        sys.path.insert(0, str(parent_dir))
+    from agents.storyAgent.cache import MemoryCache, get_cache
+    from agents.storyAgent.context_builder import FIRESTORE_TIMEOUT, get_firestore_client
+
+# How long checkpoints of an unfinished run are kept (seconds)
+STORY_CHECKPOINT_TTL = float(os.getenv("STORY_CHECKPOINT_TTL", "86400"))
+# Where checkpoints are kept: "firestore" (default, survives restarts and is shared by every instance),
+# "cache" (the shared sqlite/redis cache backend) or "memory" (this process only, for local runs)
+STORY_CHECKPOINT_BACKEND = os.getenv("STORY_CHECKPOINT_BACKEND", "firestore").lower()
+# Firestore collection of checkpointed runs (one document per stage under storyRuns/{runId}/parts)
+STORY_CHECKPOINT_COLLECTION = os.getenv("STORY_CHECKPOINT_COLLECTION", "storyRuns")
+
+
+class StoryCheckpointStore:
+    """
+    Keeps the finished stages of a story generation run.
+
+    The plan (outline and chapter briefs) and every finished chapter are stored
+    as separate entries, so saving a chapter never rewrites the others. By
+    default they go to Firestore, where they survive instance restarts and are
+    visible to every instance; each entry has an `expiresAt` field a Firestore
+    TTL policy can delete it by. The "cache" backend uses the shared cache and
+    refuses the in-process memory cache, whose entries would be lost on restart
+    or evicted by suggestion traffic mid-run. Calls block: run them in a thread.
+    """
+
+    def __init__(self, backend: str = STORY_CHECKPOINT_BACKEND, project_id: Optional[str] = None):
+        if backend not in ("firestore", "cache", "memory"):
+            raise ValueError(f"Unknown STORY_CHECKPOINT_BACKEND: {backend}")
+        self.backend = backend
+        self.project_id = project_id
+        self._memory = MemoryCache(max_entries=4096) if backend == "memory" else None
+
+    def _cache(self):
+        if self._memory is not None:
+            return self._memory
+        cache = get_cache()
+        if isinstance(cache, MemoryCache):
+            raise RuntimeError(
+                "STORY_CHECKPOINT_BACKEND=cache needs CACHE_BACKEND=sqlite or redis: "
+                "in-memory checkpoints are lost on restart and evicted by other cache traffic"
+            )
+        return cache
+
+    def _document(self, run_id: str, part: str):
+        return (
+            get_firestore_client(self.project_id)
+            .collection(STORY_CHECKPOINT_COLLECTION)
+            .document(run_id)
+            .collection("parts")
+            .document(part)
+        )
+
+    def _get(self, run_id: str, part: str) -> Optional[Dict[str, Any]]:
+        if self.backend != "firestore":
+            return self._cache().get(f"story_run:{run_id}:{part}")
+        snapshot = self._document(run_id, part).get(timeout=FIRESTORE_TIMEOUT)
+        if not snapshot.exists:
+            return None
+        data = snapshot.to_dict()
+        # A TTL policy deletes expired entries eventually, not at once
+        if data.get("expiresAt") is not None and data["expiresAt"] < datetime.now(timezone.utc):
+            return None
+        return data.get("value")
+
+    def _set(self, run_id: str, part: str, value: Dict[str, Any]) -> None:
+        if self.backend != "firestore":
+            self._cache().set(f"story_run:{run_id}:{part}", value, STORY_CHECKPOINT_TTL)
+            return
+        expires_at = datetime.now(timezone.utc) + timedelta(seconds=STORY_CHECKPOINT_TTL)
+        self._document(run_id, part).set({"value": value, "expiresAt": expires_at}, timeout=FIRESTORE_TIMEOUT)
+
+    def _delete(self, run_id: str, part: str) -> None:
+        if self.backend != "firestore":
+            self._cache().delete(f"story_run:{run_id}:{part}")
+            return
+        self._document(run_id, part).delete(timeout=FIRESTORE_TIMEOUT)
+
+    def get_plan(self, run_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Return the saved plan of a run.
+
+        Returns:
+            Dictionary with "title", "outline" and "briefs", or None
+        """
+        return self._get(run_id, "plan")
+
+    def save_plan(self, run_id: str, plan: Dict[str, Any]) -> None:
+        """Save the plan of a run."""
+        self._set(run_id, "plan", plan)
+
+    def get_chapter(self, run_id: str, index: int) -> Optional[Dict[str, Any]]:
+        """
+        Return a finished chapter of a run.
+
+        Returns:
+            Dictionary with "chapterNumber", "title", "content" and "summary", or None
+        """
+        return self._get(run_id, f"chapter-{index}")
+
+    def save_chapter(self, run_id: str, index: int, chapter: Dict[str, Any]) -> None:
+        """Save a finished chapter of a run."""
+        self._set(run_id, f"chapter-{index}", chapter)
+
+    def clear(self, run_id: str, chapter_count: int) -> None:
+        """Delete every checkpoint of a run."""
+        self._delete(run_id, "plan")
+        for index in range(chapter_count):
+            self._delete(run_id, f"chapter-{index}")
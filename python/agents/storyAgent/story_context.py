@@ -0,0 +1,170 @@
+"""Compact typed representation of a story's context (story, characters, places, plots, chapters)."""
+import sys
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+
+def _label(value: Any) -> Optional[str]:
+    """Short, frequently repeated value (names, genres, roles): interned so equal values share one string."""
+    if value is None or value == "":
+        return None
+    return sys.intern(str(value))
+
+
+def _text(value: Any) -> Optional[str]:
+    """Free text field; lists (e.g. traits) are joined into one string."""
+    if value is None or value == "":
+        return None
+    if isinstance(value, (list, tuple)):
+        return ", ".join(str(item) for item in value) or None
+    return str(value)
+
+
+def _number(value: Any) -> Optional[int]:
+    try:
+        return int(value) if value is not None else None
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass(slots=True)
+class Story:
+    """The story document's prompt-relevant fields."""
+    id: str
+    title: Optional[str] = None
+    genre: Optional[str] = None
+    tone: Optional[str] = None
+    description: Optional[str] = None
+
+    @classmethod
+    def from_document(cls, doc: Dict[str, Any]) -> "Story":
+        return cls(
+            id=_label(doc.get("id")) or "",
+            title=_label(doc.get("title")),
+            genre=_label(doc.get("genre")),
+            tone=_label(doc.get("tone")),
+            description=_text(doc.get("description")),
+        )
+
+
+@dataclass(slots=True)
+class Character:
+    id: str
+    name: Optional[str] = None
+    role: Optional[str] = None
+    backstory: Optional[str] = None
+    traits: Optional[str] = None
+    motivations: Optional[str] = None
+
+    @classmethod
+    def from_document(cls, doc: Dict[str, Any]) -> "Character":
+        return cls(
+            id=_label(doc.get("id")) or "",
+            name=_label(doc.get("name")),
+            role=_label(doc.get("role")),
+            backstory=_text(doc.get("backstory")),
+            traits=_text(doc.get("traits")),
+            motivations=_text(doc.get("motivations")),
+        )
+
+
+@dataclass(slots=True)
+class Place:
+    id: str
+    name: Optional[str] = None
+    description: Optional[str] = None
+    atmosphere: Optional[str] = None
+
+    @classmethod
+    def from_document(cls, doc: Dict[str, Any]) -> "Place":
+        return cls(
+            id=_label(doc.get("id")) or "",
+            name=_label(doc.get("name")),
+            description=_text(doc.get("description")),
+            atmosphere=_text(doc.get("atmosphere")),
+        )
+
+
+@dataclass(slots=True)
+class Plot:
+    id: str
+    title: Optional[str] = None
+    description: Optional[str] = None
+    type: Optional[str] = None
+
+    @classmethod
+    def from_document(cls, doc: Dict[str, Any]) -> "Plot":
+        return cls(
+            id=_label(doc.get("id")) or "",
+            title=_label(doc.get("title")),
+            description=_text(doc.get("description")),
+            type=_label(doc.get("type")),
+        )
+
+
+@dataclass(slots=True)
+class Chapter:
+    id: str
+    chapter_number: Optional[int] = None
+    order: Optional[int] = None
+    title: Optional[str] = None
+    content: str = ""
+
+    @property
+    def number(self) -> Optional[int]:
+        """Chapter number, falling back to the legacy "order" field."""
+        return self.chapter_number or self.order
+
+    @classmethod
+    def from_document(cls, doc: Dict[str, Any]) -> "Chapter":
+        return cls(
+            id=_label(doc.get("id")) or "",
+            chapter_number=_number(doc.get("chapterNumber")),
+            order=_number(doc.get("order")),
+            title=_label(doc.get("title")),
+            content=_text(doc.get("content")) or "",
+        )
+
+
+@dataclass(slots=True)
+class StoryContext:
+    """
+    Everything the prompts need to know about a story.
+
+    Only the fields the prompts use are kept, in slotted records (no per-object
+    dict, so field names are not stored per document), with short repeated values
+    interned. Built once per Firestore read and cached.
+    """
+    story: Story
+    characters: Tuple[Character, ...] = ()
+    places: Tuple[Place, ...] = ()
+    plots: Tuple[Plot, ...] = ()
+    chapters: Tuple[Chapter, ...] = ()
+    # Fingerprint of the Firestore documents it was built from (see context_snapshot.story_version); "" if unknown
+    version: str = ""
+
+    @classmethod
+    def from_documents(
+        cls,
+        story: Dict[str, Any],
+        characters: List[Dict[str, Any]],
+        places: List[Dict[str, Any]],
+        plots: List[Dict[str, Any]],
+        chapters: List[Dict[str, Any]],
+        version: str = "",
+    ) -> "StoryContext":
+        """
+        Build a context from Firestore documents (as returned by to_dict(), plus "id").
+
+        Chapters are sorted by number (chapterNumber, else the legacy "order").
+        """
+        chapter_records = [Chapter.from_document(doc) for doc in chapters]
+        chapter_records.sort(key=lambda chapter: chapter.number or 0)
+        return cls(
+            story=Story.from_document(story),
+            characters=tuple(Character.from_document(doc) for doc in characters),
+            places=tuple(Place.from_document(doc) for doc in places),
+            plots=tuple(Plot.from_document(doc) for doc in plots),
+            chapters=tuple(chapter_records),
+            version=version,
+        )
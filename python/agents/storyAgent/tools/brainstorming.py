@@ -1,4 +1,5 @@
 """Tool for brainstorming ideas."""
+import asyncio
 import sys
 from pathlib import Path
 from typing import Dict, Any, List, Optional
@@ -6,7 +7,7 @@ from typing import Dict, Any, List, Optional
 # Handle imports for both direct execution and module import
 try:
     from ..context_builder import StoryContextBuilder
-    from ..llm_provider import get_llm_provider, LLMProvider
+    from ..llm_provider import get_shared_llm_provider, LLMProvider
 except ImportError:
     # Add parent directory to path for direct execution
     current_dir = Path(__file__).parent.parent
@@ -14,7 +15,7 @@ except ImportError:
     if str(parent_dir) not in sys.path:
         sys.path.insert(0, str(parent_dir))
     from agents.storyAgent.context_builder import StoryContextBuilder
-    from agents.storyAgent.llm_provider import get_llm_provider, LLMProvider
+    from agents.storyAgent.llm_provider import get_shared_llm_provider, LLMProvider
 
 
 class BrainstormingTool:
@@ -24,7 +25,9 @@ class BrainstormingTool:
         """Initialize the brainstorming tool."""
         self.project_id = project_id
         self.location = location
-        self.llm_provider: LLMProvider = get_llm_provider(project_id, location)
+        self.llm_provider: LLMProvider = get_shared_llm_provider(
+            project_id, location, action_class="brainstorm"
+        )
         self.context_builder = StoryContextBuilder(project_id)
 
     async def execute(
@@ -47,12 +50,12 @@ class BrainstormingTool:
             Dictionary with list of generated ideas
         """
         # Build context from Firestore
-        context = self.context_builder.build_story_context(story_id)
+        context = await asyncio.to_thread(self.context_builder.build_story_context, story_id)
         formatted_context = self.context_builder.format_context_for_prompt(context)
 
-        story = context["story"]
-        genre = story.get("genre", "general fiction")
-        tone = story.get("tone", "neutral")
+        story = context.story
+        genre = story.genre or "general fiction"
+        tone = story.tone or "neutral"
 
         # Build type-specific prompt
         type_prompts = {
@@ -106,7 +109,7 @@ For each theme, provide:
             base_prompt += f"\n\nAdditional requirements: {prompt}"
 
         # Generate using LLM provider
-        generated_text = self.llm_provider.generate_content(base_prompt)
+        generated_text = await asyncio.to_thread(self.llm_provider.generate_content, base_prompt)
 
         # Parse ideas (simple extraction - could be improved)
         ideas = self._parse_ideas(generated_text, count)
@@ -1,12 +1,18 @@
 """Tool for generating individual chapters with continuity."""
+import asyncio
+import os
 import sys
+import time
 from pathlib import Path
-from typing import Dict, Any, List, Optional
+from typing import Any, Callable, Dict, List, Optional
 
 # Handle imports for both direct execution and module import
 try:
     from ..context_builder import StoryContextBuilder
-    from ..llm_provider import get_llm_provider, LLMProvider
+    from ..deadline import DeadlineExceeded
+    from ..llm_provider import get_shared_llm_provider, LLMProvider
+    from ..metrics import metrics
+    from ..story_context import Chapter
 except ImportError:
     # Add parent directory to path for direct execution
     current_dir = Path(__file__).parent.parent
@@ -14,7 +20,24 @@ except ImportError:
     if str(parent_dir) not in sys.path:
         sys.path.insert(0, str(parent_dir))
     from agents.storyAgent.context_builder import StoryContextBuilder
-    from agents.storyAgent.llm_provider import get_llm_provider, LLMProvider
+    from agents.storyAgent.deadline import DeadlineExceeded
+    from agents.storyAgent.llm_provider import get_shared_llm_provider, LLMProvider
+    from agents.storyAgent.metrics import metrics
+    from agents.storyAgent.story_context import Chapter
+
+# "single": the whole chapter in one completion
+# "scenes": outline first, then the scenes generated concurrently and stitched together
+CHAPTER_GENERATION_MODE = os.getenv("CHAPTER_GENERATION_MODE", "single")
+# Number of scenes in the outline (scenes mode)
+CHAPTER_SCENE_COUNT = int(os.getenv("CHAPTER_SCENE_COUNT", "4"))
+# Scenes generated at the same time (scenes mode)
+CHAPTER_SCENE_CONCURRENCY = int(os.getenv("CHAPTER_SCENE_CONCURRENCY", "4"))
+# Whether to write short transitions between scenes (scenes mode)
+CHAPTER_SMOOTH_SEAMS = os.getenv("CHAPTER_SMOOTH_SEAMS", "true").lower() == "true"
+# Characters of each scene shown to the seam smoother
+SEAM_CONTEXT_CHARS = 600
+
+ProgressCallback = Callable[[Dict[str, Any]], None]
 
 
 class ChapterGenerationTool:
@@ -24,7 +47,9 @@ class ChapterGenerationTool:
         """Initialize the chapter generation tool."""
         self.project_id = project_id
         self.location = location
-        self.llm_provider: LLMProvider = get_llm_provider(project_id, location)
+        self.llm_provider: LLMProvider = get_shared_llm_provider(
+            project_id, location, action_class="long_form"
+        )
         self.context_builder = StoryContextBuilder(project_id)
 
     async def execute(
@@ -32,6 +57,8 @@ class ChapterGenerationTool:
         story_id: str,
         chapter_number: int,
         previous_chapters: Optional[List[Dict[str, Any]]] = None,
+        mode: Optional[str] = None,
+        on_progress: Optional[ProgressCallback] = None,
     ) -> Dict[str, Any]:
         """
         Generate a chapter with continuity.
@@ -40,29 +67,40 @@ class ChapterGenerationTool:
             story_id: Firestore story document ID
             chapter_number: The chapter number to generate
             previous_chapters: Optional list of previous chapter contents
+            mode: "single" or "scenes" (defaults to CHAPTER_GENERATION_MODE)
+            on_progress: Optional callback receiving progress events in scenes mode
 
         Returns:
             Dictionary with generated chapter content
         """
         # Build context from Firestore
-        context = self.context_builder.build_story_context(story_id)
+        context = await asyncio.to_thread(self.context_builder.build_story_context, story_id)
         formatted_context = self.context_builder.format_context_for_prompt(context)
 
         # Get existing chapters for continuity
-        existing_chapters = context.get("chapters", [])
         if previous_chapters is None:
-            previous_chapters = existing_chapters[:chapter_number - 1]
+            previous_chapters = context.chapters[:chapter_number - 1]
+        else:
+            previous_chapters = [Chapter.from_document(chapter) for chapter in previous_chapters]
 
         # Build continuity summary
         continuity_text = ""
         if previous_chapters:
             continuity_text = "\n=== PREVIOUS CHAPTERS SUMMARY ===\n"
             for i, chapter in enumerate(previous_chapters[-3:], 1):  # Last 3 chapters
-                chapter_num = chapter.get("chapterNumber", i)
-                title = chapter.get("title", "Untitled")
-                content = chapter.get("content", "")[:500]  # First 500 chars
+                chapter_num = chapter.number or i
+                title = chapter.title or "Untitled"
+                content = chapter.content[:500]  # First 500 chars
                 continuity_text += f"Chapter {chapter_num}: {title}\n{content}...\n\n"
 
+        if (mode or CHAPTER_GENERATION_MODE) == "scenes":
+            result = await self.generate_scenes(
+                formatted_context, continuity_text, chapter_number, on_progress=on_progress
+            )
+            if result is not None:
+                return {"storyId": story_id, "chapterNumber": chapter_number, **result}
+            print("[CHAPTER_TOOL] Outline unusable, generating the chapter in one pass")
+
         # Build prompt
         prompt = f"""You are an expert novelist. Generate Chapter {chapter_number} for this story.
 
@@ -84,7 +122,7 @@ Return the chapter in the following format:
 """
 
         # Generate using LLM provider
-        generated_text = self.llm_provider.generate_content(prompt)
+        generated_text = await asyncio.to_thread(self.llm_provider.generate_content, prompt)
 
         return {
             "storyId": story_id,
@@ -92,3 +130,179 @@ Return the chapter in the following format:
             "content": generated_text,
         }
 
+
+    async def generate_scenes(
+        self,
+        formatted_context: str,
+        continuity_text: str,
+        chapter_number: int,
+        brief: str = "",
+        on_progress: Optional[ProgressCallback] = None,
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Generate a chapter as an outline of scenes written concurrently.
+
+        The outline is generated first. Every scene is then written at the same
+        time (up to CHAPTER_SCENE_CONCURRENCY), each seeing the whole outline and
+        its neighbouring scenes, so wall-clock time follows the longest scene
+        rather than the whole chapter. Finally, short transitions smooth the seams.
+
+        Args:
+            formatted_context: Story context formatted for prompts
+            continuity_text: Summary of the previous chapters
+            chapter_number: The chapter number to generate
+            brief: Optional description of what the chapter must cover
+            on_progress: Optional callback receiving progress events
+
+        Returns:
+            Dictionary with "title", "content", "outline" and "scenes", or None if
+            no usable outline came back
+        """
+        def report(event: Dict[str, Any]) -> None:
+            if on_progress is not None:
+                on_progress(event)
+
+        start = time.monotonic()
+        brief_text = f"\n=== CHAPTER BRIEF ===\n{brief}\n" if brief else ""
+        shared_context = f"{formatted_context}\n{continuity_text}{brief_text}"
+
+        outline = await self._generate_outline(shared_context, chapter_number)
+        if len(outline) < 2:
+            return None
+        report({"stage": "outline", "chapterNumber": chapter_number, "outline": outline})
+
+        title_task = asyncio.create_task(asyncio.to_thread(
+            self.llm_provider.generate_content, self._build_title_prompt(shared_context, chapter_number, outline)
+        ))
+        semaphore = asyncio.Semaphore(CHAPTER_SCENE_CONCURRENCY)
+
+        async def write_scene(index: int) -> str:
+            async with semaphore:
+                prompt = self._build_scene_prompt(shared_context, chapter_number, outline, index)
+                with metrics.timer("chapter.scene_seconds"):
+                    text = (await asyncio.to_thread(self.llm_provider.generate_content, prompt)).strip()
+            report({"stage": "scene", "chapterNumber": chapter_number, "index": index, "total": len(outline), "content": text})
+            return text
+
+        scene_tasks = [asyncio.create_task(write_scene(index)) for index in range(len(outline))]
+        try:
+            scenes = list(await asyncio.gather(*scene_tasks))
+        except BaseException:
+            # gather does not cancel siblings when one scene fails; stop the
+            # rest (and any still queued on the semaphore) along with the title.
+            for task in (*scene_tasks, title_task):
+                task.cancel()
+            await asyncio.gather(*scene_tasks, title_task, return_exceptions=True)
+            raise
+
+        transitions = [""] * (len(scenes) - 1)
+        if CHAPTER_SMOOTH_SEAMS and len(scenes) > 1:
+            transitions = list(await asyncio.gather(
+                *(self._smooth_seam(scenes[index], scenes[index + 1]) for index in range(len(scenes) - 1))
+            ))
+            report({"stage": "seams", "chapterNumber": chapter_number, "count": len(transitions)})
+
+        parts = [scenes[0]]
+        for transition, scene in zip(transitions, scenes[1:]):
+            if transition:
+                parts.append(transition)
+            parts.append(scene)
+
+        try:
+            title = (await title_task).strip().strip('"').strip()
+        except Exception as error:
+            print(f"[CHAPTER_TOOL] Title generation failed: {error}")
+            title = ""
+
+        metrics.observe("chapter.scenes_pipeline_seconds", time.monotonic() - start)
+        return {
+            "title": title or f"Chapter {chapter_number}",
+            "content": "\n\n".join(parts),
+            "outline": outline,
+            "scenes": scenes,
+        }
+
+    async def _generate_outline(self, shared_context: str, chapter_number: int) -> List[str]:
+        """Ask for the chapter's scenes as a JSON array of short summaries."""
+        system_prompt = (
+            "You are an expert novelist planning a chapter. Respond ONLY with a JSON array "
+            "of scene summaries, in reading order."
+        )
+        user_prompt = f"""{shared_context}
+
+Plan Chapter {chapter_number} as {CHAPTER_SCENE_COUNT} consecutive scenes that:
+1. Maintain continuity with previous chapters
+2. Advance the plot naturally
+3. End on a moment that encourages reading the next chapter
+
+Each scene summary is 2-3 sentences: where it happens, who is present, and what changes by its end.
+"""
+        schema = {
+            "type": "array",
+            "description": f"Exactly {CHAPTER_SCENE_COUNT} scene summaries in reading order.",
+            "items": {"type": "string", "description": "A 2-3 sentence scene summary."},
+            "minItems": CHAPTER_SCENE_COUNT,
+            "maxItems": CHAPTER_SCENE_COUNT,
+        }
+        try:
+            raw = await self.llm_provider.generate_structured_content(system_prompt, user_prompt, schema)
+        except DeadlineExceeded:
+            # Out of time: report a timeout rather than falling back to a single-pass chapter
+            raise
+        except Exception as error:
+            print(f"[CHAPTER_TOOL] Outline generation failed: {error}")
+            return []
+        return [item.strip() for item in raw if isinstance(item, str) and item.strip()][:CHAPTER_SCENE_COUNT]
+
+    def _build_scene_prompt(self, shared_context: str, chapter_number: int, outline: List[str], index: int) -> str:
+        """Prompt for one scene, with the full outline and hints about its neighbours."""
+        outline_text = "\n".join(f"{number}. {scene}" for number, scene in enumerate(outline, 1))
+        previous_hint = f"The previous scene ends this way: {outline[index - 1]}" if index > 0 else \
+            "This scene opens the chapter."
+        next_hint = f"The next scene will cover: {outline[index + 1]}" if index + 1 < len(outline) else \
+            "This scene closes the chapter; end on a moment that encourages reading on."
+        return f"""You are an expert novelist writing Chapter {chapter_number} of this story, one scene at a time.
+
+{shared_context}
+
+=== CHAPTER OUTLINE ===
+{outline_text}
+
+Write scene {index + 1} of {len(outline)}: {outline[index]}
+
+{previous_hint}
+{next_hint}
+
+Write only this scene's prose: no title, no scene number, no commentary. Pick up where the previous scene
+leaves off and stop where the next one begins, so the scenes read as one continuous chapter.
+"""
+
+    def _build_title_prompt(self, shared_context: str, chapter_number: int, outline: List[str]) -> str:
+        outline_text = "\n".join(f"- {scene}" for scene in outline)
+        return f"""{shared_context}
+
+Chapter {chapter_number} covers these scenes:
+{outline_text}
+
+Respond ONLY with a short, evocative title for this chapter.
+"""
+
+    async def _smooth_seam(self, before: str, after: str) -> str:
+        """Write a short bridge between two scenes, or nothing if they already flow."""
+        prompt = f"""Two consecutive scenes of a novel were written separately. Write a bridge of at most
+two sentences that joins them smoothly, in the same voice and tense. If they already flow, respond with nothing.
+
+--- END OF FIRST SCENE ---
+{before[-SEAM_CONTEXT_CHARS:]}
+
+--- START OF SECOND SCENE ---
+{after[:SEAM_CONTEXT_CHARS]}
+
+Respond ONLY with the bridge text.
+"""
+        try:
+            return (await asyncio.to_thread(self.llm_provider.generate_content, prompt)).strip()
+        except Exception as error:
+            # A missing transition is cosmetic; keep the scenes
+            print(f"[CHAPTER_TOOL] Seam smoothing failed: {error}")
+            return ""
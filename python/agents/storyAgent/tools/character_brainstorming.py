@@ -1,4 +1,5 @@
 """Specialized tool for character brainstorming."""
+import asyncio
 import sys
 from pathlib import Path
 from typing import Dict, Any, Optional
@@ -6,7 +7,7 @@ from typing import Dict, Any, Optional
 # Handle imports for both direct execution and module import
 try:
     from ..context_builder import StoryContextBuilder
-    from ..llm_provider import get_llm_provider, LLMProvider
+    from ..llm_provider import get_shared_llm_provider, LLMProvider
 except ImportError:
     # Add parent directory to path for direct execution
     current_dir = Path(__file__).parent.parent
@@ -14,7 +15,7 @@ except ImportError:
     if str(parent_dir) not in sys.path:
         sys.path.insert(0, str(parent_dir))
     from agents.storyAgent.context_builder import StoryContextBuilder
-    from agents.storyAgent.llm_provider import get_llm_provider, LLMProvider
+    from agents.storyAgent.llm_provider import get_shared_llm_provider, LLMProvider
 
 
 class CharacterBrainstormingTool:
@@ -24,7 +25,9 @@ class CharacterBrainstormingTool:
         """Initialize the character brainstorming tool."""
         self.project_id = project_id
         self.location = location
-        self.llm_provider: LLMProvider = get_llm_provider(project_id, location)
+        self.llm_provider: LLMProvider = get_shared_llm_provider(
+            project_id, location, action_class="brainstorm"
+        )
         self.context_builder = StoryContextBuilder(project_id)
 
     async def execute(
@@ -44,12 +47,12 @@ class CharacterBrainstormingTool:
         Returns:
             Dictionary with character profiles
         """
-        context = self.context_builder.build_story_context(story_id)
+        context = await asyncio.to_thread(self.context_builder.build_story_context, story_id)
         formatted_context = self.context_builder.format_context_for_prompt(context)
 
-        story = context["story"]
-        genre = story.get("genre", "general fiction")
-        tone = story.get("tone", "neutral")
+        story = context.story
+        genre = story.genre or "general fiction"
+        tone = story.tone or "neutral"
 
         role_text = f"Role: {role}" if role else "Any role"
         archetype_text = f"Archetype: {archetype}" if archetype else "Any archetype"
@@ -75,7 +78,7 @@ Provide a complete character profile with:
 
 Make the character compelling and well-developed."""
 
-        generated_text = self.llm_provider.generate_content(prompt)
+        generated_text = await asyncio.to_thread(self.llm_provider.generate_content, prompt)
 
         return {
             "storyId": story_id,
@@ -1,23 +1,60 @@
 """Specialized tool for plot brainstorming."""
+import asyncio
+import hashlib
+import os
+import re
 import sys
+import time
 from pathlib import Path
-from typing import Dict, Any, List, Tuple, Optional
+from typing import Dict, Any, AsyncIterator, List, Sequence, Tuple, Optional
 
 try:
-    from ..context_builder import StoryContextBuilder
-    from ..llm_provider import get_llm_provider, LLMProvider
+    from ..cache import get_cache
+    from ..chapter_buffers import ChapterBufferStore, StaleChapterBufferError, code_point_index
+    from ..context_builder import FIRESTORE_TIMEOUT, StoryContextBuilder, preloaded_story_context
+    from ..context_snapshot import context_snapshot
+    from ..deadline import DeadlineExceeded, remaining, stage_timeout
+    from ..llm_provider import get_shared_llm_provider, LLMProvider
+    from ..metrics import metrics
+    from ..ngram_suggester import NgramModel, ngram_models
+    from ..story_context import Chapter
 except ImportError:    
     current_dir = Path(__file__).parent.parent
     parent_dir = current_dir.parent.parent
     if str(parent_dir) not in sys.path:
         sys.path.insert(0, str(parent_dir))
-    from agents.storyAgent.context_builder import StoryContextBuilder
-    from agents.storyAgent.llm_provider import get_llm_provider, LLMProvider
+    from agents.storyAgent.cache import get_cache
+    from agents.storyAgent.chapter_buffers import ChapterBufferStore, StaleChapterBufferError, code_point_index
+    from agents.storyAgent.context_builder import FIRESTORE_TIMEOUT, StoryContextBuilder, preloaded_story_context
+    from agents.storyAgent.context_snapshot import context_snapshot
+    from agents.storyAgent.deadline import DeadlineExceeded, remaining, stage_timeout
+    from agents.storyAgent.llm_provider import get_shared_llm_provider, LLMProvider
+    from agents.storyAgent.metrics import metrics
+    from agents.storyAgent.ngram_suggester import NgramModel, ngram_models
+    from agents.storyAgent.story_context import Chapter
 
 
 PREFIX_CHAR_LENGTH = 1200 
 SUFFIX_CHAR_LENGTH = 300  
 NUMBER_OF_SUGGESTIONS = 3 
+# How long suggestions for an identical prompt are reused (seconds, 0 disables)
+SUGGESTION_CACHE_TTL = float(os.getenv("SUGGESTION_CACHE_TTL", "60"))
+# "candidates": one short completion per suggestion, generated together by the provider
+# "array": a single completion returning all suggestions as a JSON array
+NEXT_LINE_GENERATION_MODE = os.getenv("NEXT_LINE_GENERATION_MODE", "candidates")
+# Per-candidate output cap; a single line rarely needs more
+NEXT_LINE_MAX_TOKENS = int(os.getenv("NEXT_LINE_MAX_TOKENS", "60"))
+CANDIDATE_STOP_SEQUENCES = ["\n"]
+# Overall time budget for one request; a top-up for missing suggestions must fit inside it (seconds)
+NEXT_LINE_DEADLINE = float(os.getenv("NEXT_LINE_DEADLINE", "30"))
+# Don't start a top-up with less time than this left (seconds)
+MIN_TOP_UP_TIME = 1.0
+# How long the formatted prompt context of a chapter is reused while its story version is unchanged (seconds, 0 disables)
+PROMPT_CONTEXT_CACHE_TTL = float(os.getenv("PROMPT_CONTEXT_CACHE_TTL", "300"))
+
+# Sentence end: terminal punctuation (plus closing quotes/brackets) before a capitalised word or the end
+_SENTENCE_END = re.compile(r"[.!?]+[\"'\u201d\u2019)\]]*(?=\s+[\"'\u201c\u2018(\[]?[A-Z]|\s*$)")
+_ABBREVIATIONS = {"mr", "mrs", "ms", "dr", "st", "jr", "sr", "prof", "mt"}
 
 class NextLineGenerationTool:
     """Specialized tool for generating next lines."""
@@ -26,10 +63,13 @@ class NextLineGenerationTool:
         """Initialize the next line generation tool."""
         self.project_id = project_id
         self.location = location
-        self.llm_provider: LLMProvider = get_llm_provider(project_id, location)
+        self.llm_provider: LLMProvider = get_shared_llm_provider(
+            project_id, location, action_class="interactive"
+        )
         self.context_builder = StoryContextBuilder(project_id)
+        self.chapter_buffers = ChapterBufferStore()
 
-    def _slice_content(self, content: str, cursor_pos: int) -> Tuple[str, str]:
+    def slice_content(self, content: str, cursor_pos: int) -> Tuple[str, str]:
         """Slices the chapter content into a prefix and suffix based on cursor position."""
         
         # 1. Calculate Prefix (Text before cursor)
@@ -42,32 +82,67 @@ class NextLineGenerationTool:
 
         return prefix, suffix
 
-    def _get_chapter(self, story_id: str, chapter_id: str) -> Optional[Dict[str, Any]]:
-        """Fetch a specific chapter from Firestore."""
+    def _resolve_window(
+        self,
+        story_id: str,
+        chapter_id: Optional[str],
+        content: Optional[str],
+        cursor_pos: int,
+        prefix: Optional[str] = None,
+        suffix: Optional[str] = None,
+        base_hash: Optional[str] = None,
+        edits: Optional[List[Dict[str, Any]]] = None,
+        expected_hash: Optional[str] = None,
+    ) -> Tuple[str, str, Optional[str], str]:
+        """
+        Resolves the text around the cursor from whichever form the caller sent.
+
+        The caller may send a pre-sliced window (prefix/suffix), a delta against the
+        server-side chapter buffer (base_hash/edits), or the full chapter content.
+        Full content sent with a chapter_id is stored as that chapter's buffer.
+        cursor_pos counts UTF-16 code units, as the editor's JavaScript does.
+
+        Returns:
+            Tuple of (prefix, suffix, content hash of the chapter buffer or None,
+            all the chapter text before the cursor that is known)
+        """
+        if prefix is not None:
+            return prefix[-PREFIX_CHAR_LENGTH:], (suffix or "")[:SUFFIX_CHAR_LENGTH], None, prefix
+
+        if base_hash is not None:
+            if not chapter_id:
+                raise StaleChapterBufferError("Delta uploads require a chapterId")
+            digest, content = self.chapter_buffers.apply_delta(
+                story_id, chapter_id, base_hash, edits or [], expected_hash
+            )
+        else:
+            content = content or ""
+            digest = self.chapter_buffers.put(story_id, chapter_id, content) if chapter_id else None
+
+        cursor_pos = code_point_index(content, int(cursor_pos))
+        prefix_text, suffix_text = self.slice_content(content, cursor_pos)
+        return prefix_text, suffix_text, digest, content[:cursor_pos]
+
+    def _get_chapter(self, story_id: str, chapter_id: str) -> Optional[Chapter]:
+        """Fetch a specific chapter from Firestore (or from the story's preloaded context)."""
+        preloaded = preloaded_story_context(story_id)
+        if preloaded is not None:
+            return next((chapter for chapter in preloaded.chapters if chapter.id == chapter_id), None)
         try:
-            from google.cloud import firestore
-            import os
-            
-            # Create Firestore client (same way as context_builder)
-            emulator_host = os.getenv("FIRESTORE_EMULATOR_HOST")
-            if self.project_id:
-                db = firestore.Client(project=self.project_id)
-            else:
-                db = firestore.Client()
-            
-            if emulator_host:
-                os.environ["FIRESTORE_EMULATOR_HOST"] = emulator_host
-            
+            # Reuse the context builder's shared Firestore client
+            db = self.context_builder.db
             chapter_ref = db.collection("stories").document(story_id).collection("chapters").document(chapter_id)
-            chapter_doc = chapter_ref.get()
+            chapter_doc = chapter_ref.get(timeout=stage_timeout(FIRESTORE_TIMEOUT, "chapter fetch"))
             if chapter_doc.exists:
-                return {"id": chapter_doc.id, **chapter_doc.to_dict()}
+                return Chapter.from_document({"id": chapter_doc.id, **chapter_doc.to_dict()})
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             # Log error but don't fail - chapter_id is optional
             print(f"Warning: Could not fetch chapter {chapter_id}: {e}")
         return None
 
-    def _get_previous_chapters_context(self, chapters: List[Dict[str, Any]], current_chapter_number: Optional[int]) -> str:
+    def _get_previous_chapters_context(self, chapters: Sequence[Chapter], current_chapter_number: Optional[int]) -> str:
         """Build context from previous chapters for continuity."""
         if not current_chapter_number:
             return ""
@@ -75,9 +150,9 @@ class NextLineGenerationTool:
         # Filter and sort previous chapters
         previous_chapters = [
             ch for ch in chapters 
-            if (ch.get("chapterNumber") or ch.get("order", 0)) < current_chapter_number
+            if (ch.number or 0) < current_chapter_number
         ]
-        previous_chapters.sort(key=lambda x: x.get("chapterNumber") or x.get("order", 0))
+        previous_chapters.sort(key=lambda x: x.number or 0)
         
         if not previous_chapters:
             return ""
@@ -87,9 +162,9 @@ class NextLineGenerationTool:
         context_parts = []
         
         for chapter in recent_chapters:
-            chapter_num = chapter.get("chapterNumber") or chapter.get("order", "?")
-            title = chapter.get("title", "Untitled")
-            content = chapter.get("content", "")
+            chapter_num = chapter.number or "?"
+            title = chapter.title or "Untitled"
+            content = chapter.content
             # Include first 500 chars of each previous chapter
             content_preview = content[:500] + "..." if len(content) > 500 else content
             context_parts.append(f"Chapter {chapter_num}: {title}\n{content_preview}")
@@ -98,6 +173,155 @@ class NextLineGenerationTool:
             return "\n\n--- PREVIOUS CHAPTERS (for continuity) ---\n" + "\n\n".join(context_parts)
         return ""
 
+    def load_prompt_context(
+        self, story_id: str, chapter_id: Optional[str] = None, refresh: bool = False
+    ) -> Tuple[str, str]:
+        """
+        Builds the story-level parts of the prompt, which do not depend on the cursor.
+
+        The story context comes from the context builder, which caches it for
+        STORY_CONTEXT_CACHE_TTL seconds. The formatted result is cached per chapter
+        and story version for PROMPT_CONTEXT_CACHE_TTL seconds, so formatting and
+        the chapter lookup are skipped while the story is unchanged, and any edit
+        shows up once the story context is read again.
+
+        Args:
+            story_id: Firestore story document ID
+            chapter_id: Optional chapter document ID, used to add the previous chapters
+            refresh: Rebuild the context even if a cached one exists
+
+        Returns:
+            Tuple of (formatted story context, previous chapters text)
+        """
+        import logging
+        logger = logging.getLogger(__name__)
+
+        # Build Macro Context
+        context = self.context_builder.build_story_context(story_id)
+
+        # Keyed on the story version, so a cached block never outlives the context it was built from
+        cache_key = f"prompt_context:{story_id}:{chapter_id or ''}:{context.version}"
+        if PROMPT_CONTEXT_CACHE_TTL > 0 and not refresh:
+            cached = get_cache().get(cache_key)
+            if cached is not None:
+                metrics.increment("next_line.prompt_context", source="cache")
+                return cached
+        metrics.increment("next_line.prompt_context", source="built")
+
+        chapters_count = len(context.chapters)
+        logger.info(f"Story context built, chapters count: {chapters_count}")
+        print(f"[NEXT_LINE_TOOL] Story context built, chapters count: {chapters_count}")
+
+        # Restored from the warm-restart snapshot together with the context
+        snapshotted = context_snapshot.prompt_block(story_id, chapter_id, context)
+        if snapshotted is not None:
+            if PROMPT_CONTEXT_CACHE_TTL > 0:
+                get_cache().set(cache_key, snapshotted, PROMPT_CONTEXT_CACHE_TTL)
+            return snapshotted
+
+        # If chapter_id is provided, enhance context with chapter-specific information
+        previous_chapters_text = ""
+        if chapter_id:
+            logger.info(f"Fetching chapter {chapter_id}...")
+            print(f"[NEXT_LINE_TOOL] Fetching chapter {chapter_id}...")
+            current_chapter = self._get_chapter(story_id, chapter_id)
+            if current_chapter:
+                current_chapter_number = current_chapter.number
+                logger.info(f"Found chapter, number: {current_chapter_number}")
+                print(f"[NEXT_LINE_TOOL] Found chapter, number: {current_chapter_number}")
+                # Get previous chapters for continuity
+                previous_chapters_text = self._get_previous_chapters_context(
+                    context.chapters,
+                    current_chapter_number
+                )
+                prev_len = len(previous_chapters_text)
+                logger.info(f"Previous chapters context length: {prev_len}")
+                print(f"[NEXT_LINE_TOOL] Previous chapters context length: {prev_len}")
+
+        logger.info("Formatting context for prompt...")
+        print("[NEXT_LINE_TOOL] Formatting context for prompt...")
+        prompt_context = (self.context_builder.format_context_for_prompt(context), previous_chapters_text)
+        if PROMPT_CONTEXT_CACHE_TTL > 0:
+            get_cache().set(cache_key, prompt_context, PROMPT_CONTEXT_CACHE_TTL)
+        context_snapshot.note_prompt(story_id, chapter_id, prompt_context, context)
+        return prompt_context
+
+    async def prefetch(self, story_id: str, chapter_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Warms everything the first suggestion for a chapter needs, e.g. when the author opens it.
+
+        Rebuilds the cached prompt context (story context, chapter metadata and
+        previous chapter previews), syncs the story's n-gram model, and warms the
+        provider connection. Each part is best effort.
+
+        Args:
+            story_id: Firestore story document ID
+            chapter_id: Optional chapter document ID
+
+        Returns:
+            Dictionary with the parts that were warmed and the time taken
+        """
+        start = time.monotonic()
+
+        async def warm_context() -> None:
+            await asyncio.to_thread(self.load_prompt_context, story_id, chapter_id, True)
+            # Reuses the story context just cached by load_prompt_context
+            await asyncio.to_thread(self.ngram_model, story_id)
+
+        parts = {"context": warm_context(), "provider": self.llm_provider.warm_up()}
+        outcomes = await asyncio.gather(*parts.values(), return_exceptions=True)
+        warmed = {}
+        for part, outcome in zip(parts, outcomes):
+            warmed[part] = not isinstance(outcome, BaseException)
+            if isinstance(outcome, BaseException):
+                print(f"[NEXT_LINE_TOOL] Prefetch of {part} failed for story {story_id}: {outcome}")
+        elapsed = time.monotonic() - start
+        metrics.observe("next_line.prefetch_seconds", elapsed)
+        return {"storyId": story_id, "chapterId": chapter_id, "warmed": warmed, "seconds": round(elapsed, 3)}
+
+    def ngram_model(self, story_id: str) -> NgramModel:
+        """The story's local n-gram model, synced with its chapters when due."""
+        return ngram_models.get(
+            story_id,
+            lambda: self.context_builder.build_story_context(story_id).chapters,
+        )
+
+    def _fallback_suggestions(
+        self,
+        story_id: str,
+        prefix_text: str,
+        existing: List[str],
+        chapter_id: Optional[str] = None,
+        before_cursor: Optional[str] = None,
+    ) -> List[str]:
+        """
+        Fills missing suggestions from the story's n-gram model, without any network call
+        beyond a (usually cached) chapter sync.
+
+        The stored text of the current chapter also holds what the author wrote after
+        the cursor, which the model would simply echo back, so that chapter is replaced
+        in the model by the text before the cursor (until the next chapter sync).
+
+        Returns:
+            The suggestions, extended with n-gram continuations
+        """
+        missing = NUMBER_OF_SUGGESTIONS - len(existing)
+        if missing <= 0:
+            return existing
+        try:
+            with metrics.timer("next_line.fallback_seconds"):
+                model = self.ngram_model(story_id)
+                if chapter_id:
+                    model.update_source(chapter_id, prefix_text if before_cursor is None else before_cursor)
+                candidates = model.suggest(prefix_text, NUMBER_OF_SUGGESTIONS)
+        except Exception as error:
+            print(f"[NEXT_LINE_TOOL] N-gram fallback failed: {error!r}")
+            return existing
+        suggestions, _ = self.repair_suggestions(candidates, existing=existing)
+        if len(suggestions) > len(existing):
+            metrics.increment("next_line.fallback_suggestions", len(suggestions) - len(existing))
+        return suggestions
+
     def _build_system_prompt(self) -> str:
         """Defines the AI's role, rules, and constraints."""
         return f"""
@@ -112,9 +336,36 @@ You are a highly skilled, creative, and observant Novelist Assistant AI. Your so
 6.  **DO NOT output any pre-amble, explanation, or text outside of the required JSON object.**
 """
 
-    def _build_user_prompt(self, formatted_context: str, prefix_text: str, suffix_text: str, previous_chapters_text: str = "") -> str:
+    def _build_candidate_system_prompt(self) -> str:
+        """Defines the AI's role and constraints when generating one line per call."""
+        return """
+You are a highly skilled, creative, and observant Novelist Assistant AI. Your sole task is to provide a seamless, in-context line continuation for a user who is actively writing a novel.
+
+### RULES AND CONSTRAINTS:
+1.  **Output Format:** Output ONLY the continuation text itself: no quotes around it, no numbering, no explanation.
+2.  **Suggestion Length:** Output a single, logical sentence or a short, cohesive thought, ready to be dropped directly into the text. Do NOT output full paragraphs or multiple sentences.
+3.  **Coherence:** Maintain the established story's Genre, Tone, and the immediate preceding text's flow, pacing, and point-of-view.
+4.  **Focus:** Use the "CURRENT CHAPTER CONTEXT" as the primary guide. Use the "GLOBAL STORY CONTEXT" only for world/character consistency.
+"""
+
+    def _build_user_prompt(
+        self,
+        formatted_context: str,
+        prefix_text: str,
+        suffix_text: str,
+        previous_chapters_text: str = "",
+        single_line: bool = False,
+    ) -> str:
         """Assembles the dynamic user prompt with all context and the task."""
         previous_section = f"\n{previous_chapters_text}\n" if previous_chapters_text else ""
+        if single_line:
+            task = """Write the single next line that flows naturally from the text preceding the [INSERTION_POINT] and smoothly transitions into the text that follows it.
+
+Respond ONLY with that line."""
+        else:
+            task = f"""Generate {NUMBER_OF_SUGGESTIONS} unique, short line suggestions that flow naturally from the text preceding the [INSERTION_POINT] and smoothly transition into the text that follows it.
+
+Respond ONLY with the JSON array containing the {NUMBER_OF_SUGGESTIONS} generated lines."""
         
         return f"""
 ### A. GLOBAL STORY CONTEXT 
@@ -132,9 +383,7 @@ The [INSERTION_POINT] marks the exact spot where the next line should logically
 --- END OF EXCERPT ---
 
 ### YOUR TASK:
-Generate {NUMBER_OF_SUGGESTIONS} unique, short line suggestions that flow naturally from the text preceding the [INSERTION_POINT] and smoothly transition into the text that follows it.
-
-Respond ONLY with the JSON array containing the {NUMBER_OF_SUGGESTIONS} generated lines.
+{task}
 """
 
     def _get_response_schema(self) -> Dict[str, Any]:
@@ -150,75 +399,245 @@ Respond ONLY with the JSON array containing the {NUMBER_OF_SUGGESTIONS} generate
             "maxItems": NUMBER_OF_SUGGESTIONS,
         }
 
+    def _trim_candidate(self, text: str) -> str:
+        """Cleans a raw candidate and cuts it to its first sentence."""
+        line = text.strip().strip('"').strip()
+        for match in _SENTENCE_END.finditer(line):
+            words = line[:match.start()].split()
+            if words and words[-1].lower() in _ABBREVIATIONS:
+                continue
+            return line[:match.end()].strip()
+        return line
+
+    async def _generate_candidates(self, system_prompt: str, user_prompt: str, count: int) -> List[str]:
+        """Generates count independent one-line candidates."""
+        return await self.llm_provider.generate_candidates(
+            system_prompt,
+            user_prompt,
+            count,
+            max_tokens=NEXT_LINE_MAX_TOKENS,
+            stop=CANDIDATE_STOP_SEQUENCES,
+        )
+
+    def repair_suggestions(self, raw: Any, existing: Optional[List[str]] = None) -> Tuple[List[str], int]:
+        """
+        Validates, cleans and dedupes raw suggestions.
+
+        Args:
+            raw: Provider output (expected to be a list of strings)
+            existing: Suggestions already accepted; new ones must differ from these
+
+        Returns:
+            Tuple of (accepted suggestions including existing, number of raw items dropped)
+        """
+        suggestions = list(existing or [])
+        seen = {suggestion.lower() for suggestion in suggestions}
+        items = raw if isinstance(raw, list) else []
+        dropped = 0 if isinstance(raw, list) else 1
+
+        for item in items:
+            if isinstance(item, dict):
+                item = item.get("text") or item.get("suggestion")
+            line = self._trim_candidate(item) if isinstance(item, str) else ""
+            if not line or line.lower() in seen or len(suggestions) >= NUMBER_OF_SUGGESTIONS:
+                dropped += 1
+                continue
+            seen.add(line.lower())
+            suggestions.append(line)
+        return suggestions, dropped
+
+    async def _top_up(
+        self,
+        suggestions: List[str],
+        system_prompt: str,
+        user_prompt: str,
+        deadline: float,
+    ) -> List[str]:
+        """
+        Requests only the missing suggestions, if there is time left before the deadline.
+
+        Returns:
+            The suggestions, extended with any valid new ones
+        """
+        missing = NUMBER_OF_SUGGESTIONS - len(suggestions)
+        time_left = deadline - time.monotonic()
+        if missing <= 0 or time_left < MIN_TOP_UP_TIME:
+            return suggestions
+
+        metrics.increment("next_line.top_ups")
+        try:
+            with metrics.timer("next_line.top_up_seconds"):
+                raw = await asyncio.wait_for(
+                    self._generate_candidates(system_prompt, user_prompt, missing),
+                    timeout=time_left,
+                )
+        except Exception as error:
+            # Keep the partial result rather than failing the whole request
+            metrics.increment("next_line.top_up_failures")
+            print(f"[NEXT_LINE_TOOL] Top-up for {missing} suggestions failed: {error!r}")
+            return suggestions
+
+        suggestions, _ = self.repair_suggestions(raw, existing=suggestions)
+        return suggestions
+
+    async def stream_suggestions(
+        self,
+        formatted_context: str,
+        prefix_text: str,
+        suffix_text: str,
+        previous_chapters_text: str = "",
+        deadline: Optional[float] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Yields suggestions one at a time, as soon as each is ready.
+
+        Used by editor sessions, which hold the story context for their whole
+        lifetime. In "array" mode suggestions arrive as the model streams them; in
+        "candidates" mode they arrive when the provider returns. Missing suggestions
+        are topped up if there is time left before the deadline.
+
+        Args:
+            formatted_context: Story context from load_prompt_context
+            prefix_text: Text before the cursor
+            suffix_text: Text after the cursor
+            previous_chapters_text: Previous chapters text from load_prompt_context
+            deadline: time.monotonic() value after which no top-up is started
+
+        Yields:
+            Distinct, cleaned suggestions (at most NUMBER_OF_SUGGESTIONS in total)
+        """
+        if deadline is None:
+            deadline = time.monotonic() + NEXT_LINE_DEADLINE
+        candidate_system_prompt = self._build_candidate_system_prompt()
+        candidate_user_prompt = self._build_user_prompt(
+            formatted_context, prefix_text, suffix_text, previous_chapters_text, single_line=True
+        )
+        suggestions: List[str] = []
+
+        def accept(item: Any) -> Optional[str]:
+            nonlocal suggestions
+            accepted = len(suggestions)
+            suggestions, _ = self.repair_suggestions([item], existing=suggestions)
+            return suggestions[-1] if len(suggestions) > accepted else None
+
+        try:
+            if NEXT_LINE_GENERATION_MODE == "candidates":
+                for item in await self._generate_candidates(
+                    candidate_system_prompt, candidate_user_prompt, NUMBER_OF_SUGGESTIONS
+                ):
+                    line = accept(item)
+                    if line:
+                        yield line
+            else:
+                user_prompt = self._build_user_prompt(
+                    formatted_context, prefix_text, suffix_text, previous_chapters_text
+                )
+                async for item in self.llm_provider.stream_structured_content(
+                    self._build_system_prompt(), user_prompt, self._get_response_schema()
+                ):
+                    line = accept(item)
+                    if line:
+                        yield line
+        except DeadlineExceeded:
+            raise
+        except Exception as error:
+            # Keep what already arrived; the top-up below may still fill the rest
+            print(f"[NEXT_LINE_TOOL ERROR] Error in LLM generation: {error}")
+
+        accepted = len(suggestions)
+        suggestions = await self._top_up(suggestions, candidate_system_prompt, candidate_user_prompt, deadline)
+        for line in suggestions[accepted:]:
+            yield line
+
     async def execute(
         self,
         story_id: str,
-        content: str,
+        content: Optional[str],
         cursorPosition: int,
         chapter_id: Optional[str] = None,
+        prefix: Optional[str] = None,
+        suffix: Optional[str] = None,
+        base_hash: Optional[str] = None,
+        edits: Optional[List[Dict[str, Any]]] = None,
+        content_hash: Optional[str] = None,
+        regenerate: bool = False,
     ) -> Dict[str, Any]:
         """
         Generates 3 next line suggestions based on story context and cursor position.
 
         Args:
             story_id: Firestore story document ID
-            content: Current content of the chapter
-            cursorPosition: Character index where the new line should be inserted
+            content: Current content of the chapter (optional when prefix or base_hash is given)
+            cursorPosition: Insertion point, in UTF-16 code units (a JavaScript string index)
             chapter_id: Optional chapter document ID for better context and validation
+            prefix: Optional pre-sliced text before the cursor (skips content slicing)
+            suffix: Optional pre-sliced text after the cursor
+            base_hash: Optional hash of the chapter buffer that edits apply to
+            edits: Optional edits ({"start", "end", "text"}) against the chapter buffer
+            content_hash: Optional hash of the chapter content after the edits
+            regenerate: Ask the model again instead of serving suggestions cached for the same prompt
 
         Returns:
-            Dictionary containing the suggestions array.
+            Dictionary containing the suggestions array, and "contentHash" when the
+            chapter buffer was updated. If a delta could not be applied, the result has
+            "needsFullContent": True and the caller should resend the full content.
         """
         import logging
         logger = logging.getLogger(__name__)
         
-        logger.info(f"NextLineGenerationTool.execute called: story_id={story_id}, content_length={len(content)}, cursorPosition={cursorPosition}, chapter_id={chapter_id}")
-        print(f"[NEXT_LINE_TOOL] execute called: story_id={story_id}, content_length={len(content)}, cursorPosition={cursorPosition}, chapter_id={chapter_id}")
-        
+        # The tool's own budget, shortened by the caller's deadline if it is tighter
+        time_left = remaining()
+        deadline = time.monotonic() + (NEXT_LINE_DEADLINE if time_left is None else min(NEXT_LINE_DEADLINE, time_left))
+        content_length = len(content) if isinstance(content, str) else 0
+        logger.info(f"NextLineGenerationTool.execute called: story_id={story_id}, content_length={content_length}, cursorPosition={cursorPosition}, chapter_id={chapter_id}, delta={base_hash is not None}")
+        print(f"[NEXT_LINE_TOOL] execute called: story_id={story_id}, content_length={content_length}, cursorPosition={cursorPosition}, chapter_id={chapter_id}, delta={base_hash is not None}")
+
+        # Build Micro Context first: a stale delta should fail before any Firestore reads.
+        # The chapter buffer may live in the sqlite/redis cache, so this runs in a thread.
         try:
-            # Build Macro Context
-            logger.info("Building story context...")
-            print("[NEXT_LINE_TOOL] Building story context...")
-            context = self.context_builder.build_story_context(story_id)
-            chapters_count = len(context.get('chapters', []))
-            logger.info(f"Story context built, chapters count: {chapters_count}")
-            print(f"[NEXT_LINE_TOOL] Story context built, chapters count: {chapters_count}")
-    
-            # If chapter_id is provided, enhance context with chapter-specific information
-            current_chapter_number = None
-            previous_chapters_text = ""
-            if chapter_id:
-                logger.info(f"Fetching chapter {chapter_id}...")
-                print(f"[NEXT_LINE_TOOL] Fetching chapter {chapter_id}...")
-                current_chapter = self._get_chapter(story_id, chapter_id)
-                if current_chapter:
-                    current_chapter_number = current_chapter.get("chapterNumber") or current_chapter.get("order")
-                    logger.info(f"Found chapter, number: {current_chapter_number}")
-                    print(f"[NEXT_LINE_TOOL] Found chapter, number: {current_chapter_number}")
-                    # Get previous chapters for continuity
-                    previous_chapters_text = self._get_previous_chapters_context(
-                        context.get("chapters", []), 
-                        current_chapter_number
-                    )
-                    prev_len = len(previous_chapters_text)
-                    logger.info(f"Previous chapters context length: {prev_len}")
-                    print(f"[NEXT_LINE_TOOL] Previous chapters context length: {prev_len}")
-            
-            logger.info("Formatting context for prompt...")
-            print("[NEXT_LINE_TOOL] Formatting context for prompt...")
-            formatted_context = self.context_builder.format_context_for_prompt(context)
-            
-            # Build Micro Context
-            logger.info("Slicing content...")
-            print("[NEXT_LINE_TOOL] Slicing content...")
-            prefix_text, suffix_text = self._slice_content(content, cursorPosition)
-            logger.info(f"Prefix length: {len(prefix_text)}, Suffix length: {len(suffix_text)}")
-            print(f"[NEXT_LINE_TOOL] Prefix length: {len(prefix_text)}, Suffix length: {len(suffix_text)}")
+            prefix_text, suffix_text, buffer_hash, before_cursor = await asyncio.to_thread(
+                self._resolve_window,
+                story_id, chapter_id, content, cursorPosition,
+                prefix, suffix, base_hash, edits, content_hash,
+            )
+        except StaleChapterBufferError as error:
+            logger.info(f"Chapter buffer out of date, requesting full content: {error}")
+            print(f"[NEXT_LINE_TOOL] Chapter buffer out of date, requesting full content: {error}")
+            return {
+                "storyId": story_id,
+                "suggestions": [],
+                "needsFullContent": True,
+                "error": str(error),
+            }
+        except DeadlineExceeded:
+            raise
+        except Exception as error:
+            # Malformed text or cursor, or an unreachable cache backend
+            logger.error(f"Could not read the text around the cursor: {error}", exc_info=True)
+            print(f"[NEXT_LINE_TOOL ERROR] Could not read the text around the cursor: {error!r}")
+            return {
+                "storyId": story_id,
+                "suggestions": [],
+                "error": f"Failed to execute next line generation: {error}"
+            }
+        logger.info(f"Prefix length: {len(prefix_text)}, Suffix length: {len(suffix_text)}")
+        print(f"[NEXT_LINE_TOOL] Prefix length: {len(prefix_text)}, Suffix length: {len(suffix_text)}")
+
+        try:
+            formatted_context, previous_chapters_text = await asyncio.to_thread(
+                self.load_prompt_context, story_id, chapter_id
+            )
             
             logger.info("Building prompts...")
             print("[NEXT_LINE_TOOL] Building prompts...")
-            system_prompt = self._build_system_prompt()
-            user_prompt = self._build_user_prompt(formatted_context, prefix_text, suffix_text, previous_chapters_text)
+            candidate_mode = NEXT_LINE_GENERATION_MODE == "candidates"
+            if candidate_mode:
+                system_prompt = self._build_candidate_system_prompt()
+            else:
+                system_prompt = self._build_system_prompt()
+            user_prompt = self._build_user_prompt(
+                formatted_context, prefix_text, suffix_text, previous_chapters_text, single_line=candidate_mode
+            )
             response_schema = self._get_response_schema()
             
             logger.info("Calling LLM provider...")
@@ -232,44 +651,113 @@ Respond ONLY with the JSON array containing the {NUMBER_OF_SUGGESTIONS} generate
             logger.info(f"Response schema: {response_schema}")
             print(f"[NEXT_LINE_TOOL] Response schema: {response_schema}")
 
-            try:
-                generated_suggestions = await self.llm_provider.generate_structured_content(
-                    system_prompt=system_prompt,
-                    user_prompt=user_prompt,
-                    response_schema=response_schema
-                )
-                logger.info(f"Generated suggestions: {generated_suggestions}")
-                print(f"[NEXT_LINE_TOOL] Generated suggestions: {generated_suggestions}")
-                suggestions_count = len(generated_suggestions) if isinstance(generated_suggestions, list) else 'non-list'
-                logger.info(f"LLM returned {suggestions_count} suggestions")
-                print(f"[NEXT_LINE_TOOL] LLM returned {suggestions_count} suggestions")
-                
-                if not isinstance(generated_suggestions, list) or len(generated_suggestions) != NUMBER_OF_SUGGESTIONS:
-                     raise ValueError("LLM returned improperly formatted or missing suggestions.")
-
-                result = {
-                    "storyId": story_id,                
-                    "suggestions": generated_suggestions,
-                }
-                logger.info(f"Successfully generated {len(generated_suggestions)} suggestions")
-                print(f"[NEXT_LINE_TOOL] Successfully generated {len(generated_suggestions)} suggestions")
-                return result
+            cache_key = "suggestions:" + hashlib.sha256(
+                f"{system_prompt}\0{user_prompt}".encode("utf-8")
+            ).hexdigest()
+            # A regenerate request skips the lookup; its fresh suggestions replace the cached ones
+            if SUGGESTION_CACHE_TTL > 0 and not regenerate:
+                cached_suggestions = await asyncio.to_thread(get_cache().get, cache_key)
+                if cached_suggestions is not None:
+                    logger.info("Serving suggestions from cache")
+                    print("[NEXT_LINE_TOOL] Serving suggestions from cache")
+                    result = {
+                        "storyId": story_id,
+                        "suggestions": cached_suggestions,
+                    }
+                    if buffer_hash:
+                        result["contentHash"] = buffer_hash
+                    return result
 
+            try:
+                if candidate_mode:
+                    generated_suggestions = await self._generate_candidates(
+                        system_prompt, user_prompt, NUMBER_OF_SUGGESTIONS
+                    )
+                else:
+                    generated_suggestions = await self.llm_provider.generate_structured_content(
+                        system_prompt=system_prompt,
+                        user_prompt=user_prompt,
+                        response_schema=response_schema
+                    )
             except Exception as error:
+                # Nothing usable came back; the top-up below may still rescue the request
                 logger.error(f"Error in LLM generation: {error}", exc_info=True)
                 print(f"[NEXT_LINE_TOOL ERROR] Error in LLM generation: {error}")
-                import traceback
-                print(f"[NEXT_LINE_TOOL ERROR] Traceback: {traceback.format_exc()}")
+                generated_suggestions = error
+
+            logger.info(f"Generated suggestions: {generated_suggestions}")
+            print(f"[NEXT_LINE_TOOL] Generated suggestions: {generated_suggestions}")
+
+            # Repair stage: keep valid, distinct suggestions, then request only the missing ones
+            suggestions, dropped = self.repair_suggestions(generated_suggestions)
+            if dropped:
+                metrics.increment("next_line.dropped_suggestions", dropped)
+            first_pass_count = len(suggestions)
+            if first_pass_count < NUMBER_OF_SUGGESTIONS:
+                if not candidate_mode:
+                    system_prompt = self._build_candidate_system_prompt()
+                    user_prompt = self._build_user_prompt(
+                        formatted_context, prefix_text, suffix_text, previous_chapters_text, single_line=True
+                    )
+                suggestions = await self._top_up(suggestions, system_prompt, user_prompt, deadline)
+
+            # Last resort: continuations from the author's own text (the model sync may read Firestore)
+            llm_count = len(suggestions)
+            suggestions = await asyncio.to_thread(
+                self._fallback_suggestions, story_id, prefix_text, suggestions, chapter_id, before_cursor
+            )
+            used_fallback = len(suggestions) > llm_count
+
+            if used_fallback:
+                outcome = "fallback"
+            elif len(suggestions) == NUMBER_OF_SUGGESTIONS:
+                outcome = "complete" if first_pass_count == NUMBER_OF_SUGGESTIONS else "repaired"
+            else:
+                outcome = "partial" if suggestions else "empty"
+            metrics.increment("next_line.requests", outcome=outcome)
+            logger.info(f"Generated {len(suggestions)} suggestions ({outcome})")
+            print(f"[NEXT_LINE_TOOL] Generated {len(suggestions)} suggestions ({outcome})")
+
+            if not suggestions:
+                error = generated_suggestions if isinstance(generated_suggestions, Exception) else \
+                    "LLM returned improperly formatted or missing suggestions."
                 return {
                     "storyId": story_id,
                     "suggestions": [],
                     "error": f"Failed to generate lines: {error}"
                 }
+
+            if SUGGESTION_CACHE_TTL > 0 and len(suggestions) == NUMBER_OF_SUGGESTIONS and not used_fallback:
+                await asyncio.to_thread(get_cache().set, cache_key, suggestions, SUGGESTION_CACHE_TTL)
+
+            result = {
+                "storyId": story_id,
+                "suggestions": suggestions,
+            }
+            if used_fallback:
+                result["fallback"] = True
+            if buffer_hash:
+                result["contentHash"] = buffer_hash
+            return result
+
+        except DeadlineExceeded:
+            # Let the server turn this into a timeout response
+            raise
         except Exception as error:
             logger.error(f"Error in NextLineGenerationTool.execute: {error}", exc_info=True)
             print(f"[NEXT_LINE_TOOL ERROR] Error in execute: {error}")
             import traceback
             print(f"[NEXT_LINE_TOOL ERROR] Traceback: {traceback.format_exc()}")
+            suggestions = await asyncio.to_thread(
+                self._fallback_suggestions, story_id, prefix_text, [], chapter_id, before_cursor
+            )
+            if suggestions:
+                metrics.increment("next_line.requests", outcome="fallback")
+                return {
+                    "storyId": story_id,
+                    "suggestions": suggestions,
+                    "fallback": True,
+                }
             return {
                 "storyId": story_id,
                 "suggestions": [],
@@ -1,12 +1,19 @@
 """Tool for generating complete stories."""
+import asyncio
+import os
 import sys
+import time
 from pathlib import Path
-from typing import Dict, Any, Optional
+from typing import Any, Callable, Dict, List, Optional
 
 # Handle imports for both direct execution and module import
 try:
     from ..context_builder import StoryContextBuilder
-    from ..llm_provider import get_llm_provider, LLMProvider
+    from ..llm_provider import get_shared_llm_provider, LLMProvider
+    from ..metrics import metrics
+    from ..single_flight import canonical_key
+    from ..story_checkpoints import StoryCheckpointStore
+    from .chapter_generation import CHAPTER_GENERATION_MODE, ChapterGenerationTool
 except ImportError:
     # Add parent directory to path for direct execution
     current_dir = Path(__file__).parent.parent
@@ -14,7 +21,21 @@ except ImportError:
     if str(parent_dir) not in sys.path:
         sys.path.insert(0, str(parent_dir))
     from agents.storyAgent.context_builder import StoryContextBuilder
-    from agents.storyAgent.llm_provider import get_llm_provider, LLMProvider
+    from agents.storyAgent.llm_provider import get_shared_llm_provider, LLMProvider
+    from agents.storyAgent.metrics import metrics
+    from agents.storyAgent.single_flight import canonical_key
+    from agents.storyAgent.story_checkpoints import StoryCheckpointStore
+    from agents.storyAgent.tools.chapter_generation import CHAPTER_GENERATION_MODE, ChapterGenerationTool
+
+# "single": the whole story in one completion
+# "chapters": outline, chapter briefs, then chapters generated concurrently with checkpoints
+STORY_GENERATION_MODE = os.getenv("STORY_GENERATION_MODE", "single")
+# Chapters written at the same time (chapters mode)
+STORY_CHAPTER_CONCURRENCY = int(os.getenv("STORY_CHAPTER_CONCURRENCY", "3"))
+# Number of chapters per story length (chapters mode)
+STORY_CHAPTER_COUNTS = {"short": 3, "medium": 6, "long": 12}
+
+ProgressCallback = Callable[[Dict[str, Any]], None]
 
 
 class StoryGenerationTool:
@@ -24,11 +45,24 @@ class StoryGenerationTool:
         """Initialize the story generation tool."""
         self.project_id = project_id
         self.location = location
-        self.llm_provider: LLMProvider = get_llm_provider(project_id, location)
+        self.llm_provider: LLMProvider = get_shared_llm_provider(
+            project_id, location, action_class="long_form"
+        )
         self.context_builder = StoryContextBuilder(project_id)
+        self.chapter_tool = ChapterGenerationTool(project_id, location)
+        self.checkpoints = StoryCheckpointStore(project_id=project_id)
 
     async def execute(
-        self, story_id: str, genre: Optional[str] = None, tone: Optional[str] = None, length: Optional[str] = None
+        self,
+        story_id: str,
+        genre: Optional[str] = None,
+        tone: Optional[str] = None,
+        length: Optional[str] = None,
+        mode: Optional[str] = None,
+        chapter_count: Optional[int] = None,
+        run_id: Optional[str] = None,
+        restart: bool = False,
+        on_progress: Optional[ProgressCallback] = None,
     ) -> Dict[str, Any]:
         """
         Generate a complete story.
@@ -38,19 +72,44 @@ class StoryGenerationTool:
             genre: Story genre (optional, uses story data if not provided)
             tone: Story tone (optional, uses story data if not provided)
             length: Story length (short/medium/long)
+            mode: "single" or "chapters" (defaults to STORY_GENERATION_MODE)
+            chapter_count: Number of chapters in chapters mode (defaults to one per length)
+            run_id: Checkpoint ID in chapters mode (defaults to one derived from the arguments,
+                so retrying the same request resumes it)
+            restart: Discard existing checkpoints and start over (chapters mode)
+            on_progress: Optional callback receiving progress events in chapters mode
 
         Returns:
             Dictionary with generated story content
         """
         # Build context from Firestore
-        context = self.context_builder.build_story_context(story_id)
+        context = await asyncio.to_thread(self.context_builder.build_story_context, story_id)
         formatted_context = self.context_builder.format_context_for_prompt(context)
 
-        story = context["story"]
-        genre = genre or story.get("genre", "general fiction")
-        tone = tone or story.get("tone", "neutral")
+        story = context.story
+        genre = genre or story.genre or "general fiction"
+        tone = tone or story.tone or "neutral"
         length = length or "medium"
 
+        if (mode or STORY_GENERATION_MODE) == "chapters":
+            count = chapter_count or STORY_CHAPTER_COUNTS.get(length, STORY_CHAPTER_COUNTS["medium"])
+            run_id = run_id or canonical_key("generateStory", story_id, genre, tone, length, count)
+            if restart:
+                await asyncio.to_thread(self.checkpoints.clear, run_id, count)
+            result = await self.generate_chapters(
+                formatted_context, genre, tone, count, run_id, on_progress=on_progress
+            )
+            return {
+                "storyId": story_id,
+                **result,
+                "metadata": {
+                    "genre": genre,
+                    "tone": tone,
+                    "length": length,
+                    "chapterCount": count,
+                },
+            }
+
         # Build prompt
         prompt = f"""You are an expert novelist. Generate a complete {genre} story with a {tone} tone.
 
@@ -70,7 +129,7 @@ Return the story in the following format:
 """
 
         # Generate using LLM provider
-        generated_text = self.llm_provider.generate_content(prompt)
+        generated_text = await asyncio.to_thread(self.llm_provider.generate_content, prompt)
 
         # Parse response (simple extraction)
         return {
@@ -83,3 +142,188 @@ Return the story in the following format:
             },
         }
 
+
+    async def generate_chapters(
+        self,
+        formatted_context: str,
+        genre: str,
+        tone: str,
+        chapter_count: int,
+        run_id: str,
+        on_progress: Optional[ProgressCallback] = None,
+    ) -> Dict[str, Any]:
+        """
+        Generate a story chapter by chapter in stages, checkpointing each one.
+
+        Stages: a global outline, one brief per chapter, then the chapters,
+        up to STORY_CHAPTER_CONCURRENCY at a time. Chapters start in order; each
+        sees the continuity summaries of every chapter finished before it started
+        and the briefs of the rest, and leaves its own summary for later chapters.
+        Finished stages are read back from checkpoints, so a failed run resumes
+        where it stopped.
+
+        Args:
+            formatted_context: Story context formatted for prompts
+            genre: Story genre
+            tone: Story tone
+            chapter_count: Number of chapters
+            run_id: Checkpoint ID of this run
+            on_progress: Optional callback receiving progress events
+
+        Returns:
+            Dictionary with "title", "outline", "chapters", "content" and "resumedChapters"
+        """
+        def report(event: Dict[str, Any]) -> None:
+            if on_progress is not None:
+                on_progress(event)
+
+        start = time.monotonic()
+        plan = await asyncio.to_thread(self.checkpoints.get_plan, run_id)
+        if plan is None or len(plan.get("briefs", [])) != chapter_count:
+            plan = await self._plan_story(formatted_context, genre, tone, chapter_count)
+            await asyncio.to_thread(self.checkpoints.save_plan, run_id, plan)
+        report({"stage": "outline", "title": plan["title"], "outline": plan["outline"], "briefs": plan["briefs"]})
+
+        chapters: List[Optional[Dict[str, Any]]] = list(await asyncio.gather(
+            *(asyncio.to_thread(self.checkpoints.get_chapter, run_id, index) for index in range(chapter_count))
+        ))
+        resumed = sum(1 for chapter in chapters if chapter is not None)
+        if resumed:
+            print(f"[STORY_TOOL] Resuming run {run_id[:12]} with {resumed}/{chapter_count} chapters done")
+            metrics.increment("story.resumed_chapters", resumed)
+        semaphore = asyncio.Semaphore(STORY_CHAPTER_CONCURRENCY)
+
+        async def write_chapter(index: int) -> None:
+            if chapters[index] is not None:
+                report({"stage": "chapter", "index": index, "total": chapter_count, "title": chapters[index]["title"], "resumed": True})
+                return
+            async with semaphore:
+                continuity_text = self._continuity_text(plan, chapters, index)
+                chapter = await self._write_chapter(formatted_context, plan, continuity_text, index)
+            chapters[index] = chapter
+            await asyncio.to_thread(self.checkpoints.save_chapter, run_id, index, chapter)
+            report({"stage": "chapter", "index": index, "total": chapter_count, "title": chapter["title"], "resumed": False})
+
+        # Let every chapter finish (and checkpoint) before surfacing a failure
+        results = await asyncio.gather(
+            *(write_chapter(index) for index in range(chapter_count)), return_exceptions=True
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+        await asyncio.to_thread(self.checkpoints.clear, run_id, chapter_count)
+        metrics.observe("story.chapters_pipeline_seconds", time.monotonic() - start)
+        content = "\n\n".join(
+            f"Chapter {chapter['chapterNumber']}: {chapter['title']}\n\n{chapter['content']}" for chapter in chapters
+        )
+        return {
+            "title": plan["title"],
+            "outline": plan["outline"],
+            "chapters": chapters,
+            "content": f"Title: {plan['title']}\n\n{content}",
+            "resumedChapters": resumed,
+        }
+
+    async def _plan_story(self, formatted_context: str, genre: str, tone: str, chapter_count: int) -> Dict[str, Any]:
+        """Generate the global outline and one brief per chapter."""
+        outline = await asyncio.to_thread(self.llm_provider.generate_content, f"""You are an expert novelist planning a {genre} story with a {tone} tone.
+
+{formatted_context}
+
+Write a global outline for a story of {chapter_count} chapters that:
+1. Incorporates all the characters, places, and plot elements provided
+2. Has a clear beginning, middle, and end
+3. Includes character development and plot progression
+
+Start with a line "Title: [Story Title]", then describe the premise, the main arc and the ending.
+""")
+        outline = outline.strip()
+        title = "Untitled"
+        for line in outline.splitlines():
+            if line.lower().startswith("title:"):
+                title = line.split(":", 1)[1].strip().strip('"') or title
+                break
+
+        schema = {
+            "type": "array",
+            "description": f"Exactly {chapter_count} chapter briefs in reading order.",
+            "items": {"type": "string", "description": "A 2-4 sentence brief of what one chapter covers."},
+            "minItems": chapter_count,
+            "maxItems": chapter_count,
+        }
+        raw = await self.llm_provider.generate_structured_content(
+            "You are an expert novelist. Respond ONLY with a JSON array of chapter briefs, in reading order.",
+            f"""{formatted_context}
+
+=== STORY OUTLINE ===
+{outline}
+
+Split this story into {chapter_count} chapters. For each chapter, write a 2-4 sentence brief:
+what happens, who is involved, and how the chapter ends.
+""",
+            schema,
+        )
+        briefs = [item.strip() for item in raw if isinstance(item, str) and item.strip()][:chapter_count]
+        if len(briefs) < chapter_count:
+            raise ValueError(f"Expected {chapter_count} chapter briefs, got {len(briefs)}")
+        return {"title": title, "outline": outline, "briefs": briefs}
+
+    def _continuity_text(self, plan: Dict[str, Any], chapters: List[Optional[Dict[str, Any]]], index: int) -> str:
+        """What earlier chapters established: actual summaries where written, briefs otherwise."""
+        lines = []
+        for earlier in range(index):
+            chapter = chapters[earlier]
+            if chapter is not None:
+                lines.append(f"Chapter {earlier + 1}: {chapter['title']} (written)\n{chapter['summary']}")
+            else:
+                lines.append(f"Chapter {earlier + 1} (being written, planned as)\n{plan['briefs'][earlier]}")
+        if not lines:
+            return ""
+        return "\n=== PREVIOUS CHAPTERS SUMMARY ===\n" + "\n\n".join(lines) + "\n"
+
+    async def _write_chapter(
+        self,
+        formatted_context: str,
+        plan: Dict[str, Any],
+        continuity_text: str,
+        index: int,
+    ) -> Dict[str, Any]:
+        """Write one chapter from its brief and summarise it for the chapters after it."""
+        chapter_number = index + 1
+        brief = plan["briefs"][index]
+        story_context = f"{formatted_context}\n\n=== STORY OUTLINE ===\n{plan['outline']}"
+
+        title = ""
+        content = None
+        if CHAPTER_GENERATION_MODE == "scenes":
+            scenes = await self.chapter_tool.generate_scenes(story_context, continuity_text, chapter_number, brief=brief)
+            if scenes is not None:
+                title, content = scenes["title"], scenes["content"]
+        if content is None:
+            content = (await asyncio.to_thread(self.llm_provider.generate_content, f"""You are an expert novelist. Write Chapter {chapter_number} of this story.
+
+{story_context}
+{continuity_text}
+=== CHAPTER {chapter_number} BRIEF ===
+{brief}
+
+Write the full chapter prose. Maintain continuity with the previous chapters and end in a way that leads
+into the next chapter. Start with a line "Title: [Chapter Title]".
+""")).strip()
+            lines = content.splitlines()
+            if lines and lines[0].lower().startswith("title:"):
+                title = lines[0].split(":", 1)[1].strip().strip('"')
+                content = "\n".join(lines[1:]).strip()
+
+        summary = (await asyncio.to_thread(self.llm_provider.generate_content, f"""Summarise this chapter for the author writing the next ones.
+In at most 5 short bullet points, cover what happened, where each character ends up, and any open threads.
+
+{content}
+""")).strip()
+        return {
+            "chapterNumber": chapter_number,
+            "title": title or f"Chapter {chapter_number}",
+            "content": content,
+            "summary": summary,
+        }
@@ -0,0 +1,169 @@
+"""Recording of sanitized agent request shapes, replayed by benchmarks/replay_benchmark.py."""
+import asyncio
+import hashlib
+import json
+import os
+import random
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, Optional
+
+# Handle imports for both direct execution and module import
+try:
+    from .metrics import metrics
+except ImportError:
+    # Add parent directory to path for direct execution
+    current_dir = Path(__file__).parent
+    parent_dir = current_dir.parent.parent
+    if str(parent_dir) not in sys.path:
+        sys.path.insert(0, str(parent_dir))
+    from agents.storyAgent.metrics import metrics
+
+if TYPE_CHECKING:
+    from .story_context import StoryContext
+
+# JSONL file request shapes are appended to (unset: recording disabled)
+TRACE_FILE = os.getenv("TRACE_FILE", "")
+# Fraction of agent requests recorded
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+# Salt for the hashed story and chapter IDs, so traces cannot be matched against known IDs
+TRACE_SALT = os.getenv("TRACE_SALT", "")
+
+# Parameters that are IDs: recorded as salted hashes, so replay keeps which requests share a story
+ID_PARAMETERS = {"storyId", "chapterId"}
+# Parameters with a small fixed set of values, recorded as is
+ENUM_PARAMETERS = {"type", "plotType", "length", "mode"}
+
+# Record of the request being served, if it is being recorded
+_record: ContextVar[Optional[Dict[str, Any]]] = ContextVar("trace_record", default=None)
+_write_lock = threading.Lock()
+
+
+def hash_id(value: Any) -> str:
+    """Salted, shortened hash of an ID."""
+    return hashlib.sha256(f"{TRACE_SALT}{value}".encode("utf-8")).hexdigest()[:16]
+
+
+def parameter_shape(parameters: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Describe request parameters without their content.
+
+    IDs become hashes, enum-like values are kept, text becomes its length,
+    lists and objects their size, numbers and booleans are kept. The cursor
+    position is recorded relative to the content length when it is a number.
+
+    Args:
+        parameters: Agent request parameters
+
+    Returns:
+        {name: {"id"|"value"|"len"|"items"|"ratio": ...}}
+    """
+    shape: Dict[str, Any] = {}
+    for name, value in parameters.items():
+        if value is None:
+            continue
+        if name in ID_PARAMETERS:
+            shape[name] = {"id": hash_id(value)}
+        elif name in ENUM_PARAMETERS and isinstance(value, str) and len(value) <= 32:
+            shape[name] = {"value": value}
+        elif (
+            name == "cursorPosition"
+            and isinstance(value, (int, float))
+            and not isinstance(value, bool)
+            and isinstance(parameters.get("content"), str)
+            and parameters["content"]
+        ):
+            shape[name] = {"ratio": round(min(1.0, value / len(parameters["content"])), 4)}
+        elif isinstance(value, (bool, int, float)):
+            shape[name] = {"value": value}
+        elif isinstance(value, str):
+            shape[name] = {"len": len(value)}
+        elif isinstance(value, (list, tuple)):
+            shape[name] = {"items": len(value), "len": len(json.dumps(value, default=str))}
+        else:
+            shape[name] = {"len": len(json.dumps(value, default=str))}
+    return shape
+
+
+def note_story(context: "StoryContext") -> None:
+    """Add the size of the story a recorded request works on to its record."""
+    record = _record.get()
+    if record is None or "story" in record:
+        return
+    record["story"] = {
+        "chapters": len(context.chapters),
+        "chapterChars": sum(len(chapter.content) for chapter in context.chapters),
+        "characters": len(context.characters),
+        "places": len(context.places),
+        "plots": len(context.plots),
+        "chapterIds": [hash_id(chapter.id) for chapter in context.chapters],
+    }
+
+
+def _append(path: str, line: bytes) -> None:
+    with _write_lock, open(path, "ab") as trace_file:
+        trace_file.write(line)
+
+
+class TrafficRecorder:
+    """
+    ASGI middleware that appends one line per agent request to TRACE_FILE.
+
+    Each line has the arrival time, path, action, parameter shape (see
+    parameter_shape), the size of the story, the response status and the time
+    until the response was complete. Request text and IDs are not recorded.
+    """
+
+    def __init__(self, app: Any, path_prefix: str = "/agent/execute"):
+        self.app = app
+        self.path_prefix = path_prefix
+
+    async def __call__(self, scope: Dict[str, Any], receive: Any, send: Any) -> None:
+        if (
+            not TRACE_FILE
+            or scope["type"] != "http"
+            or scope["method"] != "POST"
+            or not scope["path"].startswith(self.path_prefix)
+            or random.random() >= TRACE_SAMPLE_RATE
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        arrived_at = time.time()
+        start = time.monotonic()
+        body = bytearray()
+        record: Dict[str, Any] = {"t": round(arrived_at, 3), "path": scope["path"]}
+        token = _record.set(record)
+
+        async def receive_recorded() -> Dict[str, Any]:
+            message = await receive()
+            if message["type"] == "http.request":
+                body.extend(message.get("body", b""))
+            return message
+
+        async def send_recorded(message: Dict[str, Any]) -> None:
+            if message["type"] == "http.response.start":
+                record["status"] = message["status"]
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                record["seconds"] = round(time.monotonic() - start, 4)
+            await send(message)
+
+        try:
+            await self.app(scope, receive_recorded, send_recorded)
+        finally:
+            _record.reset(token)
+            try:
+                request = json.loads(bytes(body) or b"{}")
+                record["action"] = request.get("action")
+                record["parameters"] = parameter_shape(request.get("parameters") or {})
+            except (ValueError, AttributeError):
+                record["action"] = None
+            headers = dict(scope["headers"])
+            if b"x-deadline-ms" in headers:
+                record["deadlineMs"] = headers[b"x-deadline-ms"].decode("latin-1")
+            record.setdefault("seconds", round(time.monotonic() - start, 4))
+            await asyncio.to_thread(_append, TRACE_FILE, json.dumps(record).encode("utf-8") + b"\n")
+            metrics.increment("trace.recorded")
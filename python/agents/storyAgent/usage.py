@@ -0,0 +1,221 @@
+"""Token usage of LLM calls, attributed to the action and story being served."""
+import os
+import sys
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+# Handle imports for both direct execution and module import
+try:
+    from .metrics import metrics
+except ImportError:
+    # Add parent directory to path for direct execution
+    current_dir = Path(__file__).parent
+    parent_dir = current_dir.parent.parent
+    if str(parent_dir) not in sys.path:
+        sys.path.insert(0, str(parent_dir))
+    from agents.storyAgent.metrics import metrics
+
+# Stories whose token totals are kept in memory (least recently used evicted first)
+USAGE_MAX_STORIES = int(os.getenv("USAGE_MAX_STORIES", "1000"))
+# Stories listed on /metrics, highest token use first
+USAGE_TOP_STORIES = int(os.getenv("USAGE_TOP_STORIES", "20"))
+
+
+@dataclass
+class UsageRecord:
+    """
+    What one provider call consumed.
+
+    Token counts are None when the provider did not report them. Durations are
+    in seconds: time_to_first_token from sending the request to the first output
+    token (None when it cannot be known, e.g. a non-streaming Gemini call),
+    generation_seconds the time spent producing output, total_seconds the
+    whole round trip.
+    """
+    provider: str
+    model: Optional[str]
+    input_tokens: Optional[int]
+    output_tokens: Optional[int]
+    time_to_first_token: Optional[float]
+    generation_seconds: float
+    total_seconds: float
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        if not self.output_tokens or self.generation_seconds <= 0:
+            return None
+        return self.output_tokens / self.generation_seconds
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "provider": self.provider,
+            "model": self.model,
+            "inputTokens": self.input_tokens,
+            "outputTokens": self.output_tokens,
+            "timeToFirstToken": self.time_to_first_token,
+            "generationSeconds": round(self.generation_seconds, 3),
+            "totalSeconds": round(self.total_seconds, 3),
+        }
+
+
+def _totals(records: List[UsageRecord]) -> Dict[str, Any]:
+    return {
+        "calls": len(records),
+        "inputTokens": sum(record.input_tokens or 0 for record in records),
+        "outputTokens": sum(record.output_tokens or 0 for record in records),
+        "generationSeconds": round(sum(record.generation_seconds for record in records), 3),
+    }
+
+
+@dataclass
+class UsageLedger:
+    """Provider calls made while serving one action."""
+    action: Optional[str]
+    story_id: Optional[str]
+    parent: Optional["UsageLedger"] = None
+    records: List[UsageRecord] = field(default_factory=list)
+
+    def summary(self) -> Dict[str, Any]:
+        """Totals plus every call, as returned in AgentResponse.usage."""
+        first_token = next(
+            (record.time_to_first_token for record in self.records if record.time_to_first_token is not None),
+            None,
+        )
+        return {
+            **_totals(self.records),
+            "timeToFirstToken": first_token,
+            "records": [record.to_dict() for record in self.records],
+        }
+
+
+# Ledger of the action being served. Like the request deadline, it is copied into
+# tasks and asyncio.to_thread calls, so provider calls find it without any plumbing.
+_ledger: ContextVar[Optional[UsageLedger]] = ContextVar("usage_ledger", default=None)
+
+
+@contextmanager
+def usage_scope(action: Optional[str], story_id: Optional[str] = None) -> Iterator[UsageLedger]:
+    """
+    Collect the usage of provider calls made in the enclosed code.
+
+    Calls are also added to every enclosing scope's ledger.
+
+    Args:
+        action: Agent action, used to label the metrics
+        story_id: Story the action works on, used for per-story totals
+
+    Yields:
+        The scope's ledger
+    """
+    parent = _ledger.get()
+    ledger = UsageLedger(action, story_id or (parent.story_id if parent else None), parent)
+    token = _ledger.set(ledger)
+    try:
+        yield ledger
+    finally:
+        _ledger.reset(token)
+
+
+def detach_ledger() -> Optional[UsageLedger]:
+    """
+    Give the current context a ledger of its own, not linked to the enclosing ones.
+
+    Used for work shared by several callers (see SingleFlight): its usage is
+    collected once, then added to each caller's ledgers with add_usage.
+
+    Returns:
+        The new ledger, or None if there was no ledger to detach from
+    """
+    parent = _ledger.get()
+    if parent is None:
+        return None
+    ledger = UsageLedger(parent.action, parent.story_id)
+    _ledger.set(ledger)
+    return ledger
+
+
+def add_usage(records: List[UsageRecord]) -> None:
+    """
+    Add provider calls made elsewhere to the current ledgers, without counting them in metrics again.
+
+    Args:
+        records: Usage collected in a detached ledger
+    """
+    ledger = _ledger.get()
+    while ledger is not None:
+        ledger.records.extend(records)
+        ledger = ledger.parent
+
+
+class StoryUsageRegistry:
+    """Token totals per story, least recently used stories evicted first."""
+
+    def __init__(self, max_stories: int = USAGE_MAX_STORIES):
+        self.max_stories = max_stories
+        self._stories: "OrderedDict[str, Dict[str, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, story_id: str, record: UsageRecord) -> None:
+        with self._lock:
+            totals = self._stories.get(story_id)
+            if totals is None:
+                totals = {"calls": 0, "inputTokens": 0, "outputTokens": 0, "generationSeconds": 0.0}
+                self._stories[story_id] = totals
+                while len(self._stories) > self.max_stories:
+                    self._stories.popitem(last=False)
+            else:
+                self._stories.move_to_end(story_id)
+            totals["calls"] += 1
+            totals["inputTokens"] += record.input_tokens or 0
+            totals["outputTokens"] += record.output_tokens or 0
+            totals["generationSeconds"] += record.generation_seconds
+
+    def top(self, limit: int = USAGE_TOP_STORIES) -> Dict[str, Dict[str, float]]:
+        """The stories with the most tokens used, for /metrics."""
+        with self._lock:
+            ranked = sorted(
+                self._stories.items(),
+                key=lambda item: item[1]["inputTokens"] + item[1]["outputTokens"],
+                reverse=True,
+            )
+            return {story_id: dict(totals) for story_id, totals in ranked[:limit]}
+
+
+# Process-wide registry
+story_usage = StoryUsageRegistry()
+
+
+def record_usage(record: UsageRecord) -> None:
+    """
+    Account for one provider call: metrics per action and provider, per-story totals, and the current ledgers.
+
+    Args:
+        record: Usage reported by the provider
+    """
+    ledger = _ledger.get()
+    action = ledger.action if ledger is not None and ledger.action else "none"
+    labels = {"action": action, "provider": record.provider}
+
+    metrics.increment("llm.calls", **labels)
+    if record.input_tokens is not None:
+        metrics.increment("llm.input_tokens", record.input_tokens, **labels)
+    if record.output_tokens is not None:
+        metrics.increment("llm.output_tokens", record.output_tokens, **labels)
+    if record.time_to_first_token is not None:
+        metrics.observe("llm.time_to_first_token_seconds", record.time_to_first_token, **labels)
+    metrics.observe("llm.generation_seconds", record.generation_seconds, **labels)
+    if record.tokens_per_second is not None:
+        metrics.observe("llm.output_tokens_per_second", record.tokens_per_second, provider=record.provider)
+
+    if ledger is None:
+        return
+    if ledger.story_id:
+        story_usage.add(ledger.story_id, record)
+    while ledger is not None:
+        ledger.records.append(record)
+        ledger = ledger.parent
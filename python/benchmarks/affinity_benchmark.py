@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""Story-affinity benchmark.
+
+Starts several server processes on local ports with the mock LLM provider,
+serving a synthetic dataset (PRELOAD_EXPORT), and sends next-line requests for
+a set of stories to instances picked at random, as a load balancer would. It
+runs twice: with every instance serving whatever it receives, then with
+AFFINITY_PEERS set so requests are forwarded to the story's owner.
+
+Reports the prompt-context cache hit rate summed over the instances: a miss is
+what costs Firestore reads in production, so with affinity each story should
+miss once in the whole fleet rather than once per instance.
+
+Usage (from the python/ directory):
+    python benchmarks/affinity_benchmark.py --instances 4 --stories 40 --requests 800
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import httpx
+
+PROJECT_ROOT = Path(__file__).parent.parent
+SENTENCE = "The lanterns along the harbour wall guttered in the wind, and Mara counted them twice. "
+
+
+def build_dataset(stories: int, chapters: int) -> Dict[str, dict]:
+    """An export (the format of export-prod-data.ts) with the given number of stories."""
+    return {"stories": {
+        f"story-{index}": {
+            "title": f"Story {index}",
+            "genre": "mystery",
+            "tone": "tense",
+            "__characters": {"mara": {"name": "Mara", "role": "protagonist", "backstory": SENTENCE * 4}},
+            "__chapters": {
+                f"chapter-{number}": {"chapterNumber": number, "title": f"Chapter {number}", "content": SENTENCE * 40}
+                for number in range(1, chapters + 1)
+            },
+        }
+        for index in range(stories)
+    }}
+
+
+def start_servers(ports: List[int], dataset_path: str, affinity: bool) -> List[subprocess.Popen]:
+    urls = [f"http://127.0.0.1:{port}" for port in ports]
+    processes = []
+    for port, url in zip(ports, urls):
+        env = dict(os.environ)
+        env.update({
+            "PORT": str(port),
+            "USE_MOCK": "true",
+            "PRELOAD_EXPORT": dataset_path,
+            "WARM_UP_PROVIDER": "false",
+            "TRACE_FILE": "",
+            "AFFINITY_PEERS": ",".join(urls) if affinity else "",
+            "AFFINITY_SELF": url if affinity else "",
+        })
+        env.setdefault("GOOGLE_CLOUD_PROJECT", "demo")
+        env.setdefault("PYTHONPATH", str(PROJECT_ROOT))
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "agents.storyAgent.server"],
+            cwd=PROJECT_ROOT,
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        ))
+    return processes
+
+
+def wait_until_healthy(urls: List[str], timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    for url in urls:
+        while True:
+            try:
+                if httpx.get(f"{url}/health", timeout=1.0).status_code == 200:
+                    break
+            except httpx.TransportError:
+                pass
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"{url} did not become healthy")
+            time.sleep(0.1)
+
+
+async def send_requests(urls: List[str], args: argparse.Namespace) -> List[float]:
+    rng = random.Random(args.seed)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: List[float] = []
+
+    async with httpx.AsyncClient(timeout=60.0) as client:
+        async def one() -> None:
+            story = rng.randrange(args.stories)
+            chapter = rng.randrange(1, args.chapters + 1)
+            content = SENTENCE * rng.randint(1, 5)
+            body = {"action": "generateNextLines", "parameters": {
+                "storyId": f"story-{story}",
+                "chapterId": f"chapter-{chapter}",
+                "content": content,
+                "cursorPosition": len(content),
+            }}
+            url = rng.choice(urls)
+            async with semaphore:
+                start = time.monotonic()
+                response = await client.post(f"{url}/agent/execute", json=body)
+                latencies.append(time.monotonic() - start)
+                response.raise_for_status()
+
+        await asyncio.gather(*(one() for _ in range(args.requests)))
+    return latencies
+
+
+def prompt_context_counts(urls: List[str]) -> Dict[str, float]:
+    """Prompt-context cache hits and misses summed over the instances."""
+    totals = {"cache": 0.0, "built": 0.0}
+    for url in urls:
+        counters = httpx.get(f"{url}/metrics", timeout=5.0).json()["counters"]
+        for source in totals:
+            totals[source] += counters.get(f"next_line.prompt_context{{source={source}}}", 0)
+    return totals
+
+
+def run(args: argparse.Namespace, dataset_path: str, affinity: bool) -> None:
+    ports = [args.port + index for index in range(args.instances)]
+    urls = [f"http://127.0.0.1:{port}" for port in ports]
+    processes = start_servers(ports, dataset_path, affinity)
+    try:
+        wait_until_healthy(urls, 60.0)
+        start = time.monotonic()
+        latencies = sorted(asyncio.run(send_requests(urls, args)))
+        elapsed = time.monotonic() - start
+        counts = prompt_context_counts(urls)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    lookups = counts["cache"] + counts["built"]
+    print(
+        f"{'affinity' if affinity else 'random':9} {args.requests / elapsed:>7.0f}/s "
+        f"p50 {latencies[len(latencies) // 2] * 1000:>7.1f} ms  p99 {latencies[int(len(latencies) * 0.99)] * 1000:>7.1f} ms  "
+        f"context builds {counts['built']:>5.0f}  hit rate {counts['cache'] / lookups if lookups else 0:.1%}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--instances", type=int, default=4, help="Server processes")
+    parser.add_argument("--stories", type=int, default=40, help="Distinct stories requested")
+    parser.add_argument("--chapters", type=int, default=3, help="Chapters per story")
+    parser.add_argument("--requests", type=int, default=800, help="Requests per run")
+    parser.add_argument("--concurrency", type=int, default=16, help="Requests in flight at once")
+    parser.add_argument("--port", type=int, default=8770, help="Port of the first instance")
+    parser.add_argument("--seed", type=int, default=7, help="Seed for the request mix")
+    args = parser.parse_args()
+
+    dataset_path = os.path.join(tempfile.mkdtemp(), "affinity-export.json")
+    with open(dataset_path, "w", encoding="utf-8") as dataset_file:
+        json.dump(build_dataset(args.stories, args.chapters), dataset_file)
+
+    print(f"{args.requests} requests for {args.stories} stories over {args.instances} instances")
+    run(args, dataset_path, affinity=False)
+    run(args, dataset_path, affinity=True)
+
+
+if __name__ == "__main__":
+    main()
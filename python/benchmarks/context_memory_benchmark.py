@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""Story context memory benchmark.
+
+Builds synthetic stories shaped like Firestore documents (each document decoded
+separately, so field names and values are fresh strings as with to_dict()) and
+measures with tracemalloc how much memory a cached context takes as plain
+dicts versus the typed StoryContext, reporting contexts per GB.
+
+Usage (from the python/ directory):
+    python benchmarks/context_memory_benchmark.py
+"""
+import argparse
+import gc
+import json
+import random
+import sys
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Dict, List
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from agents.storyAgent.story_context import StoryContext  # noqa: E402
+
+GENRES = ["fantasy", "mystery", "romance", "science fiction", "thriller"]
+TONES = ["dark", "hopeful", "whimsical", "tense", "melancholic"]
+ROLES = ["protagonist", "antagonist", "mentor", "sidekick", "love interest"]
+PLOT_TYPES = ["main", "subplot", "backstory"]
+SENTENCE = "The lanterns along the harbour wall guttered in the wind, and Mara counted them twice. "
+
+
+def _document(fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Round-trip through JSON so every key and value is a freshly allocated string."""
+    return json.loads(json.dumps(fields))
+
+
+def _metadata(rng: random.Random) -> Dict[str, Any]:
+    # Fields Firestore documents carry that the prompts never use
+    return {
+        "userId": f"user-{rng.randrange(10**6)}",
+        "createdAt": "2024-03-01T12:00:00Z",
+        "updatedAt": "2024-03-02T08:30:00Z",
+    }
+
+
+def make_story(rng: random.Random, characters: int, places: int, plots: int, chapters: int, chapter_kb: int) -> Dict[str, Any]:
+    """Documents of one story, in the shape _fetch_story_context reads them."""
+    story_id = f"story-{rng.randrange(10**9)}"
+    return {
+        "story": _document({
+            "id": story_id, "title": "The Harbour Lights", "genre": rng.choice(GENRES),
+            "tone": rng.choice(TONES), "description": SENTENCE * 3, **_metadata(rng),
+        }),
+        "characters": [
+            _document({
+                "id": f"char-{i}", "name": f"Character {i}", "role": rng.choice(ROLES),
+                "backstory": SENTENCE * 4, "traits": ["brave", "stubborn", "curious"],
+                "motivations": SENTENCE, **_metadata(rng),
+            })
+            for i in range(characters)
+        ],
+        "places": [
+            _document({
+                "id": f"place-{i}", "name": f"Place {i}", "description": SENTENCE * 2,
+                "atmosphere": "cold and salt-stained", **_metadata(rng),
+            })
+            for i in range(places)
+        ],
+        "plots": [
+            _document({
+                "id": f"plot-{i}", "title": f"Plot {i}", "description": SENTENCE * 3,
+                "type": rng.choice(PLOT_TYPES), **_metadata(rng),
+            })
+            for i in range(plots)
+        ],
+        "chapters": [
+            _document({
+                "id": f"chapter-{i}", "chapterNumber": i + 1, "title": f"Chapter {i + 1}",
+                "content": SENTENCE * max(0, chapter_kb * 1024 // len(SENTENCE)), **_metadata(rng),
+            })
+            for i in range(chapters)
+        ],
+    }
+
+
+def measure(build: Callable[[], List[Any]]) -> int:
+    """Bytes still allocated by the objects build() returns."""
+    gc.collect()
+    tracemalloc.start()
+    objects = build()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--stories", type=int, default=200, help="Contexts built per measurement")
+    parser.add_argument("--characters", type=int, default=12, help="Characters per story")
+    parser.add_argument("--places", type=int, default=8, help="Places per story")
+    parser.add_argument("--plots", type=int, default=6, help="Plots per story")
+    parser.add_argument("--chapters", type=int, default=20, help="Chapters per story")
+    parser.add_argument("--chapter-kb", type=int, default=12, help="Approximate size of each chapter's text")
+    args = parser.parse_args()
+
+    def stories(chapter_kb: int) -> Callable[[], List[Dict[str, Any]]]:
+        rng = random.Random(42)
+        return lambda: [
+            make_story(rng, args.characters, args.places, args.plots, args.chapters, chapter_kb)
+            for _ in range(args.stories)
+        ]
+
+    def typed(chapter_kb: int) -> Callable[[], List[StoryContext]]:
+        build = stories(chapter_kb)
+        return lambda: [StoryContext.from_documents(**documents) for documents in build()]
+
+    print(
+        f"{args.stories} stories: {args.characters} characters, {args.places} places, "
+        f"{args.plots} plots, {args.chapters} chapters of ~{args.chapter_kb} KB"
+    )
+    for label, chapter_kb in (("with chapter text", args.chapter_kb), ("metadata only", 0)):
+        baseline = measure(stories(chapter_kb)) / args.stories
+        compact = measure(typed(chapter_kb)) / args.stories
+        print(
+            f"{label:18} dicts {baseline / 1024:>8.1f} KB/story {2**30 / baseline:>8.0f}/GB | "
+            f"StoryContext {compact / 1024:>8.1f} KB/story {2**30 / compact:>8.0f}/GB "
+            f"({baseline / compact:.2f}x)"
+        )
+
+
+if __name__ == "__main__":
+    main()
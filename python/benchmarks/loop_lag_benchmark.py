@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Event loop lag benchmark.
+
+Runs agent actions concurrently in one process with the mock LLM provider,
+while the event loop watchdog measures loop lag. Firestore reads and LLM calls
+are simulated with blocking sleeps, as the real clients block: as long as the
+tools run them in threads the loop stays responsive, and a change that calls
+one on the loop shows up as stalls with the offending stack. Exits with status
+1 when the loop stalled or the worst lag exceeds --max-lag, so it can gate CI.
+
+Usage (from the python/ directory):
+    python benchmarks/loop_lag_benchmark.py --requests 200 --concurrency 32
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+os.environ.setdefault("USE_MOCK", "true")
+os.environ.setdefault("GOOGLE_CLOUD_PROJECT", "demo")
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from agents.storyAgent.agent import StoryAgent  # noqa: E402
+from agents.storyAgent.context_builder import StoryContextBuilder  # noqa: E402
+from agents.storyAgent.llm_provider import MockProvider  # noqa: E402
+from agents.storyAgent.loop_watchdog import LoopWatchdog  # noqa: E402
+from agents.storyAgent.metrics import metrics  # noqa: E402
+from agents.storyAgent.story_context import StoryContext  # noqa: E402
+
+ACTIONS = {
+    "brainstormIdeas": {"type": "plots"},
+    "brainstormCharacter": {},
+    "brainstormPlot": {"plotType": "twist"},
+    "generateNextLines": {"content": "The lanterns along the harbour wall guttered in the wind.", "cursorPosition": 57},
+}
+
+
+def simulate_latency(firestore_seconds: float, llm_seconds: float) -> None:
+    """Make story reads and mock LLM calls block like the real clients."""
+    context = StoryContext.from_documents(
+        {"id": "bench", "title": "The Harbour Lights", "genre": "mystery", "tone": "tense"}, [], [], [], []
+    )
+
+    def build_story_context(self, story_id, *args, **kwargs):
+        time.sleep(firestore_seconds)
+        return context
+
+    generate_content = MockProvider.generate_content
+
+    def slow_generate_content(self, prompt):
+        time.sleep(llm_seconds)
+        return generate_content(self, prompt)
+
+    StoryContextBuilder.build_story_context = build_story_context
+    MockProvider.generate_content = slow_generate_content
+
+
+async def run(args: argparse.Namespace, watchdog: LoopWatchdog) -> float:
+    agent = StoryAgent()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    actions = list(ACTIONS.items())
+    heartbeat = asyncio.create_task(watchdog.run())
+    await asyncio.sleep(watchdog.interval)
+
+    async def one(index: int) -> None:
+        action, parameters = actions[index % len(actions)]
+        async with semaphore:
+            # Distinct stories, so identical requests are not deduplicated
+            await agent.execute_agent(action, {**parameters, "storyId": f"bench-{index}"})
+
+    start = time.monotonic()
+    await asyncio.gather(*(one(index) for index in range(args.requests)))
+    elapsed = time.monotonic() - start
+    heartbeat.cancel()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="Agent calls to run")
+    parser.add_argument("--concurrency", type=int, default=32, help="Agent calls in flight at once")
+    parser.add_argument("--firestore-ms", type=float, default=20, help="Simulated story context read time")
+    parser.add_argument("--llm-ms", type=float, default=50, help="Simulated LLM call time")
+    parser.add_argument("--interval", type=float, default=0.01, help="Seconds between lag measurements")
+    parser.add_argument("--max-lag", type=float, default=0.05, help="Worst acceptable lag in seconds")
+    args = parser.parse_args()
+
+    simulate_latency(args.firestore_ms / 1000, args.llm_ms / 1000)
+    watchdog = LoopWatchdog(interval=args.interval, threshold=args.max_lag)
+    elapsed = asyncio.run(run(args, watchdog))
+
+    lag = metrics.snapshot()["timings"].get("event_loop.lag_seconds", {})
+    snapshot = watchdog.snapshot()
+    print(f"{args.requests} requests, {args.concurrency} concurrent, {elapsed:.2f}s ({args.requests / elapsed:.0f}/s)")
+    print(
+        f"loop lag: p50 {lag.get('p50', 0) * 1000:.1f} ms, p99 {lag.get('p99', 0) * 1000:.1f} ms, "
+        f"max {snapshot['maxLagSeconds'] * 1000:.1f} ms over {lag.get('count', 0)} measurements"
+    )
+    for stall in snapshot["stalls"]:
+        print(f"stall {stall['seconds'] * 1000:.0f} ms in {stall['where']}")
+        for line in stall["stack"][-8:]:
+            print(f"    {line}")
+    if snapshot["stalls"] or snapshot["maxLagSeconds"] > args.max_lag:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""Replay recorded agent traffic against a local server.
+
+Reads a trace recorded with TRACE_FILE (see agents/storyAgent/traffic_recorder.py),
+builds a synthetic dataset with stories of the recorded sizes, starts the server
+with the mock LLM provider serving that dataset (PRELOAD_EXPORT), and sends the
+recorded requests at their original spacing divided by --speed. Parameters are
+rebuilt from their recorded shape: text of the recorded length, the cursor at
+the recorded relative position. Delta uploads (baseHash + edits) are replayed as
+full content, since the server has no chapter buffer to apply them to.
+
+Reports latency percentiles per action, next to the latency recorded in
+production, so capacity can be planned on the real mix of actions and story sizes.
+
+Usage (from the python/ directory):
+    python benchmarks/replay_benchmark.py trace.jsonl --speed 2
+    python benchmarks/replay_benchmark.py trace.jsonl --url http://localhost:8000 --dataset replay-export.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+PROJECT_ROOT = Path(__file__).parent.parent
+SENTENCE = "The lanterns along the harbour wall guttered in the wind, and Mara counted them twice. "
+
+
+def filler(length: int) -> str:
+    """Text of the given length."""
+    return (SENTENCE * (length // len(SENTENCE) + 1))[:length]
+
+
+def load_trace(path: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Recorded requests with an action, in arrival order."""
+    records = []
+    with open(path, "r", encoding="utf-8") as trace_file:
+        for line in trace_file:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if record.get("action"):
+                records.append(record)
+    records.sort(key=lambda record: record["t"])
+    return records[:limit] if limit else records
+
+
+def build_dataset(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    An export (the format of export-prod-data.ts) with one synthetic story per recorded story.
+
+    Each story gets the largest recorded counts of chapters, characters, places
+    and plots, chapters of the recorded average size, and the recorded chapter IDs.
+    """
+    sizes: Dict[str, Dict[str, Any]] = {}
+    for record in records:
+        story_id = record.get("parameters", {}).get("storyId", {}).get("id")
+        if not story_id:
+            continue
+        size = sizes.setdefault(story_id, {"chapters": 0, "chapterChars": 0, "characters": 0, "places": 0, "plots": 0, "chapterIds": []})
+        for key, value in (record.get("story") or {}).items():
+            if key == "chapterIds":
+                size[key] = value if len(value) > len(size[key]) else size[key]
+            else:
+                size[key] = max(size[key], value)
+        chapter = record["parameters"].get("chapterId", {}).get("id")
+        if chapter and chapter not in size["chapterIds"]:
+            size["chapterIds"] = [*size["chapterIds"], chapter]
+
+    stories = {}
+    for story_id, size in sizes.items():
+        chapter_count = max(size["chapters"], len(size["chapterIds"]))
+        chapter_ids = size["chapterIds"] + [f"chapter-{index}" for index in range(len(size["chapterIds"]), chapter_count)]
+        chapter_chars = size["chapterChars"] // chapter_count if chapter_count else 0
+        stories[story_id] = {
+            "title": "The Harbour Lights",
+            "genre": "mystery",
+            "tone": "tense",
+            "description": filler(300),
+            "__characters": {
+                f"character-{index}": {"name": f"Character {index}", "role": "supporting", "backstory": filler(400)}
+                for index in range(size["characters"])
+            },
+            "__places": {
+                f"place-{index}": {"name": f"Place {index}", "description": filler(200)}
+                for index in range(size["places"])
+            },
+            "__plots": {
+                f"plot-{index}": {"title": f"Plot {index}", "description": filler(300), "type": "subplot"}
+                for index in range(size["plots"])
+            },
+            "__chapters": {
+                chapter_id: {"chapterNumber": number, "title": f"Chapter {number}", "content": filler(chapter_chars)}
+                for number, chapter_id in enumerate(chapter_ids, start=1)
+            },
+        }
+    return {"stories": stories}
+
+
+def build_parameters(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Request parameters rebuilt from their recorded shape."""
+    shape = dict(record.get("parameters", {}))
+    if "edits" in shape:
+        # Delta uploads need the server's chapter buffer: send a full chapter instead
+        shape.pop("baseHash", None)
+        shape.pop("edits", None)
+        shape.pop("contentHash", None)
+        shape.setdefault("content", {"len": (record.get("story") or {}).get("chapterChars", 4000) // max(1, (record.get("story") or {}).get("chapters", 1))})
+        shape.setdefault("cursorPosition", {"ratio": 1.0})
+
+    parameters: Dict[str, Any] = {}
+    for name, description in shape.items():
+        if "id" in description:
+            parameters[name] = description["id"]
+        elif "value" in description:
+            parameters[name] = description["value"]
+        elif "items" in description:
+            parameters[name] = []
+        elif "len" in description:
+            parameters[name] = filler(description["len"])
+    cursor = shape.get("cursorPosition", {})
+    if "ratio" in cursor:
+        parameters["cursorPosition"] = int(cursor["ratio"] * len(parameters.get("content", "")))
+    return parameters
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def replay(records: List[Dict[str, Any]], url: str, speed: float, timeout: float) -> Dict[str, List[Dict[str, Any]]]:
+    """Send every record at its recorded offset divided by speed; return the results per action."""
+    results: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+    first = records[0]["t"]
+    start = time.monotonic()
+
+    async with httpx.AsyncClient(base_url=url, timeout=timeout, limits=httpx.Limits(max_connections=None)) as client:
+        async def send(record: Dict[str, Any]) -> None:
+            delay = (record["t"] - first) / speed - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            body = {"action": record["action"], "parameters": build_parameters(record)}
+            headers = {"X-Deadline-Ms": record["deadlineMs"]} if record.get("deadlineMs") else {}
+            sent = time.monotonic()
+            try:
+                if record.get("path", "").endswith("/stream"):
+                    async with client.stream("POST", record["path"], json=body, headers=headers) as response:
+                        lines = [line async for line in response.aiter_lines() if line]
+                    success = response.status_code == 200 and bool(lines) and json.loads(lines[-1]).get("success")
+                else:
+                    response = await client.post(record.get("path", "/agent/execute"), json=body, headers=headers)
+                    success = response.status_code == 200 and response.json().get("success")
+            except httpx.HTTPError:
+                success = False
+            results[record["action"]].append({
+                "seconds": time.monotonic() - sent,
+                "success": bool(success),
+                "lateness": max(0.0, sent - start - (record["t"] - first) / speed),
+                "recorded": record.get("seconds"),
+            })
+
+        await asyncio.gather(*(send(record) for record in records))
+    return results
+
+
+def start_server(dataset_path: str, port: int) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "PORT": str(port),
+        "USE_MOCK": "true",
+        "PRELOAD_EXPORT": dataset_path,
+        "WARM_UP_PROVIDER": "false",
+        # Do not record the replay itself
+        "TRACE_FILE": "",
+    })
+    env.setdefault("GOOGLE_CLOUD_PROJECT", "demo")
+    env.setdefault("PYTHONPATH", str(PROJECT_ROOT))
+    return subprocess.Popen(
+        [sys.executable, "-m", "agents.storyAgent.server"],
+        cwd=PROJECT_ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def wait_until_healthy(url: str, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(f"{url}/health", timeout=1.0).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError("Server did not become healthy")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace", help="JSONL trace recorded with TRACE_FILE")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay rate relative to the recording (2 = twice as fast)")
+    parser.add_argument("--limit", type=int, default=None, help="Replay only the first N requests")
+    parser.add_argument("--url", default=None, help="Replay against this server instead of starting one")
+    parser.add_argument("--port", type=int, default=8766, help="Port for the server started by the benchmark")
+    parser.add_argument("--dataset", default=None, help="Where to write the synthetic dataset (default: a temp file)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Per-request timeout in seconds")
+    args = parser.parse_args()
+
+    records = load_trace(args.trace, args.limit)
+    if not records:
+        print("No requests in trace")
+        return
+    dataset_path = args.dataset or os.path.join(tempfile.mkdtemp(), "replay-export.json")
+    with open(dataset_path, "w", encoding="utf-8") as dataset_file:
+        json.dump(build_dataset(records), dataset_file)
+
+    process = None
+    url = args.url
+    if url is None:
+        process = start_server(dataset_path, args.port)
+        url = f"http://127.0.0.1:{args.port}"
+    try:
+        wait_until_healthy(url, 60.0)
+        span = (records[-1]["t"] - records[0]["t"]) / args.speed
+        print(f"Replaying {len(records)} requests over {span:.1f}s against {url} (dataset: {dataset_path})")
+        start = time.monotonic()
+        results = asyncio.run(replay(records, url, args.speed, args.timeout))
+        elapsed = time.monotonic() - start
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    print(f"{len(records)} requests in {elapsed:.1f}s ({len(records) / elapsed:.1f}/s)")
+    print(f"{'action':22} {'count':>6} {'errors':>6} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8} {'rec p50':>8} {'late p99':>9}")
+    for action, runs in sorted(results.items()):
+        seconds = [run["seconds"] for run in runs]
+        recorded = [run["recorded"] for run in runs if run["recorded"] is not None]
+        print(
+            f"{action:22} {len(runs):>6} {sum(not run['success'] for run in runs):>6} "
+            f"{percentile(seconds, 0.5):>8.3f} {percentile(seconds, 0.95):>8.3f} {percentile(seconds, 0.99):>8.3f} "
+            f"{max(seconds):>8.3f} {percentile(recorded, 0.5):>8.3f} "
+            f"{percentile([run['lateness'] for run in runs], 0.99):>9.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
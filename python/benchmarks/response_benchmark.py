@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Response encoding benchmark for /agent/execute payloads.
+
+Compares the default Pydantic serialization of AgentResponse with the fast
+encoder path (orjson when installed, raw responses omitted, negotiated
+compression), reporting payload bytes and serialization CPU per request.
+
+Usage (from the python/ directory):
+    python benchmarks/response_benchmark.py
+"""
+import argparse
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict
+
+from pydantic import BaseModel
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from agents.storyAgent import response_encoding  # noqa: E402
+
+
+class AgentResponse(BaseModel):
+    """Same shape as server.AgentResponse (not imported to avoid starting the agent)."""
+    success: bool
+    data: Any = None
+    error: str = None
+
+
+PARAGRAPH = (
+    "The lanterns along the harbour wall guttered in the wind, and Mara counted them "
+    "twice before she trusted herself to speak. Somewhere below, the tide was turning. "
+)
+
+
+def make_payloads(size_kb: int) -> Dict[str, Any]:
+    """Build representative results for a story, a chapter and a brainstorm."""
+    text = PARAGRAPH * max(1, size_kb * 1024 // len(PARAGRAPH))
+    ideas_text = "\n\n".join(f"{i}. **Idea {i}** - {PARAGRAPH * 3}" for i in range(1, 6))
+    return {
+        "generateStory": {
+            "storyId": "story-1",
+            "content": text,
+            "metadata": {"genre": "fantasy", "tone": "dark", "length": "long"},
+        },
+        "generateChapter": {"storyId": "story-1", "chapterNumber": 7, "content": text},
+        "brainstormIdeas": {
+            "storyId": "story-1",
+            "type": "characters",
+            "ideas": [{"text": idea} for idea in ideas_text.split("\n\n")],
+            "rawResponse": ideas_text,
+        },
+    }
+
+
+def measure(fn: Callable[[], bytes], iterations: int) -> Dict[str, float]:
+    """Return the body size and mean CPU time of an encoder."""
+    body = fn()
+    start = time.process_time()
+    for _ in range(iterations):
+        fn()
+    elapsed = time.process_time() - start
+    return {"bytes": len(body), "us": elapsed / iterations * 1_000_000}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-kb", type=int, default=40, help="Approximate size of generated story text")
+    parser.add_argument("--iterations", type=int, default=200, help="Encodings per measurement")
+    parser.add_argument("--accept-encoding", default="gzip, deflate, br", help="Accept-Encoding header to negotiate")
+    args = parser.parse_args()
+
+    print(f"orjson: {'yes' if response_encoding.orjson else 'no'}, brotli: {'yes' if response_encoding.brotli else 'no'}")
+    for action, data in make_payloads(args.size_kb).items():
+        stripped = {key: value for key, value in data.items() if key != "rawResponse"}
+        baseline = measure(lambda: AgentResponse(success=True, data=data).model_dump_json().encode("utf-8"), args.iterations)
+        payload = {"success": True, "data": stripped, "error": None}
+        encoded = measure(lambda: response_encoding.encode_json(payload), args.iterations)
+        compressed = measure(lambda: response_encoding.encode_body(payload, args.accept_encoding)[0], args.iterations)
+        print(
+            f"{action:16} baseline {baseline['bytes']:>8} B {baseline['us']:>6.0f} us | "
+            f"fast {encoded['bytes']:>8} B {encoded['us']:>6.0f} us | "
+            f"fast+compressed {compressed['bytes']:>8} B {compressed['us']:>6.0f} us"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""Cold-start benchmark for the story agent server.
+
+Starts the server in a fresh process and measures the time from process start
+to the first successful /health response and the first successful
+/agent/execute response.
+
+Usage (from the python/ directory, with the Firestore emulator running):
+    USE_MOCK=true python benchmarks/startup_benchmark.py --story-id <storyId>
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import httpx
+
+PROJECT_ROOT = Path(__file__).parent.parent
+
+
+def wait_for(request, deadline: float, interval: float = 0.01) -> httpx.Response:
+    """Retry a request until it succeeds or the deadline passes."""
+    while time.monotonic() < deadline:
+        try:
+            response = request()
+            if response.status_code == 200:
+                return response
+        except httpx.TransportError:
+            pass
+        time.sleep(interval)
+    raise TimeoutError("Server did not respond before the deadline")
+
+
+def run_once(port: int, story_id: str, action: str, timeout: float) -> dict:
+    """Start the server once and return the measured timings in seconds."""
+    env = dict(os.environ)
+    env["PORT"] = str(port)
+    env.setdefault("PYTHONPATH", str(PROJECT_ROOT))
+
+    start = time.monotonic()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "agents.storyAgent.server"],
+        cwd=PROJECT_ROOT,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        base_url = f"http://127.0.0.1:{port}"
+        deadline = start + timeout
+        with httpx.Client(base_url=base_url, timeout=timeout) as client:
+            wait_for(lambda: client.get("/health"), deadline)
+            health = time.monotonic() - start
+
+            parameters = {"storyId": story_id}
+            if action == "generateNextLines":
+                parameters.update({"content": "It was a dark and stormy night.", "cursorPosition": 31})
+            response = wait_for(
+                lambda: client.post("/agent/execute", json={"action": action, "parameters": parameters}),
+                deadline,
+            )
+            execute = time.monotonic() - start
+            if not response.json().get("success"):
+                raise RuntimeError(f"Agent execution failed: {response.json().get('error')}")
+
+        return {"health": health, "execute": execute}
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--story-id", required=True, help="Story document ID to use for /agent/execute")
+    parser.add_argument("--action", default="generateNextLines", help="Agent action to execute")
+    parser.add_argument("--runs", type=int, default=5, help="Number of cold starts to measure")
+    parser.add_argument("--port", type=int, default=8765, help="Port to run the server on")
+    parser.add_argument("--timeout", type=float, default=60.0, help="Per-run timeout in seconds")
+    args = parser.parse_args()
+
+    results = []
+    for run in range(1, args.runs + 1):
+        timings = run_once(args.port, args.story_id, args.action, args.timeout)
+        results.append(timings)
+        print(f"run {run}: health={timings['health'] * 1000:.0f}ms execute={timings['execute'] * 1000:.0f}ms")
+
+    for key in ("health", "execute"):
+        values = sorted(r[key] for r in results)
+        print(f"{key}: min={values[0] * 1000:.0f}ms median={values[len(values) // 2] * 1000:.0f}ms max={values[-1] * 1000:.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
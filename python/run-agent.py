@@ -31,9 +31,9 @@ if not os.getenv("FIRESTORE_EMULATOR_HOST"):
 
 # Import and run the server
 if __name__ == "__main__":
-    from agents.storyAgent.server import app
-    import uvicorn
-    
-    port = int(os.getenv("PORT", "8000"))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    from agents.storyAgent.server import run_server
+
+    # Set WORKERS=<n> to pre-fork several worker processes sharing one cache
+    run_server()
+
 
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""Run one agent action over many stories offline.
+
+Stories come from a dataset written by functions/src/export-prod-data.ts
+(EXPORT_FILE=...), or from Firestore (the emulator, loaded with a snapshot via
+`firebase emulators:start --import=...`, unless FIRESTORE_EMULATOR_HOST points
+elsewhere). Results are appended to a JSONL file, one line per story; rerunning
+with the same output file skips stories that already succeeded.
+
+Examples:
+    python run-batch.py --export prod-export.json --action brainstormIdeas --params '{"type": "plots"}' --output plots.jsonl
+    python run-batch.py --firestore --action brainstormCharacter --processes 4 --concurrency 16
+"""
+import argparse
+import json
+import os
+import sys
+from pathlib import Path
+from dotenv import load_dotenv
+
+# Add project root to Python path
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+# Load environment variables from .env file
+# Try multiple locations: project root, agents folder, and agents/storyAgent folder
+env_locations = [
+    project_root / ".env",  # project root .env
+    project_root / "agents" / ".env",  # agents/.env
+    project_root / "agents" / "storyAgent" / ".env",  # agents/storyAgent/.env
+]
+
+for env_path in env_locations:
+    if env_path.exists():
+        load_dotenv(dotenv_path=env_path)
+        print(f"Loaded environment variables from {env_path}")
+        break
+
+# Set environment variables if not already set
+if not os.getenv("FIRESTORE_EMULATOR_HOST"):
+    # Check if emulator is likely running
+    emulator_host = os.getenv("FIRESTORE_EMULATOR_HOST", "localhost:8080")
+    os.environ["FIRESTORE_EMULATOR_HOST"] = emulator_host
+
+
+def main():
+    from agents.storyAgent.batch_runner import (
+        BATCH_CONCURRENCY,
+        completed_stories,
+        list_firestore_stories,
+        load_export,
+        run_batch,
+    )
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--export", help="Dataset file written by export-prod-data.ts")
+    source.add_argument("--firestore", action="store_true", help="Read stories from Firestore or the emulator")
+    parser.add_argument("--action", required=True, help="Agent action, e.g. brainstormIdeas")
+    parser.add_argument("--params", default="{}", help="JSON parameters for every story (storyId is added)")
+    parser.add_argument("--output", default="batch-results.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="Worker processes")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="Concurrent agent calls per process")
+    parser.add_argument("--timeout", type=float, default=None, help="Deadline per story (seconds)")
+    parser.add_argument("--stories", nargs="*", help="Only run these story IDs")
+    parser.add_argument("--limit", type=int, default=None, help="Run at most this many stories")
+    parser.add_argument("--skip-failed", action="store_true", help="Also skip stories whose last result was a failure")
+    parser.add_argument("--restart", action="store_true", help="Ignore results already in the output file")
+    args = parser.parse_args()
+
+    if args.export:
+        items = list(load_export(args.export).items())
+    else:
+        items = [(story_id, None) for story_id in list_firestore_stories(os.getenv("GOOGLE_CLOUD_PROJECT"))]
+
+    if args.stories:
+        wanted = set(args.stories)
+        items = [item for item in items if item[0] in wanted]
+    if not args.restart:
+        done = completed_stories(args.output, include_failed=args.skip_failed)
+        if done:
+            print(f"Skipping {len(done)} stories already in {args.output}")
+        items = [item for item in items if item[0] not in done]
+    if args.limit is not None:
+        items = items[:args.limit]
+    if not items:
+        print("Nothing to run")
+        return
+
+    summary = run_batch(
+        items,
+        args.action,
+        json.loads(args.params),
+        args.output,
+        processes=args.processes,
+        concurrency=args.concurrency,
+        timeout=args.timeout,
+    )
+    print(json.dumps(summary))
+
+
+if __name__ == "__main__":
+    main()
@@ -24,6 +24,8 @@ export interface GenerateNextLinesRequest {
   content: string;
   cursorPosition: number;
   chapterId?: string;
+  // Ask for new suggestions instead of the ones cached for the same text
+  regenerate?: boolean;
 }
 
 export interface GenerateNextLinesResponse {
@@ -35,6 +37,11 @@ export interface GenerateNextLinesResponse {
   error: string | null;
 }
 
+export interface PrefetchChapterRequest {
+  storyId: string;
+  chapterId?: string;
+}
+
 /**
  * Generate brainstorming ideas synchronously (characters, plots, places, or themes).
  *
@@ -93,3 +100,19 @@ export const generateNextLines = async (
     throw new Error(errorMessage);
   }
 };
+
+/**
+ * Ask the agent to warm its caches for a chapter that was just opened, so the
+ * first next line suggestion is fast. Best effort: failures are ignored.
+ *
+ * @param request - The story and chapter being opened
+ */
+export const prefetchChapter = async (
+  request: PrefetchChapterRequest
+): Promise<void> => {
+  try {
+    await axiosInstance.post("/prefetchChapter", request);
+  } catch (error: any) {
+    console.warn("Chapter prefetch failed:", error.message);
+  }
+};
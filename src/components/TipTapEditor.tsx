@@ -25,7 +25,7 @@ import { AITextGenerator } from "@/components/AITextGenerator";
 import EditorHeader from "@/components/EditorHeader";
 import { slashCommandSuggestion } from "./SlashCommandExtension";
 import { SuggestionMenu } from "./SuggestionMenu";
-import { generateNextLines } from "@/api/brainstormApi";
+import { generateNextLines, prefetchChapter } from "@/api/brainstormApi";
 import { useAiUsage } from "@/contexts/AiUsageContext";
 
 const limit = 50000;
@@ -213,6 +213,13 @@ export const TipTapEditor: React.FC<TipTapEditorProps> = ({
     },
   });
 
+  // Warm the agent's context for this chapter before the first suggestion
+  useEffect(() => {
+    if (storyId) {
+      prefetchChapter({ storyId, chapterId });
+    }
+  }, [storyId, chapterId]);
+
   // Update editor content when initialContent changes
   useEffect(() => {
     if (editor && editor.getHTML() !== initialContent) {